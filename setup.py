@@ -6,7 +6,8 @@ setup(name='staste',
       author='Valentin Golev',
       author_email='v.golev@gmail.com',
       url='http://staste.unfoldthat.com/',
-      packages=['staste', 'staste.charts'],
+      packages=['staste', 'staste.charts',
+                'staste.management', 'staste.management.commands'],
       package_data={'staste':
                         ['templates/staste/*.html',
                          'templates/staste/*/*.html']
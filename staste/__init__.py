@@ -1,9 +1,16 @@
-
 from django.conf import settings
 
-from redis import Redis
+from staste.backends import load_backend
+
+backend = load_backend()
 
-redis = Redis(**getattr(settings, 'STASTE_REDIS_CONNECTION', {}))
+# it's been called like that before there were other backends
+redis = backend
 
 if not getattr(settings, 'STASTE_METRICS_PREFIX', None):
     settings.STASTE_METRICS_PREFIX = 'staste'
+
+from staste.query import batch_query
+
+# switches itself on with settings.STASTE_INSTRUMENTATION
+from staste import instrumentation
@@ -1,4 +1,7 @@
-from staste import redis
+import bisect
+
+from staste import backend
+from staste import scripts
 
 class Axis(object):
     def __init__(self, choices):
@@ -37,4 +40,148 @@ class StoredChoiceAxis(Axis):
         return ['__all__', str(value)]
 
     def get_choices(self, key):
-        return redis.smembers(key)
+        return backend.smembers(key)
+
+
+
+def _boundary_label(boundary):
+    """'1048576' for 1048576.0, '0.1' for 0.1: labels must tell all boundaries apart"""
+    if float(boundary).is_integer():
+        return '%d' % boundary
+    return repr(float(boundary))
+
+
+class RangeAxis(Axis):
+    """An Axis for numbers, like ages or payload sizes. Values are counted in fixed ranges
+
+    boundaries [18, 25, 65] make ranges '<18', '18-25', '25-65' and '65+'.
+    A value goes to the range it's not less than the start of, and is less than the end of.
+    Choices are known without Redis, and are iterated in numeric order"""
+
+    def __init__(self, boundaries):
+        self.boundaries = sorted(boundaries)
+
+        if not self.boundaries:
+            raise ValueError('A range axis needs at least one boundary')
+
+        labels = [_boundary_label(boundary) for boundary in self.boundaries]
+        choices = ['<%s' % labels[0]]
+        choices.extend('%s-%s' % (start, end) for start, end in zip(labels, labels[1:]))
+        choices.append('%s+' % labels[-1])
+
+        super(RangeAxis, self).__init__(choices)
+
+    def get_range(self, value):
+        """Returns a label of the range of a number"""
+        return self.choices[bisect.bisect_right(self.boundaries, value)]
+
+    def get_field_id_parts(self, value):
+        if value is None:
+            return ['__all__']
+
+        return ['__all__', self.get_range(value)]
+
+    def get_field_main_id(self, value):
+        """Filters by a range label, or by the range of a number"""
+        if value is None or value == '':
+            return '__all__'
+
+        if value in self.choices:
+            return value
+
+        return self.get_range(value)
+
+
+class LogRangeAxis(RangeAxis):
+    """A RangeAxis with log-spaced boundaries: start, start*factor, start*factor^2... up to end"""
+
+    def __init__(self, start, end, factor=2):
+        from staste.metrica import log_boundaries
+
+        super(LogRangeAxis, self).__init__(log_boundaries(start, end, factor))
+
+
+class HierarchicalAxis(Axis):
+    """An Axis for dotted (or slashed) paths, like 'app.views.index' or '/blog/2011/'
+
+    Every ancestor of a value is counted too ('app', 'app.views', 'app.views.index'),
+    and children of every value are stored in a set of their own. So iterating on
+    a filtered axis drills down one level with a single HMGET:
+
+        metrica.filter(view='app').iterate('view') => [('app.views', 10), ('app.admin', 2)]
+
+    Without a filter, it iterates on the top level values"""
+
+    hierarchical = True
+
+    def __init__(self, separator='.'):
+        self.separator = separator
+
+    def get_ancestors(self, value):
+        """Returns a list of a value and all its ancestors, from the top level one"""
+        parts = str(value).split(self.separator)
+
+        ancestors = [self.separator.join(parts[:i]) for i in xrange(1, len(parts) + 1)]
+        # a leading separator makes an empty root
+        return [ancestor for ancestor in ancestors if ancestor]
+
+    def get_field_id_parts(self, value):
+        if value is None:
+            return ['__all__']
+
+        return ['__all__'] + self.get_ancestors(value)
+
+    def get_choice_sets(self, value):
+        """Returns a list of (set key postfix, member) pairs: the top level set, and the children set of every ancestor"""
+        if value is None:
+            return []
+
+        ancestors = self.get_ancestors(value)
+        parents = [''] + [':%s' % ancestor for ancestor in ancestors[:-1]]
+
+        return zip(parents, ancestors)
+
+    def get_choices(self, key):
+        return backend.smembers(key)
+
+    def get_children(self, key, parent):
+        return backend.smembers('%s:%s' % (key, parent))
+
+
+class TopKAxis(Axis):
+    """An Axis for values you can't count all of, like URLs or user agents
+
+    Every time bucket keeps a sorted set of at most `capacity` values (the space-saving
+    algorithm: a new value replaces the rarest one), so memory stays bounded. Iterating
+    returns the k heaviest hitters, and everything else is folded into '__other__'.
+    Once more than `capacity` distinct values were seen, counts are guaranteed lower
+    bounds, so the more capacity, the more precise they are.
+
+    You can iterate on such an axis, but can't filter by it"""
+
+    track_top = True
+
+    def __init__(self, k=20, capacity=None):
+        self.k = k
+        self.capacity = capacity or k * 4
+
+        if self.capacity < k:
+            raise ValueError('Capacity of a top-k axis must be at least k')
+
+    def get_field_id_parts(self, value):
+        # values are not stored in hash fields at all
+        return ['__all__']
+
+    def get_field_main_id(self, value):
+        if value:
+            raise ValueError("Can't filter by a top-k axis, iterate on it instead")
+
+        return '__all__'
+
+    def get_choices(self, key):
+        raise ValueError("A top-k axis has no stored choices, iterate on it instead")
+
+    def track(self, pipe, zset_key, value, increment, expiration):
+        """Counts a value in a sorted set of a time bucket"""
+        scripts.SPACE_SAVING.queue(pipe, [zset_key],
+                                   [value, increment, self.capacity, expiration or 0])
@@ -0,0 +1,524 @@
+"""Storage backends
+
+Staste talks to its storage with a handful of Redis commands, so a backend looks like
+a (small) Redis client: hincrby, hget, smembers, pipelines and so on. Values come back
+as strings, like they do from Redis.
+
+RedisBackend is the real thing. MemoryBackend keeps everything in native dicts and sets
+in the current process: it's useful for tests, benchmarks, or batch jobs which
+don't need to share their counters with anyone."""
+import time
+import fnmatch
+import threading
+
+from django.conf import settings
+
+
+class BaseBackend(object):
+    """An interface of a storage backend. All methods mimic Redis commands"""
+
+    def pipeline(self, transaction=False):
+        """Returns an object which has the same command methods, and an .execute() which returns a list of their results"""
+        raise NotImplementedError
+
+    def hget(self, key, field):
+        raise NotImplementedError
+
+    def hmget(self, key, fields):
+        raise NotImplementedError
+
+    def hgetall(self, key):
+        raise NotImplementedError
+
+    def hkeys(self, key):
+        raise NotImplementedError
+
+    def hincrby(self, key, field, value=1):
+        raise NotImplementedError
+
+    def hlen(self, key):
+        raise NotImplementedError
+
+    def hdel(self, key, *fields):
+        raise NotImplementedError
+
+    def hscan_iter(self, key, match=None, count=None):
+        """Iterates on (field, value) pairs of a hash, a chunk at a time"""
+        raise NotImplementedError
+
+    def smembers(self, key):
+        raise NotImplementedError
+
+    def scard(self, key):
+        raise NotImplementedError
+
+    def srem(self, key, *members):
+        raise NotImplementedError
+
+    def sadd(self, key, member):
+        raise NotImplementedError
+
+    def pfadd(self, key, *values):
+        raise NotImplementedError
+
+    def pfcount(self, *keys):
+        raise NotImplementedError
+
+    def pfmerge(self, destkey, *keys):
+        raise NotImplementedError
+
+    def zincrby(self, key, member, amount=1):
+        raise NotImplementedError
+
+    def zscore(self, key, member):
+        raise NotImplementedError
+
+    def zcard(self, key):
+        raise NotImplementedError
+
+    def zrange(self, key, start, end, withscores=False):
+        raise NotImplementedError
+
+    def zrevrange(self, key, start, end, withscores=False):
+        raise NotImplementedError
+
+    def zrem(self, key, *members):
+        raise NotImplementedError
+
+    def expire(self, key, seconds):
+        raise NotImplementedError
+
+    def ttl(self, key):
+        raise NotImplementedError
+
+    def keys(self, pattern='*'):
+        raise NotImplementedError
+
+    def scan_iter(self, match=None, count=None):
+        """Iterates on keys, a chunk at a time. Unlike KEYS, it doesn't block the server"""
+        raise NotImplementedError
+
+    def object(self, infotype, key):
+        """OBJECT subcommands, like object('encoding', key)"""
+        raise NotImplementedError
+
+    def memory_usage(self, key):
+        """Bytes taken by a key and its value. Redis 4.0+, it's None on older ones"""
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def unlink(self, *keys):
+        """Deletes keys, and frees their memory in background. Redis 4.0+"""
+        raise NotImplementedError
+
+    def evalsha(self, sha, numkeys, *args):
+        raise NotImplementedError
+
+    def script_load(self, script):
+        raise NotImplementedError
+
+    def info(self):
+        raise NotImplementedError
+
+
+class RedisBackend(BaseBackend):
+    """Stores everything in Redis. Configured with settings.STASTE_REDIS_CONNECTION,
+    or settings.STASTE_REDIS_SHARDS (see staste.sharding)"""
+
+    def __init__(self, client=None):
+        """client - a staste.client.StasteRedis or a ShardedRedis, connected to from settings by default"""
+        self.client = client or self._connect()
+
+    def _connect(self):
+        from staste.client import StasteRedis
+
+        shards = getattr(settings, 'STASTE_REDIS_SHARDS', None)
+
+        if not shards:
+            return StasteRedis(**getattr(settings, 'STASTE_REDIS_CONNECTION', {}))
+
+        from staste.sharding import ShardedRedis, SlotRouter
+
+        router_class = SlotRouter
+        router_path = getattr(settings, 'STASTE_REDIS_ROUTER', None)
+        if router_path:
+            router_class = import_by_path(router_path)
+
+        return ShardedRedis([StasteRedis(**shard) for shard in shards],
+                            router_class=router_class)
+
+    def pipeline(self, transaction=False):
+        return self.client.pipeline(transaction=transaction)
+
+    def hget(self, key, field):
+        return self.client.hget(key, field)
+
+    def hmget(self, key, fields):
+        return self.client.hmget(key, fields)
+
+    def hgetall(self, key):
+        return self.client.hgetall(key)
+
+    def hkeys(self, key):
+        return self.client.hkeys(key)
+
+    def hincrby(self, key, field, value=1):
+        return self.client.hincrby(key, field, value)
+
+    def hlen(self, key):
+        return self.client.hlen(key)
+
+    def hdel(self, key, *fields):
+        return self.client.hdel(key, *fields)
+
+    def hscan_iter(self, key, match=None, count=None):
+        return self.client.hscan_iter(key, match=match, count=count)
+
+    def smembers(self, key):
+        return self.client.smembers(key)
+
+    def scard(self, key):
+        return self.client.scard(key)
+
+    def srem(self, key, *members):
+        return self.client.srem(key, *members)
+
+    def sadd(self, key, member):
+        return self.client.sadd(key, member)
+
+    def pfadd(self, key, *values):
+        return self.client.pfadd(key, *values)
+
+    def pfcount(self, *keys):
+        return self.client.pfcount(*keys)
+
+    def pfmerge(self, destkey, *keys):
+        return self.client.pfmerge(destkey, *keys)
+
+    def zincrby(self, key, member, amount=1):
+        return self.client.zincrby(key, member, amount)
+
+    def zscore(self, key, member):
+        return self.client.zscore(key, member)
+
+    def zcard(self, key):
+        return self.client.zcard(key)
+
+    def zrange(self, key, start, end, withscores=False):
+        return self.client.zrange(key, start, end, withscores=withscores)
+
+    def zrevrange(self, key, start, end, withscores=False):
+        return self.client.zrevrange(key, start, end, withscores=withscores)
+
+    def zrem(self, key, *members):
+        return self.client.zrem(key, *members)
+
+    def expire(self, key, seconds):
+        return self.client.expire(key, seconds)
+
+    def ttl(self, key):
+        return self.client.ttl(key)
+
+    def keys(self, pattern='*'):
+        return self.client.keys(pattern)
+
+    def scan_iter(self, match=None, count=None):
+        return self.client.scan_iter(match=match, count=count)
+
+    def object(self, infotype, key):
+        return self.client.object(infotype, key)
+
+    def memory_usage(self, key):
+        return self.client.memory_usage(key)
+
+    def delete(self, *keys):
+        return self.client.delete(*keys)
+
+    def unlink(self, *keys):
+        return self.client.unlink(*keys)
+
+    def evalsha(self, sha, numkeys, *args):
+        return self.client.evalsha(sha, numkeys, *args)
+
+    def script_load(self, script):
+        return self.client.script_load(script)
+
+    def info(self):
+        return self.client.info()
+
+
+class MemoryBackend(BaseBackend):
+    """Keeps everything in the memory of the current process. Thread-safe
+
+    Scripts are run with their Python implementations (see staste.scripts.Script)"""
+
+    def __init__(self):
+        self._data = {}
+        self._expirations = {} # key => unix time
+        self._lock = threading.RLock()
+
+    def pipeline(self, transaction=False):
+        return MemoryPipeline(self)
+
+    def _get(self, key, default=None):
+        expiration = self._expirations.get(key)
+        if expiration is not None and expiration <= time.time():
+            self._delete(key)
+
+        return self._data.get(key, default)
+
+    def _get_or_create(self, key, type_):
+        value = self._get(key)
+        if value is None:
+            value = self._data[key] = type_()
+        return value
+
+    def _delete(self, key):
+        self._expirations.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def hget(self, key, field):
+        with self._lock:
+            value = self._get(key, {}).get(field)
+            return None if value is None else str(value)
+
+    def hmget(self, key, fields):
+        with self._lock:
+            hash_ = self._get(key, {})
+            return [None if hash_.get(field) is None else str(hash_[field])
+                    for field in fields]
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict((field, str(value))
+                        for field, value in self._get(key, {}).iteritems())
+
+    def hkeys(self, key):
+        with self._lock:
+            return self._get(key, {}).keys()
+
+    def hincrby(self, key, field, value=1):
+        with self._lock:
+            hash_ = self._get_or_create(key, dict)
+            hash_[field] = hash_.get(field, 0) + int(value)
+            return hash_[field]
+
+    def hlen(self, key):
+        with self._lock:
+            return len(self._get(key, {}))
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            hash_ = self._get(key, {})
+            return len([hash_.pop(field) for field in fields if field in hash_])
+
+    def hscan_iter(self, key, match=None, count=None):
+        # a snapshot, so the hash can be changed while iterating
+        for field, value in self.hgetall(key).items():
+            if match is None or fnmatch.fnmatchcase(field, match):
+                yield field, value
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._get(key, ()))
+
+    def scard(self, key):
+        with self._lock:
+            return len(self._get(key, ()))
+
+    def srem(self, key, *members):
+        with self._lock:
+            set_ = self._get(key, set())
+            removed = [str(member) for member in members if str(member) in set_]
+            set_.difference_update(removed)
+            return len(removed)
+
+    def sadd(self, key, member):
+        with self._lock:
+            set_ = self._get_or_create(key, set)
+            member = str(member)
+
+            if member in set_:
+                return 0
+            set_.add(member)
+            return 1
+
+    # HyperLogLogs are plain sets here, so counts are exact
+
+    def pfadd(self, key, *values):
+        with self._lock:
+            set_ = self._get_or_create(key, set)
+            size = len(set_)
+            set_.update(str(value) for value in values)
+            return int(len(set_) != size)
+
+    def pfcount(self, *keys):
+        with self._lock:
+            union = set()
+            for key in keys:
+                union.update(self._get(key, ()))
+            return len(union)
+
+    def pfmerge(self, destkey, *keys):
+        with self._lock:
+            union = self._get_or_create(destkey, set)
+            for key in keys:
+                union.update(self._get(key, ()))
+            return True
+
+    # Sorted sets are dicts of member => score
+
+    def zincrby(self, key, member, amount=1):
+        with self._lock:
+            zset = self._get_or_create(key, dict)
+            member = str(member)
+            zset[member] = zset.get(member, 0.0) + float(amount)
+            return zset[member]
+
+    def zscore(self, key, member):
+        with self._lock:
+            return self._get(key, {}).get(str(member))
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._get(key, {}))
+
+    def zrange(self, key, start, end, withscores=False, _reverse=False):
+        with self._lock:
+            items = sorted(self._get(key, {}).iteritems(),
+                           key=lambda item: (item[1], item[0]),
+                           reverse=_reverse)
+
+        # Redis ranges are inclusive, and -1 is the last element
+        items = items[start:None if end == -1 else end + 1]
+
+        if withscores:
+            return items
+        return [member for member, score in items]
+
+    def zrevrange(self, key, start, end, withscores=False):
+        return self.zrange(key, start, end, withscores, _reverse=True)
+
+    def zrem(self, key, *members):
+        with self._lock:
+            zset = self._get(key, {})
+            return len([zset.pop(str(member)) for member in members
+                        if str(member) in zset])
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if self._get(key) is None:
+                return False
+            self._expirations[key] = time.time() + seconds
+            return True
+
+    def ttl(self, key):
+        with self._lock:
+            if self._get(key) is None or key not in self._expirations:
+                return None
+            return int(self._expirations[key] - time.time())
+
+    def keys(self, pattern='*'):
+        with self._lock:
+            return [key for key in list(self._data)
+                    if fnmatch.fnmatchcase(key, pattern) and self._get(key) is not None]
+
+    def scan_iter(self, match=None, count=None):
+        for key in self.keys(match or '*'):
+            yield key
+
+    # there are no Redis encodings and allocations here, so these are rough estimates:
+    # small collections are 'listpack', like in Redis 7 with default settings
+
+    def object(self, infotype, key):
+        if infotype != 'encoding':
+            raise ValueError('Unsupported OBJECT subcommand: %s' % infotype)
+
+        with self._lock:
+            value = self._get(key)
+
+        if value is None:
+            return None
+        if isinstance(value, (dict, set)):
+            return 'listpack' if len(value) <= 128 else 'hashtable'
+        return 'raw'
+
+    def memory_usage(self, key):
+        with self._lock:
+            value = self._get(key)
+
+            if value is None:
+                return None
+
+            size = 64 + len(key)
+            if isinstance(value, dict):
+                size += sum(16 + len(str(field)) + len(str(v)) for field, v in value.iteritems())
+            else:
+                size += sum(16 + len(str(member)) for member in value)
+            return size
+
+    def delete(self, *keys):
+        with self._lock:
+            return len(filter(None, [self._delete(key) for key in keys]))
+
+    unlink = delete
+
+    def evalsha(self, sha, numkeys, *args):
+        from staste.scripts import get_script
+
+        keys, args = list(args[:numkeys]), list(args[numkeys:])
+
+        with self._lock:
+            return get_script(sha).run_in_python(self, keys, args)
+
+    def script_load(self, script):
+        from staste.scripts import Script
+
+        return Script(script).sha
+
+    def info(self):
+        return {'used_memory': 0,
+                'used_memory_human': '%s keys' % len(self._data)}
+
+
+class MemoryPipeline(object):
+    """Queues commands for a MemoryBackend and runs them all at once on .execute()"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self, raise_on_error=True):
+        # commands raise right away here, like they would in Redis before anything's sent
+        with self.backend._lock:
+            results = [method(*args, **kwargs)
+                       for method, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+def import_by_path(path):
+    """Imports an object by its dotted path, like 'staste.backends.MemoryBackend'"""
+    from django.utils.importlib import import_module
+
+    module_name, name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), name)
+
+
+def load_backend():
+    """Creates a backend of settings.STASTE_BACKEND class, a RedisBackend by default"""
+    path = getattr(settings, 'STASTE_BACKEND', 'staste.backends.RedisBackend')
+    return import_by_path(path)()
@@ -0,0 +1,223 @@
+"""Micro-benchmarks of kicks and queries
+
+Runs against the configured backend: set STASTE_BACKEND = 'staste.backends.MemoryBackend'
+to measure staste itself, without Redis. Every benchmark is run for a grid of parameters
+and reports ops/sec, p50/p99 latency, and Redis commands and bytes (as sent over the wire) per operation.
+
+Metricas are named 'staste_benchmark_...', and their keys are deleted afterwards.
+
+    results = run_benchmarks(ops=1000)
+    save_results(results, 'before.json')
+
+Usually it's run with `manage.py staste_benchmark`."""
+import json
+import time
+import datetime
+import platform
+
+from staste import backend
+from staste.axis import Axis, StoredChoiceAxis
+from staste.metrica import Metrica
+from staste.dateaxis import DATE_AXIS
+from staste.bucket_cache import BUCKET_CACHE
+from staste.instrumentation import BackendHook, resp_size
+from staste.utils import batches
+
+
+class CommandCounter(BackendHook):
+    """Counts commands (and their bytes) sent to the backend"""
+
+    def __init__(self):
+        super(CommandCounter, self).__init__()
+        self.commands = 0
+        self.bytes = 0
+
+    def record(self, commands, seconds, pipeline):
+        self.commands += len(commands)
+        self.bytes += sum(resp_size([name] + list(args)) for name, args in commands)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+def measure(name, params, ops, operation):
+    """Calls operation(i) `ops` times. Returns a result dict"""
+    counter = CommandCounter()
+    counter.install(backend)
+
+    latencies = []
+    try:
+        started = time.time()
+        for i in xrange(ops):
+            op_started = time.time()
+            operation(i)
+            latencies.append(time.time() - op_started)
+        elapsed = time.time() - started
+    finally:
+        counter.uninstall()
+
+    latencies.sort()
+
+    return {'benchmark': name,
+            'params': params,
+            'ops': ops,
+            'ops_per_sec': ops / elapsed if elapsed else None,
+            'commands_per_op': counter.commands / float(ops),
+            'bytes_per_op': counter.bytes / float(ops),
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000}
+
+
+def _metrica(name, axes):
+    return Metrica(name='staste_benchmark_%s' % name, axes=axes)
+
+
+def _axes(n, choices=4):
+    return [('axis%s' % i, Axis(choices=range(1, choices + 1))) for i in xrange(n)]
+
+
+def bench_kick(ops, axes_counts=(0, 1, 2, 3, 4)):
+    for n in axes_counts:
+        metrica = _metrica('kick_%s' % n, _axes(n))
+
+        def kick(i):
+            metrica.kick(**dict(('axis%s' % a, (i + a) % 4 + 1) for a in xrange(n)))
+
+        yield measure('kick', {'axes': n}, ops, kick)
+
+
+def bench_total(ops, axes_counts=(0, 2, 4)):
+    for n in axes_counts:
+        metrica = _metrica('total_%s' % n, _axes(n))
+        metrica.kick(**dict(('axis%s' % a, 1) for a in xrange(n)))
+
+        values = metrica.filter(**dict(('axis%s' % a, 1) for a in xrange(n)))
+        yield measure('total', {'axes': n}, ops, lambda i: values.total())
+
+
+def _stored_choices_metrica(name, choices):
+    metrica = _metrica('%s_%s' % (name, choices), [('choice', StoredChoiceAxis())])
+    for choice in xrange(choices):
+        metrica.kick(choice=choice)
+    return metrica
+
+
+def bench_iterate(ops, choices_counts=(10, 100, 1000)):
+    for choices in choices_counts:
+        values = _stored_choices_metrica('iterate', choices).values()
+        yield measure('iterate', {'choices': choices}, ops, lambda i: values.iterate('choice'))
+
+
+TIMESERIE_GRID = [('minute', datetime.timedelta(hours=1)),
+                  ('minute', datetime.timedelta(days=1)),
+                  ('hour', datetime.timedelta(days=14))]
+
+def bench_timeserie(ops, grid=TIMESERIE_GRID):
+    metrica = _metrica('timeserie', [])
+    metrica.kick()
+    values = metrica.values()
+
+    for scale, span in grid:
+        params = {'scale': scale, 'seconds': span.days * 86400 + span.seconds}
+
+        def timeserie(i):
+            now = datetime.datetime.now()
+            values.timeserie(now - span, now, scale)
+
+        def date_axis_timeserie(i):
+            now = datetime.datetime.now()
+            list(DATE_AXIS.timeserie(now - span, now, scale))
+
+        yield measure('timeserie', params, ops, timeserie)
+        yield measure('dateaxis_timeserie', params, ops, date_axis_timeserie)
+
+
+def bench_chart(ops, choices_counts=(10, 100)):
+    from django.test.client import RequestFactory
+    from staste.charts.views import TimeserieChart
+
+    factory = RequestFactory()
+
+    for choices in choices_counts:
+        metrica = _stored_choices_metrica('chart', choices)
+
+        def chart(i):
+            view = TimeserieChart(metrica=metrica)
+            view.request = factory.get('/', {'timescale': 'minute', 'minute__ago': 30})
+            view.get_context_data()
+
+        yield measure('timeserie_chart', {'choices': choices}, ops, chart)
+
+
+BENCHMARKS = [('kick', bench_kick),
+              ('total', bench_total),
+              ('iterate', bench_iterate),
+              ('timeserie', bench_timeserie),
+              ('chart', bench_chart)]
+
+
+def run_benchmarks(names=None, ops=1000, cache=False):
+    """Runs benchmarks (all by default). Returns a dict with a list of results
+
+    cache - whether to turn the closed buckets cache on. It's off by default, to measure reads"""
+    old_cache_size = BUCKET_CACHE.size
+    BUCKET_CACHE.resize((old_cache_size or 100000) if cache else 0)
+
+    results = []
+    try:
+        for name, bench in BENCHMARKS:
+            if names and name not in names:
+                continue
+
+            results.extend(bench(ops))
+    finally:
+        BUCKET_CACHE.resize(old_cache_size)
+        cleanup()
+
+    return {'backend': backend.__class__.__name__,
+            'python': platform.python_version(),
+            'started': datetime.datetime.now().isoformat(),
+            'results': results}
+
+
+def cleanup(batch_size=500):
+    """Deletes keys of benchmark metricas. They are found with SCAN, so Redis isn't blocked"""
+    from django.conf import settings
+
+    # names could be {hash tags}
+    keys = backend.scan_iter(match='%s:*staste_benchmark_*' % settings.STASTE_METRICS_PREFIX,
+                             count=batch_size)
+
+    for batch in batches(keys, batch_size):
+        backend.unlink(*batch)
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(old, new):
+    """Returns a list of (benchmark, params, old ops/sec, new ops/sec, ratio) for benchmarks run both times"""
+    old_results = dict((json.dumps([r['benchmark'], r['params']], sort_keys=True), r)
+                       for r in old['results'])
+
+    comparison = []
+    for result in new['results']:
+        old_result = old_results.get(json.dumps([result['benchmark'], result['params']], sort_keys=True))
+        if not old_result or not old_result['ops_per_sec'] or not result['ops_per_sec']:
+            continue
+
+        comparison.append((result['benchmark'], result['params'],
+                           old_result['ops_per_sec'], result['ops_per_sec'],
+                           result['ops_per_sec'] / old_result['ops_per_sec']))
+
+    return comparison
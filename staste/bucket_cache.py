@@ -0,0 +1,99 @@
+"""A read-through cache of closed time buckets
+
+A time bucket which is over (last hour, yesterday, last month) never changes again,
+unless the past is kicked, so there's no point in reading it from Redis twice. Values of closed buckets
+are kept in an LRU cache in the process memory, and, optionally, in a Django cache. It's off by default.
+
+Settings:
+    STASTE_BUCKET_CACHE_SIZE - how many hash fields to keep in memory, like 100000. 0 (the default) disables the cache
+    STASTE_BUCKET_CACHE_DJANGO - an alias of a Django cache to use too, like 'default'. None by default
+    STASTE_BUCKET_CACHE_GRACE - how many seconds after its end a bucket is considered closed. 60 by default,
+                                a bit more than a buffer flush interval (see staste.buffer)
+
+Keep in mind that if you kick the past (backfilling, or kick(date=...) of late events), cached values
+will be stale, in every process: don't turn the cache on then, or call BUCKET_CACHE.clear() afterwards
+(and clear the Django cache, if you use one). Metrica.kick_many() forgets values of its metrica itself,
+in its own process."""
+import hashlib
+
+from django.conf import settings
+
+from staste.lru import LRUCache
+
+
+_missing = object()
+
+
+class BucketCache(object):
+    def __init__(self, size=0, django_cache=None, grace=60):
+        self.size = size
+        self.grace = grace
+        self._memory = LRUCache(size)
+
+        if django_cache:
+            from django.core.cache import get_cache
+            self._django = get_cache(django_cache)
+        else:
+            self._django = None
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def resize(self, size):
+        """Sets how many hash fields to keep in memory. 0 disables the cache"""
+        self.size = self._memory.size = size
+
+        if not size:
+            self._memory.clear()
+
+    def _django_key(self, hash_key, hash_field_id):
+        # hash fields can contain anything, memcached keys can't
+        return 'staste:bucket:%s' % hashlib.md5('%s\0%s' % (hash_key, hash_field_id)).hexdigest()
+
+    def get_many(self, hash_key, hash_field_ids):
+        """Returns a dict of cached values of hash fields. Missing fields are cached as None"""
+        found = {}
+        for hash_field_id in hash_field_ids:
+            value = self._memory.get((hash_key, hash_field_id), _missing)
+            if value is not _missing:
+                found[hash_field_id] = value
+
+        if self._django is not None and len(found) < len(hash_field_ids):
+            missing = dict((self._django_key(hash_key, hash_field_id), hash_field_id)
+                           for hash_field_id in hash_field_ids
+                           if hash_field_id not in found)
+
+            for django_key, value in self._django.get_many(missing.keys()).iteritems():
+                hash_field_id = missing[django_key]
+                # Django caches can't tell None from a miss
+                found[hash_field_id] = value or None
+                self._memory.set((hash_key, hash_field_id), value or None)
+
+        return found
+
+    def set_many(self, hash_key, values):
+        """values - a dict of hash field values"""
+        for hash_field_id, value in values.iteritems():
+            self._memory.set((hash_key, hash_field_id), value)
+
+        if self._django is not None:
+            self._django.set_many(dict((self._django_key(hash_key, hash_field_id), value or '')
+                                       for hash_field_id, value in values.iteritems()))
+
+    def clear(self):
+        """Clears the in-memory cache. A Django cache is not touched"""
+        self._memory.clear()
+
+    def forget(self, key_prefix):
+        """Clears in-memory values of hash keys starting with a prefix, like Metrica.key_prefix(). A Django cache is not touched"""
+        key_prefix += ':'
+
+        for key in self._memory.keys():
+            if key[0].startswith(key_prefix):
+                self._memory.delete(key)
+
+
+BUCKET_CACHE = BucketCache(size=getattr(settings, 'STASTE_BUCKET_CACHE_SIZE', 0),
+                           django_cache=getattr(settings, 'STASTE_BUCKET_CACHE_DJANGO', None),
+                           grace=getattr(settings, 'STASTE_BUCKET_CACHE_GRACE', 60))
@@ -0,0 +1,181 @@
+"""Buffered kicks: accumulate increments in process memory, send them to Redis in batches
+
+Most kicks of a hot metrica bump the very same counters within a second, so there's
+no point in sending every single HINCRBY to Redis. A KickBuffer sums them up locally
+and a background thread flushes the combined increments every `flush_interval` seconds
+(or sooner, when `max_events` kicks or `max_fields` distinct counters are pending).
+
+Keep in mind that buffered kicks are not visible in statistics until they are flushed."""
+import os
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+
+from staste import backend
+from staste import scripts
+
+
+logger = logging.getLogger('staste')
+
+
+class KickBuffer(object):
+    """A thread-safe in-process buffer of Redis counter increments"""
+
+    def __init__(self, flush_interval=1.0, max_events=1000, max_fields=10000, background=True):
+        """flush_interval - how often (in seconds) the background thread sends everything to Redis
+        max_events - flush right away when this many kicks are pending
+        max_fields - flush right away when this many distinct hash fields are pending. keeps the memory bounded
+        background - whether to flush in a background thread (and on exit). if not, it's flushed only when it's full, or by .flush()"""
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.max_fields = max_fields
+        self.background = background
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        self._reset()
+
+        if background:
+            atexit.register(self.stop)
+
+    def _reset(self):
+        self._increments = {} # (hash_key, hash_field_id) => value
+        self._expirations = {} # hash_key => seconds
+        self._set_members = set() # (set_key, member)
+        self._script_calls = [] # (sha, numkeys, args...), can't be summed up
+        self._events = 0
+
+    def pipeline(self):
+        """Returns a pipeline-like object for a single kick. Metrica.kick() uses it instead of a Redis pipeline"""
+        return BufferedPipeline(self)
+
+    def add(self, increments, expirations, set_members, script_calls=()):
+        """Merges a kick into the buffer. Flushes it if it got too big"""
+        with self._lock:
+            self._ensure_thread()
+
+            for key, value in increments:
+                self._increments[key] = self._increments.get(key, 0) + value
+
+            self._expirations.update(expirations)
+            self._set_members.update(set_members)
+            self._script_calls.extend(script_calls)
+            self._events += 1
+
+            overflow = (self._events >= self.max_events or
+                        len(self._increments) >= self.max_fields)
+
+        if overflow:
+            self.flush()
+
+    def flush(self):
+        """Sends all pending increments to Redis in one pipeline"""
+        with self._lock:
+            if not self._events:
+                return
+
+            increments = self._increments
+            expirations = self._expirations
+            set_members = self._set_members
+            script_calls = self._script_calls
+            self._reset()
+
+        pipe = backend.pipeline(transaction=False)
+
+        for (hash_key, hash_field_id), value in increments.iteritems():
+            pipe.hincrby(hash_key, hash_field_id, value)
+
+        for hash_key, expiration in expirations.iteritems():
+            pipe.expire(hash_key, expiration)
+
+        for set_key, member in set_members:
+            pipe.sadd(set_key, member)
+
+        for call in script_calls:
+            scripts.queue_evalsha(pipe, *call)
+
+        scripts.execute(pipe)
+
+    def stop(self):
+        """Stops the background thread and flushes everything left. Called on interpreter shutdown"""
+        self._stopped.set()
+        self.flush()
+
+    def _ensure_thread(self):
+        if not self.background:
+            return
+
+        # the buffer could be inherited by a forked worker process:
+        # its pending kicks belong to the parent, and the thread is not running here
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        if self._pid is not None:
+            self._reset()
+
+        self._pid = pid
+        self._thread = threading.Thread(target=self._run,
+                                        name='staste-kick-buffer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.flush_interval)
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not flush staste kick buffer')
+
+
+class BufferedPipeline(object):
+    """Collects commands of one kick and hands them over to a KickBuffer on .execute()
+
+    Supports only commands Metrica.kick() uses"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.increments = []
+        self.expirations = {}
+        self.set_members = []
+        self.script_calls = []
+
+    def hincrby(self, hash_key, hash_field_id, value):
+        self.increments.append(((hash_key, hash_field_id), value))
+
+    def expire(self, hash_key, expiration):
+        self.expirations[hash_key] = expiration
+
+    def sadd(self, set_key, member):
+        self.set_members.append((set_key, member))
+
+    def evalsha(self, sha, numkeys, *args):
+        self.script_calls.append((sha, numkeys) + args)
+
+    def __len__(self):
+        return len(self.increments) + len(self.expirations) + len(self.set_members) + len(self.script_calls)
+
+    def execute(self, raise_on_error=True):
+        self.buffer.add(self.increments, self.expirations, self.set_members,
+                        self.script_calls)
+
+
+_default_buffer = None
+
+def get_default_buffer():
+    """Returns a KickBuffer shared by all metricas created with buffer=True
+
+    It's configured with settings.STASTE_KICK_BUFFER, a dict of KickBuffer keyword arguments"""
+    global _default_buffer
+
+    if _default_buffer is None:
+        _default_buffer = KickBuffer(**getattr(settings, 'STASTE_KICK_BUFFER', {}))
+
+    return _default_buffer
@@ -1,19 +1,45 @@
+import json
 import datetime
 
-from django.views.generic import TemplateView
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.generic import TemplateView, View
 
+from staste import batch_query
+from staste import instrumentation
+from staste import export
+from staste.explain import explain
 from staste.dateaxis import DATE_SCALES_AND_EXPIRATIONS
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5. A plain response streams an iterator too, unless a middleware reads its content
+    StreamingHttpResponse = HttpResponse
 
 
-TIMESCALES = ['day', 'hour', 'minute']
+
+# 'second' is there only for metricas storing seconds, others show minutes instead
+TIMESCALES = ['day', 'hour', 'minute', 'second']
 
 DEFAULT_TIMESCALE = 'hour'
 
 
 class Chart(TemplateView):
+    """A chart of a metrica. Add ?explain=1 to get a JSON report of Redis commands it runs instead"""
     metrica = None
 
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('explain'):
+            return self.explain(**kwargs)
+
+        return super(Chart, self).get(request, *args, **kwargs)
+
+    def explain(self, **kwargs):
+        report = explain(self.get_context_data, **kwargs)
+        del report['result']
+
+        return HttpResponse(json.dumps(report), content_type='application/json')
+
     def timespan(self, vs):
         for scale, _ in DATE_SCALES_AND_EXPIRATIONS:
             try:
@@ -83,7 +109,7 @@ class TimeserieChart(Chart):
     Accepts GET-parameters:
         'show_axis'                        - specifies the metric's axis to present (e.g. '?show_axis=gender'.);
                                              default = current metric's first axis;
-        a set of '{timescale}__ago' params - where {timescale} in ['year', 'month', 'day', 'hour', 'minute'] - 
+        a set of '{timescale}__ago' params - where {timescale} in ['day', 'hour', 'minute', 'second'] - 
                                              defines a period of time 'ago' for which the results would be aggregated
                                             (e.g. '?day__ago=2' would provide you with data regarding the past two years);
                                             default is 5 minutes;
@@ -155,13 +181,19 @@ class TimeserieChart(Chart):
                             'scale': self.timescale,  
                            }
        
-        values = {}
-        if not self.request.GET.get('hide_total', False):
-            values.update({'total': self.get_metrica_values().timeserie(**timeserie_params)})
-        for item in self.metrica.choices(axis_displayed):
-            values.update({item: self.get_metrica_values()\
-                                    .filter(**{axis_displayed: item})\
-                                    .timeserie(**timeserie_params)})
+        vs = self.get_metrica_values()
+
+        with batch_query() as batch:
+            by_choice = batch.timeserie_by(vs, axis_displayed, **timeserie_params)
+            
+            if not self.request.GET.get('hide_total', False):
+                total = batch.timeserie(vs, **timeserie_params)
+            else:
+                total = None
+
+        values = dict(by_choice.value)
+        if total:
+            values.update({'total': total.value})
         return values
 
 
@@ -171,13 +203,14 @@ class LatestCountAndAverageChart(Chart):
     title = 'Counts and Averages'
 
     scales = [#'year', 'month', 'day',
-        'hour', 'minute']
+        'hour', 'minute', 'second']
 
     scale_deltas = {'year': datetime.timedelta(days=365*5),
                     'month': datetime.timedelta(days=730),
                     'day': datetime.timedelta(days=31),
                     'hour': datetime.timedelta(days=2),
-                    'minute': datetime.timedelta(minutes=30)}
+                    'minute': datetime.timedelta(minutes=30),
+                    'second': datetime.timedelta(minutes=5)}
 
     def get_context_data(self):
 
@@ -212,3 +245,32 @@ class LatestCountAndAverageChart(Chart):
                 'views': views,
                 'current_view': view
                 }
+
+
+class TrafficView(View):
+    """Redis traffic stats of all metricas (or of ?metrica=name) as JSON. See staste.instrumentation"""
+
+    def get(self, request):
+        if 'metrica' in request.GET:
+            stats = instrumentation.get_stats(request.GET['metrica'])
+        else:
+            stats = instrumentation.get_stats()
+
+        return HttpResponse(json.dumps({'enabled': instrumentation.INSTRUMENTATION.installed,
+                                        'stats': stats}),
+                            content_type='application/json')
+
+
+class ExportView(View):
+    """Streams all data of a metrica as JSON Lines, or as CSV with ?format=csv. See staste.export"""
+    metrica = None
+
+    def get(self, request):
+        format = request.GET.get('format', 'jsonl')
+        if format not in export.FORMATS:
+            return HttpResponseBadRequest('Unknown format: %s' % format)
+
+        response = StreamingHttpResponse(export.export_lines(self.metrica, format),
+                                         content_type=export.FORMATS[format][1])
+        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (self.metrica.name, format)
+        return response
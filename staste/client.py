@@ -0,0 +1,48 @@
+"""A Redis client with commands redis-py 2.10 doesn't have quite right
+
+Its PFCOUNT takes a single key, while staste counts unions of HyperLogLogs, and there are
+no UNLINK and MEMORY USAGE at all. Such commands are sent with execute_command, so they work the same
+from clients and their pipelines."""
+from redis import Redis
+from redis.client import BasePipeline
+from redis.exceptions import ResponseError
+
+
+class CommandsMixin(object):
+    def pfcount(self, *keys):
+        """Distinct count of a union of HyperLogLogs"""
+        return self.execute_command('PFCOUNT', *keys)
+
+    def unlink(self, *keys):
+        """Deletes keys, and frees their memory in background. Redis 4.0+"""
+        return self.execute_command('UNLINK', *keys)
+
+    def memory_usage(self, key):
+        """Bytes taken by a key and its value. Redis 4.0+"""
+        return self.execute_command('MEMORY', 'USAGE', key)
+
+
+class StasteRedis(CommandsMixin, Redis):
+    """A Redis client staste connects with. Nodes of ShardedRedis should be ones of these too"""
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return StastePipeline(self.connection_pool, self.response_callbacks,
+                              transaction, shard_hint)
+
+    def unlink(self, *keys):
+        try:
+            return super(StasteRedis, self).unlink(*keys)
+        except ResponseError:
+            # Redis < 4.0 doesn't know UNLINK
+            return self.delete(*keys)
+
+    def memory_usage(self, key):
+        try:
+            return super(StasteRedis, self).memory_usage(key)
+        except ResponseError:
+            # Redis < 4.0: nothing to measure
+            return None
+
+
+class StastePipeline(BasePipeline, CommandsMixin, Redis):
+    pass
@@ -8,7 +8,7 @@ from dateutil import rrule
 
 from collections import namedtuple
 
-from staste import redis
+from staste import backend
 
 
 def days_to_seconds(days):
@@ -16,6 +16,11 @@ def days_to_seconds(days):
     return days * 24 * 60 * 60
 
 
+def _seconds(delta):
+    """timedelta.total_seconds(), which is not there in 2.6"""
+    return delta.days * 24 * 60 * 60 + delta.seconds + delta.microseconds / 1e6
+
+
 # Please keep in mind that years are special-cased (I got to think about it)
 # cause their range is not hard specified, but stored in Redis instead.
 
@@ -27,6 +32,17 @@ DATE_SCALES_AND_EXPIRATIONS = [('year', 0),
 
 DATE_SCALES_DICT = dict(DATE_SCALES_AND_EXPIRATIONS)
 
+# Scales which are stored only if a DateAxis asks for them.
+# Seconds are fields of one hash per minute, '<field id>#<second>', not keys of their own,
+# and can't be a timespan: they are only for timeseries
+OPTIONAL_DATE_SCALES_AND_EXPIRATIONS = [('second', 10 * 60)]
+
+ALL_DATE_SCALES = [scale for scale, expiration
+                   in DATE_SCALES_AND_EXPIRATIONS + OPTIONAL_DATE_SCALES_AND_EXPIRATIONS]
+
+# scale => its position, from the coarsest one
+DATE_SCALES_INDEX = dict((scale, i) for i, scale in enumerate(ALL_DATE_SCALES))
+
 DATE_SCALES_RANGES = {'month': lambda **t: (1, 12),
                       'day': lambda year, month, **t: (1, calendar.monthrange(year, month)[1]),
                       'hour': lambda **t: (0, 23),
@@ -38,7 +54,8 @@ DATE_SCALES_RRULE_KWARGS = {'year': {'freq': rrule.YEARLY,
                                      'bymonthday': 1},
                            'day': {'freq': rrule.DAILY},
                            'hour': {'freq': rrule.HOURLY},
-                           'minute': {'freq': rrule.MINUTELY}}
+                           'minute': {'freq': rrule.MINUTELY},
+                           'second': {'freq': rrule.SECONDLY}}
 
 
 # can be average
@@ -46,7 +63,8 @@ DATE_SCALES_DELTAS = {'year': datetime.timedelta(days=365),
                       'month': datetime.timedelta(days=30),
                       'day': datetime.timedelta(days=1),
                       'hour': datetime.timedelta(hours=1),
-                      'minute': datetime.timedelta(minutes=1)}
+                      'minute': datetime.timedelta(minutes=1),
+                      'second': datetime.timedelta(seconds=1)}
 
 DATE_SCALES_SCALE = {'year': lambda dt: datetime.datetime(dt.year, 1, 1),
                      'month': lambda dt: datetime.datetime(dt.year,
@@ -62,29 +80,79 @@ DATE_SCALES_SCALE = {'year': lambda dt: datetime.datetime(dt.year, 1, 1),
                                                           month=dt.month,
                                                           day=dt.day,
                                                           hour=dt.hour,
-                                                          minute=dt.minute)}
+                                                          minute=dt.minute),
+                     'second': lambda dt: dt.replace(microsecond=0)}
+
+def _next_month(dt):
+    if dt.month == 12:
+        return dt.replace(year=dt.year + 1, month=1)
+    return dt.replace(month=dt.month + 1)
+
+# start of a time bucket => start of the next one
+DATE_SCALES_NEXT = {'year': lambda dt: dt.replace(year=dt.year + 1),
+                    'month': _next_month,
+                    'day': lambda dt: dt + datetime.timedelta(days=1),
+                    'hour': lambda dt: dt + datetime.timedelta(hours=1),
+                    'minute': lambda dt: dt + datetime.timedelta(minutes=1),
+                    'second': lambda dt: dt + datetime.timedelta(seconds=1)}
+
 
 # This is a tuple which is used by Metric.kick()
 # to understand that it should be doing with a scale
-DateScale = namedtuple('DateScale', ['id', 'expiration', 'value', 'store'])
+# field_postfix is appended to hash field ids, it's not empty only for seconds
+DateScale = namedtuple('DateScale', ['id', 'expiration', 'value', 'store', 'field_postfix'])
 
 
 class DateAxis(object):
     """This is a special-cased axis of DateTime"""
+
+    def __init__(self, scales=None):
+        """scales - a list of (scale, expiration in seconds) pairs to store, like [('day', days_to_seconds(30)), ('hour', days_to_seconds(2))].
+        0 means buckets never expire. All scales of DATE_SCALES_AND_EXPIRATIONS by default.
+        'second' can be stored too, with a short expiration please
+
+        Buckets of a scale are identified by all coarser scales, stored or not"""
+        if scales is None:
+            scales = DATE_SCALES_AND_EXPIRATIONS
+
+        for scale, expiration in scales:
+            if scale not in DATE_SCALES_INDEX:
+                raise ValueError('Invalid date scale: %s' % scale)
+
+            if expiration is None or expiration < 0:
+                raise ValueError('Invalid expiration of %s: %s' % (scale, expiration))
+
+        self.scales_and_expirations = sorted(scales, key=lambda pair: DATE_SCALES_INDEX[pair[0]])
+        self.scales_dict = dict(self.scales_and_expirations)
+
+    def is_stored(self, scale):
+        return scale in self.scales_dict
     
     def scales(self, date):
         """Yields DateScale objects for all scales on which the event should be stored"""
-        yield DateScale('__all__', 0, '', False)
+        yield DateScale('__all__', 0, '', False, '')
 
         id_parts = []
         for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
             value = getattr(date, scale)
             
             id_parts += [scale, str(value)]
+
+            if not self.is_stored(scale):
+                continue
+            
             yield DateScale(':'.join(id_parts),
-                            scale_expiration,
+                            self.scales_dict[scale],
                             value,
-                            'years' if scale == 'year' else False)
+                            'years' if scale == 'year' else False,
+                            '')
+
+        if self.is_stored('second'):
+            yield DateScale(':'.join(id_parts + ['second']),
+                            self.scales_dict['second'],
+                            date.second,
+                            False,
+                            '#%s' % date.second)
             
 
     def timespan_to_id(self, **timespan):
@@ -97,9 +165,43 @@ class DateAxis(object):
         
         id_parts = self._timespan_to_id_parts(**timespan)
 
+        if not self.is_stored(id_parts[-2]):
+            raise ValueError('%s buckets are not stored' % id_parts[-2])
+
         return ':'.join(id_parts)
     
 
+    def bucket_end(self, tp_id):
+        """Returns a datetime when a time bucket (a string part of the hash key) is over
+
+        Returns None for '__all__', it's never over"""
+        if tp_id == '__all__':
+            return None
+
+        id_parts = tp_id.split(':')
+        if id_parts[-1] == 'second':
+            # a hash of seconds is over with its minute
+            id_parts.pop()
+            
+        timespan = dict(zip(id_parts[::2], [int(v) for v in id_parts[1::2]]))
+        
+        start = datetime.datetime(timespan['year'],
+                                  timespan.get('month', 1),
+                                  timespan.get('day', 1),
+                                  timespan.get('hour', 0),
+                                  timespan.get('minute', 0),
+                                  timespan.get('second', 0))
+
+        return DATE_SCALES_NEXT[id_parts[-2]](start)
+
+    def is_closed(self, tp_id, grace=0):
+        """Whether a time bucket is over (for `grace` seconds already), so its values never change again"""
+        end = self.bucket_end(tp_id)
+        if end is None:
+            return False
+
+        return end + datetime.timedelta(seconds=grace) <= datetime.datetime.now()
+
     def iterate(self, mv):
         """Iterates on all date values for scale of MetricaValues. Yields a number and an id (string part of the hash key)
 
@@ -115,6 +217,9 @@ class DateAxis(object):
                              % DATE_SCALES_AND_EXPIRATIONS[-1][0])
         scale = scale_[0]
 
+        if not self.is_stored(scale):
+            raise ValueError('%s buckets are not stored' % scale)
+
         for i in self.get_scale_range(scale, mv):
             yield int(i), ':'.join(id_parts + [scale, str(i)])
             
@@ -125,24 +230,101 @@ class DateAxis(object):
         # okay, it's not very configurable, but I tried
         if scale == 'year':
             set_key = '%s:years' % mv.metrica.key_prefix()
-            return redis.smembers(set_key)
+            return backend.smembers(set_key)
         
         return xrange(*DATE_SCALES_RANGES[scale](**mv._timespan))
 
 
+    def decompose(self, since, until, now=None):
+        """Returns ids of the fewest aligned time buckets covering a range, coarse ones in the middle, fine ones at the edges
+
+        Buckets which are expired already are replaced by finer ones (which are usually expired too).
+        The edges are rounded to the finest stored scale: its buckets are taken if they overlap the range"""
+        now = now or datetime.datetime.now()
+        scales = self.scales_and_expirations
+
+        def is_retained(scale, expiration, end):
+            return not expiration or end > now - datetime.timedelta(seconds=expiration)
+
+        def cover(since, until, i):
+            if since >= until or i >= len(scales):
+                return []
+
+            scale, expiration = scales[i]
+            start = DATE_SCALES_SCALE[scale](since)
+
+            if i == len(scales) - 1:
+                buckets = []
+                while start < until:
+                    end = DATE_SCALES_NEXT[scale](start)
+                    if is_retained(scale, expiration, end):
+                        buckets.append(':'.join(self._datetime_to_id_parts(scale, start)))
+                    start = end
+                return buckets
+
+            if start < since:
+                start = DATE_SCALES_NEXT[scale](start)
+
+            buckets = cover(since, min(start, until), i + 1)
+
+            while DATE_SCALES_NEXT[scale](start) <= until:
+                end = DATE_SCALES_NEXT[scale](start)
+                if is_retained(scale, expiration, end):
+                    buckets.append(':'.join(self._datetime_to_id_parts(scale, start)))
+                else:
+                    buckets.extend(cover(start, end, i + 1))
+                start = end
+
+            return buckets + cover(max(start, since), until, i + 1)
+
+        return cover(since, until, 0)
+
+    def window(self, since, until, now=None):
+        """Returns a list of (time bucket id, weight) pairs covering a short time range, for rates
+
+        The finest stored scale which keeps the whole range is used. A bucket sticking out of the range
+        is weighted by the part of it inside, as if events were uniform in time. The current bucket
+        is not over yet, so it's weighted by its part which is over already"""
+        now = now or datetime.datetime.now()
+
+        for scale, expiration in reversed(self.scales_and_expirations):
+            if not expiration or now - datetime.timedelta(seconds=expiration) <= since:
+                break
+        else:
+            raise ValueError('No stored scale keeps %s' % since)
+
+        buckets = []
+        
+        start = DATE_SCALES_SCALE[scale](since)
+        while start < until:
+            end = DATE_SCALES_NEXT[scale](start)
+            elapsed = min(end, now) - start
+
+            if elapsed > datetime.timedelta(0):
+                inside = min(end, until) - max(start, since)
+                weight = _seconds(inside) / _seconds(elapsed)
+                
+                buckets.append((':'.join(self._datetime_to_id_parts(scale, start)),
+                                min(weight, 1.0)))
+            start = end
+
+        return buckets
+
     def timeserie(self, since, until, max_scale=None):
-        """Returns a list of time points and scales we can have information about"""
+        """Returns a list of time points and scales we can have information about
+
+        max_scale - the finest scale to use. If it's not stored, the nearest coarser one is used"""
 
         now = datetime.datetime.now()
 
+        if max_scale and max_scale not in DATE_SCALES_INDEX:
+            raise ValueError('Invalid date scale: %s' % max_scale)
+
         points = []
         
-        for scale, expiration in reversed(DATE_SCALES_AND_EXPIRATIONS):
-            if max_scale:
-                if scale == max_scale:
-                    max_scale = None
-                else:
-                    continue
+        for scale, expiration in reversed(self.scales_and_expirations):
+            if max_scale and DATE_SCALES_INDEX[scale] > DATE_SCALES_INDEX[max_scale]:
+                continue
                 
             if expiration:
                 scale_since = now - datetime.timedelta(seconds=expiration)
@@ -175,6 +357,17 @@ class DateAxis(object):
         for point in rr:
             yield scale, self.scale_point(scale, point)
 
+    def split_tp_id(self, tp_id):
+        """Returns a string part of the hash key of a time bucket, and a postfix of its hash field ids
+
+        It's (tp_id, '') for everything, but seconds, which are fields of a per-minute hash"""
+        id_parts = tp_id.split(':')
+
+        if len(id_parts) > 1 and id_parts[-2] == 'second':
+            return ':'.join(id_parts[:-1]), '#%s' % id_parts[-1]
+
+        return tp_id, ''
+
     def scale_point(self, scale, point):
         return DATE_SCALES_SCALE[scale](point) + DATE_SCALES_DELTAS[scale]/2
     
@@ -182,7 +375,7 @@ class DateAxis(object):
     def _datetime_to_id_parts(self, max_scale, dt):
         id_parts = []
         
-        for scale, scale_expiration in DATE_SCALES_AND_EXPIRATIONS:
+        for scale in ALL_DATE_SCALES:
             val = getattr(dt, scale)
             id_parts += [scale, str(val)]
 
@@ -217,6 +410,6 @@ class DateAxis(object):
         return id_parts
 
 
-# We need only one such Axis object, and it's completely thread-safe
+# Metricas share this Axis object by default, it's completely thread-safe
 DATE_AXIS = DateAxis()
                 
@@ -0,0 +1,118 @@
+"""What does a query cost? Explains calls by watching commands they send
+
+    >>> metrica.values().explain('iterate', 'gender')
+    {'round_trips': 2, 'pipelines': 1, 'keys': 2, 'hash_fields': 3,
+     'commands': {'smembers': 1, 'hmget': 1}, 'choice_sets': {'staste:visits:__choices__:gender': 3},
+     'redis_ms': 0.8, 'python_ms': 0.3, 'total_ms': 1.1, 'result': [...]}
+
+The call is run as usual, so the result is the same. Keep in mind that closed buckets
+can come from the cache (see staste.bucket_cache), then they cost nothing."""
+import time
+import types
+import threading
+
+from staste import backend
+from staste.instrumentation import BackendHook
+
+
+# commands reading hash fields => how many fields they read
+HASH_FIELDS_READ = {'hget': lambda args: 1,
+                    'hmget': lambda args: len(args[1])}
+
+
+class ExplainHook(BackendHook):
+    """Records commands of threads which are explaining something, every thread into its own lists
+
+    It's installed while any thread is explaining, so concurrent explain() calls don't
+    install and uninstall hooks of each other"""
+
+    def __init__(self):
+        super(ExplainHook, self).__init__()
+        self._recording = threading.local()
+        self._lock = threading.Lock()
+        self._explaining = 0 # how many calls are being explained
+
+    def start(self, backend):
+        """Starts recording commands of the current thread. Returns a list of round trips they are recorded to"""
+        with self._lock:
+            if not self._explaining:
+                self.install(backend)
+            self._explaining += 1
+
+        round_trips = [] # (commands, seconds, pipeline)
+        self._lists().append(round_trips)
+        return round_trips
+
+    def stop(self):
+        """Stops the latest recording of the current thread"""
+        self._lists().pop()
+
+        with self._lock:
+            self._explaining -= 1
+            if not self._explaining:
+                self.uninstall()
+
+    def _lists(self):
+        if not hasattr(self._recording, 'lists'):
+            self._recording.lists = []
+        return self._recording.lists
+
+    def record(self, commands, seconds, pipeline):
+        # explain() calls can be nested
+        for round_trips in getattr(self._recording, 'lists', ()):
+            round_trips.append((commands, seconds, pipeline))
+
+
+EXPLAIN_HOOK = ExplainHook()
+
+
+def summarize(round_trips):
+    """Returns a report of recorded round trips, without the result and times of the call"""
+    commands = {}
+    keys = set()
+    hash_fields = 0
+    choice_sets = set()
+
+    for round_trip_commands, seconds, pipeline in round_trips:
+        for name, args in round_trip_commands:
+            commands[name] = commands.get(name, 0) + 1
+
+            if args:
+                keys.add(args[0])
+            if name in HASH_FIELDS_READ:
+                hash_fields += HASH_FIELDS_READ[name](args)
+            if name == 'smembers':
+                choice_sets.add(args[0])
+
+    return {'commands': commands,
+            'keys': len(keys),
+            'hash_fields': hash_fields,
+            'round_trips': len(round_trips),
+            'pipelines': len([rt for rt in round_trips if rt[2]]),
+            'redis_ms': sum(seconds for c, seconds, p in round_trips) * 1000,
+            'choice_sets': choice_sets}
+
+
+def explain(function, *args, **kwargs):
+    """Calls a function, and reports commands it sent. Returns a report dict, with the result under 'result'"""
+    round_trips = EXPLAIN_HOOK.start(backend)
+
+    started = time.time()
+    try:
+        result = function(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            result = list(result)
+    finally:
+        total = time.time() - started
+        EXPLAIN_HOOK.stop()
+
+    report = summarize(round_trips)
+    report['total_ms'] = total * 1000
+    report['python_ms'] = report['total_ms'] - report['redis_ms']
+    report['result'] = result
+
+    # sizes of the choice sets the call depends on. it's not a part of the call, so it's after it
+    report['choice_sets'] = dict((key, len(backend.smembers(key)))
+                                 for key in report['choice_sets'])
+
+    return report
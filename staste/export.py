@@ -0,0 +1,130 @@
+"""Streaming export of metrica data, for warehouses and such
+
+Every hash field of every time bucket is a row: the bucket ('year:2011:month:3'), its scale,
+a value of every axis ('__all__' for all values), the value, and the count of an averaged metrica.
+Unique metricas give distinct counts of their HyperLogLogs. Histograms and top sets are not exported.
+
+    for line in export_lines(metrica, 'csv'):
+        f.write(line)
+
+Keys are walked with SCAN and hash fields with HSCAN, `count` at a time, so memory stays flat
+however big the metrica is. Rows come in no particular order."""
+import csv
+import json
+from cStringIO import StringIO
+
+from staste import backend
+from staste.memory import parse_key
+from staste.utils import batches
+
+
+def columns(metrica):
+    """Names of columns of rows of a metrica"""
+    names = ['timespan', 'scale'] + [axis_kw for axis_kw, axis in metrica.axes] + ['value']
+
+    if metrica._script_count_postfix:
+        names.append('count')
+    return names
+
+
+def _row(metrica, tp_id, scale, field, value, count=None):
+    row = {'timespan': tp_id, 'scale': scale}
+
+    if '#' in field:
+        # seconds are fields of a per-minute hash
+        field, second = field.split('#', 1)
+        row['timespan'] = '%s:%s' % (tp_id, second)
+
+    row.update(zip([axis_kw for axis_kw, axis in metrica.axes], field.split(':')))
+    row['value'] = int(value or 0) / metrica.multiplier
+
+    if metrica._script_count_postfix:
+        row['count'] = int(count or 0)
+    return row
+
+
+def _hash_rows(metrica, key, tp_id, scale, count):
+    count_postfix = metrica._script_count_postfix
+
+    for items in batches(backend.hscan_iter(key, count=count), count):
+        if count_postfix:
+            counts = backend.hmget(key + count_postfix, [field for field, value in items])
+        else:
+            counts = [None] * len(items)
+
+        for (field, value), field_count in zip(items, counts):
+            yield _row(metrica, tp_id, scale, field, value, field_count)
+
+
+def _unique_rows(metrica, keys, prefix_length):
+    """Rows of HyperLogLogs: '<prefix>:<tp_id>:__unique__:<field>'"""
+    pipe = backend.pipeline(transaction=False)
+    for key, scale in keys:
+        pipe.pfcount(key)
+
+    for (key, scale), value in zip(keys, pipe.execute()):
+        tp_id, field = key[prefix_length:].split(':__unique__:', 1)
+        yield _row(metrica, tp_id, scale, field, value)
+
+
+def rows(metrica, count=1000):
+    """Yields dicts of columns(metrica), for every hash field (or HyperLogLog) of a metrica"""
+    prefix_length = len(metrica.key_prefix()) + 1
+    unique_keys = []
+
+    for key in backend.scan_iter(match='%s:*' % metrica.key_prefix(), count=count):
+        kind, scale, axis = parse_key(metrica, key)
+
+        if kind == 'values':
+            for row in _hash_rows(metrica, key, key[prefix_length:], scale, count):
+                yield row
+
+        elif kind == 'unique':
+            unique_keys.append((key, scale))
+
+            if len(unique_keys) >= count:
+                for row in _unique_rows(metrica, unique_keys, prefix_length):
+                    yield row
+                unique_keys = []
+
+    if unique_keys:
+        for row in _unique_rows(metrica, unique_keys, prefix_length):
+            yield row
+
+
+def jsonl_lines(metrica, rows):
+    for row in rows:
+        yield json.dumps(row, sort_keys=True) + '\n'
+
+
+def csv_lines(metrica, rows):
+    names = columns(metrica)
+    buf = StringIO()
+    writer = csv.DictWriter(buf, names)
+
+    def line(row):
+        writer.writerow(row)
+        value = buf.getvalue()
+
+        buf.seek(0)
+        buf.truncate()
+        return value
+
+    yield line(dict(zip(names, names)))
+    for row in rows:
+        yield line(row)
+
+
+# format => (a function of (metrica, rows) yielding lines, content type)
+FORMATS = {'jsonl': (jsonl_lines, 'application/x-ndjson'),
+           'csv': (csv_lines, 'text/csv')}
+
+
+def export_lines(metrica, format='jsonl', count=1000):
+    """Yields lines of a metrica's data in a format of FORMATS"""
+    if format not in FORMATS:
+        raise ValueError('Unknown export format: %s. Known ones are: %s'
+                         % (format, ', '.join(sorted(FORMATS))))
+
+    lines = FORMATS[format][0]
+    return lines(metrica, rows(metrica, count=count))
@@ -0,0 +1,307 @@
+"""Accounting of staste's own Redis traffic, by metrica
+
+When it's on, every command sent to the backend is counted for the metrica its key belongs to:
+commands, pipelines (and single commands) executed, bytes sent, and a histogram of their latency.
+
+    STASTE_INSTRUMENTATION = True
+
+or call enable() at runtime. Then
+
+    >>> metrica.traffic()
+    {'commands': 1240, 'round_trips': 100, 'bytes': 61230, 'latency_ms': ...}
+    >>> instrumentation.get_stats() # all metricas
+
+Stats are kept in the process memory, so every worker has its own.
+staste.charts.views.TrafficView shows them as JSON."""
+import time
+import threading
+
+from django.conf import settings
+
+from staste import backend
+
+
+_missing = object()
+
+
+class BackendHook(object):
+    """Watches commands sent to a backend object, directly or in pipelines. Subclasses implement record()
+
+    Any number of hooks can be installed on a backend at once, and uninstalled in any order:
+    they are called by the backend's HookDispatcher"""
+
+    def __init__(self):
+        self.backend = None
+
+    def record(self, commands, seconds, pipeline):
+        """Called when commands are executed. commands - a list of (command name, args)"""
+        raise NotImplementedError
+
+    def install(self, backend):
+        """Starts watching commands of the backend object. .uninstall() stops it"""
+        self.backend = backend
+        get_dispatcher(backend).add(self)
+
+    def uninstall(self):
+        get_dispatcher(self.backend).remove(self)
+        self.backend = None
+
+    @property
+    def installed(self):
+        return self.backend is not None
+
+
+class HookDispatcher(object):
+    """Wraps command methods of a backend object while any hooks are installed, and tells all of them about commands
+
+    Commands which a backend runs on its own (like a MemoryBackend running a pipeline or a script)
+    are not watched"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._saved = {}
+
+    def add(self, hook):
+        with self._lock:
+            if not self.hooks:
+                self._wrap_all()
+            self.hooks = self.hooks + [hook]
+
+    def remove(self, hook):
+        with self._lock:
+            hooks = list(self.hooks)
+            hooks.remove(hook)
+            self.hooks = hooks
+
+            if not self.hooks:
+                self._unwrap_all()
+
+    def _wrap_all(self):
+        backend = self.backend
+
+        real_pipeline = backend.pipeline
+        def pipeline(*args, **kwargs):
+            return HookedPipeline(real_pipeline(*args, **kwargs), self)
+        self._wrap('pipeline', pipeline)
+
+        for name in dir(backend):
+            if name.startswith('_') or name in ('pipeline', 'info'):
+                continue
+
+            method = getattr(backend, name)
+            if callable(method):
+                self._wrap(name, self._hooked(name, method))
+
+    def _unwrap_all(self):
+        for name, method in self._saved.iteritems():
+            if method is _missing:
+                delattr(self.backend, name)
+            else:
+                setattr(self.backend, name, method)
+
+        self._saved = {}
+
+    def _wrap(self, name, method):
+        self._saved[name] = self.backend.__dict__.get(name, _missing)
+        setattr(self.backend, name, method)
+
+    def _hooked(self, name, method):
+        def hooked(*args, **kwargs):
+            if self.inside:
+                return method(*args, **kwargs)
+
+            return self.execute([(name, args)], False, method, *args, **kwargs)
+        return hooked
+
+    @property
+    def inside(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    def execute(self, commands, pipeline, method, *args, **kwargs):
+        """Calls a method which executes commands, and tells hooks about them"""
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+        started = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._local.depth -= 1
+            seconds = time.time() - started
+
+            # the list is replaced, not changed, when hooks come and go
+            for hook in self.hooks:
+                hook.record(commands, seconds, pipeline)
+
+
+_dispatchers = {} # id of a backend object => HookDispatcher
+_dispatchers_lock = threading.Lock()
+
+def get_dispatcher(backend):
+    """Returns the HookDispatcher of a backend object"""
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(id(backend))
+        if dispatcher is None:
+            dispatcher = _dispatchers[id(backend)] = HookDispatcher(backend)
+        return dispatcher
+
+
+class HookedPipeline(object):
+    """A pipeline which tells its HookDispatcher about the commands it executes"""
+
+    def __init__(self, pipe, dispatcher):
+        self.pipe = pipe
+        self.dispatcher = dispatcher
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.pipe, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((name, args))
+            method(*args, **kwargs)
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self, **kwargs):
+        commands, self.commands = self.commands, []
+        return self.dispatcher.execute(commands, True, self.pipe.execute, **kwargs)
+
+
+def resp_size(args):
+    """How many bytes a command takes in the Redis protocol"""
+    size = len('*%d\r\n' % len(args))
+    for arg in args:
+        arg = arg if isinstance(arg, basestring) else str(arg)
+        size += len('$%d\r\n%s\r\n' % (len(arg), arg))
+    return size
+
+
+def command_key(name, args):
+    """Returns a key of a command, or None"""
+    if name == 'evalsha':
+        # sha, number of keys, keys...
+        return args[2] if len(args) > 2 and args[1] else None
+
+    return args[0] if args else None
+
+
+# upper boundaries of latency buckets, in milliseconds: 0.1ms to about 1.6s
+LATENCY_BOUNDARIES_MS = [0.1 * 2 ** i for i in xrange(15)]
+
+
+class TrafficStats(object):
+    """Traffic of a metrica"""
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.pipelines = 0
+        self.bytes = 0
+        self.latency = [0] * (len(LATENCY_BOUNDARIES_MS) + 1)
+
+    def add_latency(self, seconds):
+        ms = seconds * 1000
+        for i, boundary in enumerate(LATENCY_BOUNDARIES_MS):
+            if ms < boundary:
+                break
+        else:
+            i = len(LATENCY_BOUNDARIES_MS)
+
+        self.latency[i] += 1
+
+    def latency_percentile(self, q):
+        """An upper boundary of the latency bucket of a percentile, in milliseconds. None if it's over all of them"""
+        total = sum(self.latency)
+        if not total:
+            return None
+
+        seen = 0
+        for boundary, count in zip(LATENCY_BOUNDARIES_MS + [None], self.latency):
+            seen += count
+            if seen >= q * total:
+                return boundary
+
+    def as_dict(self):
+        return {'commands': self.commands,
+                'round_trips': self.round_trips,
+                'pipelines': self.pipelines,
+                'bytes': self.bytes,
+                'latency_ms': {'boundaries': LATENCY_BOUNDARIES_MS,
+                               'counts': list(self.latency)},
+                'p50_ms': self.latency_percentile(0.5),
+                'p99_ms': self.latency_percentile(0.99)}
+
+
+class Instrumentation(BackendHook):
+    """Counts backend traffic by metrica. Metricas are told by key prefixes"""
+
+    def __init__(self):
+        super(Instrumentation, self).__init__()
+        self._lock = threading.Lock()
+        self.stats = {} # metrica name => TrafficStats
+
+    def metrica_name(self, key):
+        prefix = settings.STASTE_METRICS_PREFIX + ':'
+
+        if not isinstance(key, basestring) or not key.startswith(prefix):
+            return None
+
+        # names could be {hash tags}
+        return key[len(prefix):].split(':', 1)[0].strip('{}')
+
+    def record(self, commands, seconds, pipeline):
+        by_metrica = {}
+        for name, args in commands:
+            metrica_name = self.metrica_name(command_key(name, args))
+            by_metrica.setdefault(metrica_name, []).append((name, args))
+
+        with self._lock:
+            for metrica_name, metrica_commands in by_metrica.iteritems():
+                stats = self.stats.get(metrica_name)
+                if stats is None:
+                    stats = self.stats[metrica_name] = TrafficStats()
+
+                stats.commands += len(metrica_commands)
+                stats.bytes += sum(resp_size([name] + list(args)) for name, args in metrica_commands)
+                stats.round_trips += 1
+                if pipeline:
+                    stats.pipelines += 1
+                stats.add_latency(seconds)
+
+    def get_stats(self, metrica_name=_missing):
+        """Returns a dict of stats of a metrica, or a dict of all of them by metrica name.
+        Commands which are not of a metrica (like KEYS) are under None"""
+        with self._lock:
+            if metrica_name is not _missing:
+                stats = self.stats.get(metrica_name) or TrafficStats()
+                return stats.as_dict()
+
+            return dict((name, stats.as_dict()) for name, stats in self.stats.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+
+INSTRUMENTATION = Instrumentation()
+
+def enable():
+    if not INSTRUMENTATION.installed:
+        INSTRUMENTATION.install(backend)
+
+def disable():
+    if INSTRUMENTATION.installed:
+        INSTRUMENTATION.uninstall()
+
+get_stats = INSTRUMENTATION.get_stats
+reset = INSTRUMENTATION.reset
+
+
+if getattr(settings, 'STASTE_INSTRUMENTATION', False):
+    enable()
@@ -0,0 +1,22 @@
+def get_metricas(paths):
+    """Imports metricas by their dotted paths, like 'myapp.metrics.visits_metrica'. Raises CommandError for anything else"""
+    from django.core.management.base import CommandError
+
+    from staste.backends import import_by_path
+    from staste.metrica import Metrica
+
+    if not paths:
+        raise CommandError('Which metricas? Give dotted paths, like myapp.metrics.visits_metrica')
+
+    metricas = []
+    for path in paths:
+        try:
+            metrica = import_by_path(path)
+        except (ImportError, AttributeError, ValueError):
+            raise CommandError("Can't import %s" % path)
+
+        if not isinstance(metrica, Metrica):
+            raise CommandError('%s is not a metrica' % path)
+        metricas.append(metrica)
+
+    return metricas
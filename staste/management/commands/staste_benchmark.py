@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from staste import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks staste kicks and queries against the configured backend. '
+            'Set STASTE_BACKEND = "staste.backends.MemoryBackend" to run without Redis')
+
+    args = '[benchmark ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--ops', type='int', default=1000,
+                    help='How many operations to run for every set of parameters'),
+        make_option('--output', default=None,
+                    help='A file to save JSON results to'),
+        make_option('--compare', default=None,
+                    help='A JSON file of previous results, to print speed ratios against'),
+        make_option('--cache', action='store_true', default=False,
+                    help='Switch the closed buckets cache on'),
+        )
+
+    def handle(self, *names, **options):
+        known = [name for name, bench in benchmark.BENCHMARKS]
+        for name in names:
+            if name not in known:
+                raise CommandError('Unknown benchmark: %s. Known ones are: %s'
+                                   % (name, ', '.join(known)))
+
+        results = benchmark.run_benchmarks(names=names, ops=options['ops'],
+                                           cache=options['cache'])
+
+        self.stdout.write('Backend: %s\n\n' % results['backend'])
+        self.stdout.write('%-20s %-32s %12s %10s %10s %10s %10s\n'
+                          % ('benchmark', 'params', 'ops/sec', 'cmds/op', 'bytes/op', 'p50 ms', 'p99 ms'))
+
+        for r in results['results']:
+            params = ', '.join('%s=%s' % item for item in sorted(r['params'].items()))
+            self.stdout.write('%-20s %-32s %12.1f %10.1f %10.1f %10.3f %10.3f\n'
+                              % (r['benchmark'], params, r['ops_per_sec'] or 0,
+                                 r['commands_per_op'], r['bytes_per_op'], r['p50_ms'], r['p99_ms']))
+
+        if options['output']:
+            benchmark.save_results(results, options['output'])
+            self.stdout.write('\nSaved to %s\n' % options['output'])
+
+        if options['compare']:
+            self.stdout.write('\nCompared to %s (new ops/sec / old ops/sec):\n' % options['compare'])
+
+            old = benchmark.load_results(options['compare'])
+            for name, params, old_rate, new_rate, ratio in benchmark.compare_results(old, results):
+                params = ', '.join('%s=%s' % item for item in sorted(params.items()))
+                self.stdout.write('%-20s %-32s %6.2fx\n' % (name, params, ratio))
+
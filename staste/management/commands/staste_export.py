@@ -0,0 +1,41 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from staste import export
+from staste.management import get_metricas
+
+
+class Command(BaseCommand):
+    help = ('Streams every value of a metrica (every time bucket and combination of axes values) '
+            'as JSON Lines or CSV. Walks the keyspace with SCAN and HSCAN, so memory stays flat')
+
+    args = '<dotted.path.to.metrica>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='jsonl',
+                    help='jsonl or csv'),
+        make_option('--output', default=None,
+                    help='A file to write to. stdout by default'),
+        make_option('--count', type='int', default=1000,
+                    help='How many keys and fields to SCAN and HSCAN at a time'),
+        )
+
+    def handle(self, *paths, **options):
+        if len(paths) != 1:
+            raise CommandError('Give a single metrica to export')
+        metrica = get_metricas(paths)[0]
+
+        try:
+            lines = export.export_lines(metrica, options['format'], count=options['count'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        out = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            for line in lines:
+                out.write(line)
+        finally:
+            if options['output']:
+                out.close()
@@ -0,0 +1,74 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from staste.management import get_metricas
+
+
+def _human(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fT' % size
+
+
+class Command(BaseCommand):
+    help = ('Reports keys, hash fields, encodings and memory of metricas, by date scale and by axis, '
+            'and projects their growth from the current kick rate. Walks the keyspace with SCAN')
+
+    args = '<dotted.path.to.metrica ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', default=1000,
+                    help='How many keys to SCAN and inspect at a time'),
+        make_option('--rate', type='float', default=None,
+                    help='Kicks per second to project growth from. The rate of the last hour by default'),
+        make_option('--json', action='store_true', default=False,
+                    help='Print reports as JSON'),
+        )
+
+    def handle(self, *paths, **options):
+        metricas = get_metricas(paths)
+
+        reports = [metrica.memory_report(count=options['count'], kicks_per_second=options['rate'])
+                   for metrica in metricas]
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2) + '\n')
+            return
+
+        for report in reports:
+            self.write_report(report)
+
+    def write_report(self, report):
+        self.stdout.write('%s: %s keys, %s fields, %s, %s kicks/sec\n'
+                          % (report['metrica'], report['keys'], report['fields'],
+                             _human(report['memory']), report['kicks_per_second']))
+        self.stdout.write('encodings: %s\n'
+                          % ', '.join('%s %s' % item for item in sorted(report['encodings'].items())))
+
+        self.stdout.write('\n%-10s %10s %12s %10s   %s\n'
+                          % ('scale', 'keys', 'fields', 'memory', 'projected'))
+        for scale, stats in sorted(report['scales'].items()):
+            projection = stats.get('projection')
+            if not projection:
+                projected = ''
+            elif 'memory' in projection:
+                projected = '%s buckets, %s' % (projection['buckets'], _human(projection['memory']))
+            else:
+                projected = '%s/year' % _human(projection['memory_per_year'])
+
+            self.stdout.write('%-10s %10s %12s %10s   %s\n'
+                              % (scale, stats['keys'], stats['fields'], _human(stats['memory']), projected))
+
+        self.stdout.write('\n%-20s %10s %10s\n' % ('axis', 'choices', 'memory'))
+        for axis, stats in sorted(report['axes'].items()):
+            self.stdout.write('%-20s %10s %10s\n' % (axis, stats['choices'], _human(stats['memory'])))
+
+        self.stdout.write('\nup to %s fields per bucket\n' % report['max_fields_per_bucket'])
+        if report['persistent']['keys']:
+            self.stdout.write('%s keys of expiring scales never expire, %s\n'
+                              % (report['persistent']['keys'], _human(report['persistent']['memory'])))
+        self.stdout.write('\n')
@@ -0,0 +1,48 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from staste.management import get_metricas
+
+
+class Command(BaseCommand):
+    help = ("Forgets values of stored choice axes which weren't kicked for --days, or deletes everything "
+            "of metricas with --purge. Runs with SCAN, HSCAN and UNLINK in batches, so Redis isn't blocked")
+
+    args = '<dotted.path.to.metrica ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=None,
+                    help='Values with no events for this many days are stale'),
+        make_option('--axis', action='append', dest='axes', default=None,
+                    help='An axis to prune, all stored choice axes by default. Can be repeated'),
+        make_option('--purge', action='store_true', default=False,
+                    help='Delete all keys of the metricas'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='How many keys, fields or members to delete at a time'),
+        make_option('--pause', type='float', default=0.01,
+                    help='Seconds to sleep between batches'),
+        )
+
+    def handle(self, *paths, **options):
+        if options['purge'] == (options['days'] is not None):
+            raise CommandError('Give either --days to prune stale values, or --purge to delete everything')
+
+        for metrica in get_metricas(paths):
+            if options['purge']:
+                deleted = metrica.purge(batch_size=options['batch_size'], pause=options['pause'])
+                self.stdout.write('%s: %s keys deleted\n' % (metrica.name, deleted))
+                continue
+
+            since = datetime.datetime.now() - datetime.timedelta(days=options['days'])
+            try:
+                result = metrica.prune(since, axes=options['axes'],
+                                       batch_size=options['batch_size'], pause=options['pause'])
+            except (ValueError, KeyError) as e:
+                raise CommandError('%s: %s' % (metrica.name, e))
+
+            for axis_kw, choices in sorted(result['choices'].items()):
+                self.stdout.write('%s: %s stale values of %s\n' % (metrica.name, len(choices), axis_kw))
+            self.stdout.write('%s: %s fields and %s top sets deleted\n'
+                              % (metrica.name, result['fields'], result['keys']))
@@ -0,0 +1,266 @@
+"""Where does the memory go? Accounting of a metrica's keys, for capacity planning
+
+    >>> memory_report(metrica)
+    {'keys': 1204, 'fields': 80312, 'memory': 7340032, 'encodings': {'listpack': 1180, 'hashtable': 24},
+     'scales': {'minute': {...}, 'hour': {...}, ...},
+     'axes': {'browser': {'choices': 12, 'memory': 840}, ...},
+     'kicks_per_second': 3.2, ...}
+
+The keyspace is walked with SCAN, so Redis isn't blocked, and keys are inspected in pipelines of
+`count`: HLEN (or SCARD, ZCARD), OBJECT ENCODING, MEMORY USAGE (Redis 4.0+) and TTL.
+
+Keys of expiring scales which have no TTL never go away (counts and histograms of buckets
+didn't get one before). They are reported as 'persistent': purge them, they aren't projected.
+
+Every date scale gets a projection: how many of its buckets live at once (their expiration over
+their length), how many fields they fill at the current kick rate, and how much memory it takes.
+Fields of a bucket are bounded by combinations of axes choices, so the more choices, the more
+memory every bucket of a busy metrica takes: check `max_fields_per_bucket` before adding an axis."""
+from staste import backend
+from staste.dateaxis import DATE_SCALES_INDEX, DATE_SCALES_DELTAS, _seconds
+
+
+# what's after the time bucket id in a key => a kind of the key
+KEY_KINDS = {'': 'values',
+             '__len__': 'counts',
+             '__hist__': 'histograms',
+             '__top__': 'top',
+             '__unique__': 'unique'}
+
+# a kind of keys => a command counting their fields. HyperLogLogs are strings, they have none
+COUNT_COMMANDS = {'choices': 'scard',
+                  'values': 'hlen',
+                  'counts': 'hlen',
+                  'histograms': 'hlen',
+                  'top': 'zcard'}
+
+# bytes per hash field when there's nothing to measure yet
+DEFAULT_FIELD_SIZE = 64
+
+
+def parse_key(metrica, key):
+    """Returns (kind, date scale, axis keyword) of a key of a metrica. A scale is '__all__' for totals of all time
+
+    Kinds are 'choices' (a set of stored choices of an axis), 'values', 'counts', 'histograms',
+    'top' and 'unique' (see KEY_KINDS), or None for a key which is not of staste"""
+    rest = key[len(metrica.key_prefix()) + 1:]
+    parts = rest.split(':')
+
+    if parts[0] == '__choices__':
+        return 'choices', None, parts[1] if len(parts) > 1 else None
+
+    if parts == ['years']:
+        # years of the date axis are stored like choices
+        return 'choices', None, 'years'
+
+    if parts[0] == '__all__':
+        scale = '__all__'
+        i = 1
+    else:
+        # scale:value pairs
+        scale = None
+        i = 0
+        while i + 1 < len(parts) and parts[i] in DATE_SCALES_INDEX and parts[i + 1].isdigit():
+            scale = parts[i]
+            i += 2
+
+    if scale is None:
+        return None, None, None
+
+    if parts[i:i + 1] == ['second']:
+        # a per-minute hash of seconds
+        scale = 'second'
+        i += 1
+
+    kind = KEY_KINDS.get(parts[i] if i < len(parts) else '')
+    axis = parts[i + 1] if kind == 'top' and i + 1 < len(parts) else None
+
+    return kind, scale, axis
+
+
+def _new_stats():
+    return {'keys': 0, 'fields': 0, 'memory': 0, 'encodings': {}}
+
+
+def _add(stats, fields, encoding, memory):
+    stats['keys'] += 1
+    stats['fields'] += fields or 0
+    stats['memory'] += memory or 0
+    if encoding:
+        stats['encodings'][encoding] = stats['encodings'].get(encoding, 0) + 1
+
+
+def _inspect(keys):
+    """Returns a list of (key, kind, scale, axis, fields, encoding, memory, ttl) for (key, kind, scale, axis) tuples, in one pipeline"""
+    pipe = backend.pipeline(transaction=False)
+    for key, kind, scale, axis in keys:
+        if kind in COUNT_COMMANDS:
+            getattr(pipe, COUNT_COMMANDS[kind])(key)
+        pipe.object('encoding', key)
+        pipe.memory_usage(key)
+        pipe.ttl(key)
+    results = iter(pipe.execute(raise_on_error=False))
+
+    def result():
+        value = next(results)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    inspected = []
+    for key, kind, scale, axis in keys:
+        fields = result() if kind in COUNT_COMMANDS else 0
+        encoding = result()
+
+        memory = next(results)
+        if isinstance(memory, Exception):
+            # Redis < 4.0 has no MEMORY USAGE
+            memory = None
+
+        inspected.append((key, kind, scale, axis, fields, encoding, memory, result()))
+    return inspected
+
+
+def _kicks_per_second(metrica):
+    values = metrica.values()
+    rate = getattr(values, 'count_rate', None) or getattr(values, 'rate', None)
+    if rate is None:
+        return None
+
+    try:
+        return rate(window=3600)
+    except ValueError:
+        # no stored scale keeps the last hour
+        return None
+
+
+def _fields_per_kick(metrica):
+    """Roughly: every axis bumps its value's field and the '__all__' one"""
+    fields = 1
+    for axis_kw, axis in metrica.axes:
+        if not getattr(axis, 'track_top', False):
+            fields *= 2
+    return fields
+
+
+def memory_report(metrica, count=1000, kicks_per_second=None):
+    """Walks keys of a metrica with SCAN, and returns a dict of their counts, fields and memory,
+    in total, by date scale, by kind of keys and by axis. See the module docstring
+
+    count - how many keys to ask SCAN for, and to inspect in one pipeline
+    kicks_per_second - the kick rate to project growth from. it's the metrica's rate for the last hour by default"""
+    report = _new_stats()
+    report.update({'metrica': metrica.name,
+                   'scales': {},
+                   'kinds': {},
+                   'axes': {},
+                   'other': _new_stats(),
+                   'persistent': _new_stats()})
+
+    expiring_scales = set(scale for scale, expiration in metrica.date_axis.scales_and_expirations
+                          if expiration)
+
+    def inspect(keys):
+        for key, kind, scale, axis, fields, encoding, memory, ttl in _inspect(keys):
+            _add(report, fields, encoding, memory)
+
+            if scale in expiring_scales and (ttl is None or ttl < 0):
+                _add(report['persistent'], fields, encoding, memory)
+
+            if kind is None:
+                _add(report['other'], fields, encoding, memory)
+                continue
+
+            if kind == 'choices':
+                axis_stats = report['axes'].setdefault(axis, {'choices': 0, 'keys': 0, 'memory': 0})
+                axis_stats['choices'] += fields or 0
+                axis_stats['keys'] += 1
+                axis_stats['memory'] += memory or 0
+            else:
+                _add(report['scales'].setdefault(scale, _new_stats()), fields, encoding, memory)
+
+            _add(report['kinds'].setdefault(kind, _new_stats()), fields, encoding, memory)
+
+    keys = []
+    for key in backend.scan_iter(match='%s:*' % metrica.key_prefix(), count=count):
+        keys.append((key,) + parse_key(metrica, key))
+
+        if len(keys) >= count:
+            inspect(keys)
+            keys = []
+    if keys:
+        inspect(keys)
+
+    report['max_fields_per_bucket'] = max_fields_per_bucket(metrica, report['axes'])
+
+    if kicks_per_second is None:
+        kicks_per_second = _kicks_per_second(metrica)
+    report['kicks_per_second'] = kicks_per_second
+
+    project(metrica, report)
+
+    return report
+
+
+def max_fields_per_bucket(metrica, axes_stats):
+    """How many values fields a bucket can have: every combination of axes choices and '__all__'"""
+    fields = 1
+    for axis_kw, axis in metrica.axes:
+        if getattr(axis, 'track_top', False):
+            continue
+
+        if getattr(axis, 'store_choice', False) or getattr(axis, 'hierarchical', False):
+            choices = axes_stats.get(axis_kw, {}).get('choices', 0)
+        else:
+            choices = len(axis.choices)
+
+        fields *= choices + 1
+    return fields
+
+
+def _field_size(stats):
+    if not stats['fields']:
+        return None
+    return stats['memory'] / float(stats['fields'])
+
+
+def project(metrica, report):
+    """Adds a 'projection' to every date scale of a report: buckets living at once, their fields and memory.
+    Scales which never expire get 'buckets_per_year' instead, as they grow forever"""
+    hashes = _new_stats()
+    for kind in ('values', 'counts', 'histograms'):
+        stats = report['kinds'].get(kind)
+        if stats:
+            for name in ('fields', 'memory'):
+                hashes[name] += stats[name]
+    default_field_size = _field_size(hashes) or DEFAULT_FIELD_SIZE
+
+    kicks_per_second = report['kicks_per_second'] or 0
+    fields_per_kick = _fields_per_kick(metrica)
+    # an averaged metrica keeps counts next to values, and so on
+    hashes_per_bucket = len([kind for kind in ('values', 'counts', 'histograms')
+                             if kind in report['kinds']]) or 1
+
+    for scale, expiration in metrica.date_axis.scales_and_expirations:
+        stats = report['scales'].setdefault(scale, _new_stats())
+        bucket_seconds = int(_seconds(DATE_SCALES_DELTAS[scale]))
+
+        fields = min(report['max_fields_per_bucket'],
+                     int(kicks_per_second * bucket_seconds * fields_per_kick))
+        if scale == 'second':
+            # seconds of a minute share a hash
+            fields *= 60
+            bucket_seconds = 60
+        fields *= hashes_per_bucket
+
+        projection = {'fields_per_bucket': fields,
+                      'memory_per_bucket': int(fields * (_field_size(stats) or default_field_size))}
+
+        if expiration:
+            projection['buckets'] = expiration / bucket_seconds + 1
+            projection['memory'] = projection['buckets'] * projection['memory_per_bucket']
+        else:
+            projection['buckets_per_year'] = 365 * 86400 / bucket_seconds
+            projection['memory_per_year'] = projection['buckets_per_year'] * projection['memory_per_bucket']
+
+        stats['projection'] = projection
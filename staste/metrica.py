@@ -1,10 +1,34 @@
+import json
+import time
+import bisect
 import datetime
 import itertools
 
+from collections import namedtuple, OrderedDict
+
 from django.conf import settings
 
-from staste import redis
+from staste import backend
 from staste.dateaxis import DATE_AXIS
+from staste.buffer import KickBuffer, get_default_buffer
+from staste import scripts
+from staste import instrumentation
+from staste.explain import explain
+from staste import memory
+from staste import retention
+from staste.lru import LRUCache
+from staste.query import Query, execute_queries, fetch_many
+from staste.bucket_cache import BUCKET_CACHE
+from staste.utils import batches
+
+
+def _sharded_without_hash_tags():
+    """Whether keys of a metrica can be on different Redis nodes, see staste.sharding"""
+    return bool(getattr(settings, 'STASTE_REDIS_SHARDS', None)) and not getattr(settings, 'STASTE_HASH_TAGS', False)
+
+
+# Everything Metrica.kick() needs to know about a combination of axes values
+KickPlan = namedtuple('KickPlan', ['field_id_parts', 'hash_field_ids', 'choices_sets', 'tracked'])
 
 class Metrica(object):
     """Metrica is some class of events you want to count, like "site visits".
@@ -16,76 +40,296 @@ class Metrica(object):
     Every time the event happens, you call Metrica.kick() function with all the parameters for all axes specified.
     """
 
-    def __init__(self, name, axes, multiplier=None):
+    # if not empty, Metrica.kick() in a script counts events in '<hash key><postfix>' hashes too
+    _script_count_postfix = ''
+
+    # postfixes of keys of hashes kept along with every time bucket hash. they expire with it
+    _companion_postfixes = ()
+
+    # seconds to remember which set members were stored. prune() removes them behind our back,
+    # so they are stored again at least this often. Prune less often than that
+    stored_members_ttl = 60 * 60
+
+    # seconds to remember at most that TTL of a key was refreshed (it's a half of the TTL, if it's shorter).
+    # keys deleted behind our back, or EXPIREs lost with a failed flush of a buffer, get a TTL again at least this often
+    expiring_keys_ttl = 60 * 60
+
+    def __init__(self, name, axes, multiplier=None, buffer=None, use_script=False,
+                 plan_cache_size=1000, cuboids=None, date_axis=None):
         """Constructor of a Metrica
 
         name - should be a unique (among your metrics) string, it will be used in Redis identifiers (lots of them)
         axes - a list/iterable of tuples: (keyword, staste.axes.Axis object). can be empty
-        multiplier - you can multiply all values you provide. it's useful since Redis does not understand floating point increments. (all totals() will be divided back by this)"""
+        multiplier - you can multiply all values you provide. it's useful since Redis does not understand floating point increments. (all totals() will be divided back by this)
+        buffer - a staste.buffer.KickBuffer, or True for the default one. kicks will be aggregated in memory and sent to Redis in batches
+        use_script - kick with a single EVALSHA, and let a Lua script bump all the counters inside Redis. needs Redis 2.6+
+        plan_cache_size - how many combinations of axes values to remember. kicks with known combinations are cheaper, and don't resend EXPIREs and SADDs
+        cuboids - a list of combinations of axes keywords (like [(), ('gender',), ('gender', 'age')]) to be stored. by default, all 2^n combinations are stored. values for other combinations are summed up from the nearest stored one
+        date_axis - a staste.dateaxis.DateAxis with date scales to store, and their expirations. all scales by default"""
         self.name = str(name)
         self.axes = list(axes)
-        self.date_axis = DATE_AXIS
+        self.date_axis = date_axis or DATE_AXIS
         self.multiplier = float(multiplier) if multiplier else 1
         # don't produce float output in the simple case
+
+        if buffer is True:
+            buffer = get_default_buffer()
+        self.buffer = buffer or None
+
+        if self.buffer and use_script:
+            raise ValueError("A metrica can't be both buffered and kicked with a script")
+        self.use_script = use_script
+
+        if use_script and any(getattr(axis, 'track_top', False) for axis_kw, axis in self.axes):
+            raise ValueError("A metrica with top-k axes can't be kicked with a script")
+
+        if use_script and _sharded_without_hash_tags():
+            # a script is routed by its first key, but it bumps all keys of the kick
+            raise ValueError("A sharded metrica can be kicked with a script only with settings.STASTE_HASH_TAGS")
+
+        if cuboids is None:
+            self.cuboids = None
+        else:
+            self.cuboids = set(frozenset(cuboid) for cuboid in cuboids)
+
+            axes_kws = set(axis_kw for axis_kw, axis in self.axes)
+            for cuboid in self.cuboids:
+                if not cuboid <= axes_kws:
+                    raise ValueError('Invalid axes in a cuboid: %s'
+                                     % ', '.join(cuboid - axes_kws))
+
+        self._plans = LRUCache(plan_cache_size)
+        self._expiring_keys = LRUCache(plan_cache_size * 10)
+        self._stored_members = LRUCache(plan_cache_size * 10)
+
+        # how many kicks were planned from scratch, and how many commands were not sent
+        self.kick_stats = {'plan_hits': 0,
+                           'plan_misses': 0,
+                           'expires_saved': 0,
+                           'sadds_saved': 0}
         
 
     def kick(self, value=1, date=None, **kwargs):
         """Registers an event with parameters (for each of axis)"""
+        return self._kick(None, value, date, kwargs)
+
+    def kick_many(self, events, chunk_size=10000):
+        """Registers lots of events, like in a backfill. events - an iterable of kick() kwargs dicts, like {'date': dt, 'gender': 'boy'}
+
+        Events are summed up in memory, `chunk_size` events at a time (or less, if they make too many distinct counters),
+        and every chunk is sent as one pipeline of increments, EXPIREs and SADDs. The iterable is read lazily,
+        so a generator of millions of events takes constant memory. Returns how many events were kicked
+
+        Events are usually in the past, so cached values of closed buckets of the metrica are forgotten"""
+        buffer = KickBuffer(max_events=chunk_size, max_fields=chunk_size * 10, background=False)
+
+        kicked = 0
+        for event in events:
+            event = dict(event)
+            self._kick(buffer.pipeline(), event.pop('value', 1), event.pop('date', None), event)
+            kicked += 1
+
+        buffer.flush()
+        BUCKET_CACHE.forget(self.key_prefix())
+        return kicked
+
+    def _kick(self, pipe, value, date, kwargs):
+        """Kicks to a pipeline, or to the metrica's own one if it's None"""
         date = date or datetime.datetime.now()
         value = int(self.multiplier * value)
         
         hash_key_prefix = self.key_prefix()
 
+        plan = self._kick_plan(self._kick_params(kwargs))
+        choices_sets_to_append = list(plan.choices_sets)
+
+        if self.use_script and pipe is None:
+            return self._kick_with_script(value, date,
+                                          plan.field_id_parts,
+                                          plan.hash_field_ids,
+                                          choices_sets_to_append)
+            
+        # Here we go: bumping all counters out there
+        if pipe is None:
+            pipe = self.pipeline()
+
+        memos = []
+
+        for date_scale in self.date_axis.scales(date):
+            hash_key = '%s:%s' % (hash_key_prefix, date_scale.id)
+            
+            for hash_field_id in plan.hash_field_ids:
+                self._increment(pipe, hash_key, hash_field_id + date_scale.field_postfix, value)
+
+                if date_scale.field_postfix:
+                    # no top sets for every second
+                    continue
+
+                for axis_kw, axis, param_value in plan.tracked:
+                    axis.track(pipe, self.key_for_top(hash_key, axis_kw, hash_field_id),
+                               param_value, value, date_scale.expiration)
+            
+            if date_scale.expiration:
+                if self._should_expire(hash_key, date_scale.expiration, memos):
+                    pipe.expire(hash_key, date_scale.expiration)
+
+                    for postfix in self._companion_postfixes:
+                        pipe.expire(hash_key + postfix, date_scale.expiration)
+
+            if date_scale.store:
+                choices_sets_to_append.append((date_scale.store, date_scale.value))
+
+        for key, s_value in choices_sets_to_append:
+            set_key = '%s:%s' % (hash_key_prefix, key)
+
+            if self._should_store_member(set_key, s_value, memos):
+                pipe.sadd(set_key, s_value)
+
+        scripts.execute(pipe)
+        self._remember(memos)
+
+    def _kick_params(self, kwargs):
+        """Returns a tuple of axes values out of kick() kwargs"""
+        params = tuple(kwargs.pop(axis_kw, None) for axis_kw, axis in self.axes)
+
+        if kwargs:
+            raise TypeError("Invalid kwargs left: %s" % kwargs)
+
+        return params
+
+    def _kick_plan(self, params):
+        """Returns a KickPlan for a tuple of axes values. Plans are cached"""
+        try:
+            # 1 and True are equal, but their field ids are not
+            cache_key = tuple((type(v), v) for v in params)
+            plan = self._plans.get(cache_key)
+        except TypeError: # unhashable
+            cache_key = plan = None
+
+        if plan:
+            self.kick_stats['plan_hits'] += 1
+            return plan
+
+        self.kick_stats['plan_misses'] += 1
+        plan = self._compile_kick_plan(params)
+
+        if cache_key is not None:
+            self._plans.set(cache_key, plan)
+
+        return plan
+
+    def _compile_kick_plan(self, params):
         choices_sets_to_append = []
         hash_field_id_parts = []
+        tracked = []
 
-        for axis_kw, axis in self.axes:
-            param_value = kwargs.pop(axis_kw, None)
-            
+        for (axis_kw, axis), param_value in zip(self.axes, params):
             hash_field_id_parts.append(
                 list(axis.get_field_id_parts(param_value))
                 )
 
+            if getattr(axis, 'track_top', False) and param_value is not None:
+                tracked.append((axis_kw, axis, str(param_value)))
+
+            if hasattr(axis, 'get_choice_sets'):
+                # an axis which stores its choices in several sets, like a HierarchicalAxis
+                for postfix, member in axis.get_choice_sets(param_value):
+                    set_key = '__choices__:%s%s' % (axis_kw, postfix)
+                    choices_sets_to_append.append((set_key, member))
+                continue
+
             try:
                 if axis.store_choice:
                     set_key = '__choices__:%s' % axis_kw
                     choices_sets_to_append.append((set_key, param_value))
             except AttributeError: # 'duck typing'
                 pass
-                
 
-        if kwargs:
-            raise TypeError("Invalid kwargs left: %s" % kwargs)
+        hash_field_ids = [':'.join(parts)
+                          for parts in itertools.product(*hash_field_id_parts)
+                          if self._is_stored(parts)]
 
-        choices_sets_to_append = filter(None, choices_sets_to_append)
-            
-        # Here we go: bumping all counters out there
-        pipe = redis.pipeline(transaction=False)
+        return KickPlan(hash_field_id_parts,
+                        hash_field_ids,
+                        tuple(filter(None, choices_sets_to_append)),
+                        tuple(tracked))
 
-        for date_scale in self.date_axis.scales(date):
-            hash_key = '%s:%s' % (hash_key_prefix, date_scale.id)
-            
-            for parts in itertools.product(*hash_field_id_parts):
-                hash_field_id = ':'.join(parts)
+    def _should_expire(self, hash_key, expiration, memos):
+        """Whether EXPIRE should be sent for a hash key. It's enough to refresh a TTL once in a half of it
 
-                self._increment(pipe, hash_key, hash_field_id, value)
-            
-            if date_scale.expiration:
-                pipe.expire(hash_key, date_scale.expiration)
+        If it should, a memo is appended to `memos`. Remember them with _remember() once the commands are sent"""
+        now = time.time()
+
+        if self._expiring_keys.get(hash_key, 0) > now:
+            self.kick_stats['expires_saved'] += 1
+            return False
+
+        memos.append((self._expiring_keys, hash_key,
+                      now + min(expiration / 2, self.expiring_keys_ttl)))
+        return True
+
+    def _should_store_member(self, set_key, member, memos):
+        """Whether SADD should be sent. Returns False if we have stored the member less than stored_members_ttl ago
+
+        If it should, a memo is appended to `memos`, like in _should_expire()"""
+        now = time.time()
+
+        try:
+            memo_key = (set_key, type(member), member)
+            if self._stored_members.get(memo_key, 0) > now:
+                self.kick_stats['sadds_saved'] += 1
+                return False
+            memos.append((self._stored_members, memo_key, now + self.stored_members_ttl))
+        except TypeError: # unhashable
+            pass
+
+        return True
+
+    def _remember(self, memos):
+        """Remembers EXPIREs and SADDs which were sent (or buffered), so they're not sent again for a while"""
+        for memo, key, until in memos:
+            memo.set(key, until)
+
+    def forget_kicks(self):
+        """Forgets which TTLs and set members were already sent. Call it when keys are deleted behind our back"""
+        self._expiring_keys.clear()
+        self._stored_members.clear()
+
+    def _kick_with_script(self, value, date, hash_field_id_parts, hash_field_ids,
+                          choices_sets_to_append):
+        """Sends the kick to Redis as a single script call. All the combinations are expanded there"""
+        scales = []
+        
+        for date_scale in self.date_axis.scales(date):
+            scales.append((date_scale.id, date_scale.expiration, date_scale.field_postfix))
 
             if date_scale.store:
                 choices_sets_to_append.append((date_scale.store, date_scale.value))
 
-        for key, s_value in choices_sets_to_append:
-            pipe.sadd('%s:%s' % (hash_key_prefix, key),
-                      s_value)
+        sets = [(key, s_value if isinstance(s_value, basestring) else str(s_value))
+                for key, s_value in choices_sets_to_append]
 
-        pipe.execute()
+        kick = {'prefix': self.key_prefix(),
+                'axes': hash_field_id_parts,
+                'scales': scales,
+                'value': str(value),
+                'count_postfix': self._script_count_postfix,
+                'sets': sets}
+
+        if self.cuboids is not None:
+            kick['fields'] = hash_field_ids
 
-    def choices(self, axis_kw):
-        return dict(self.axes)[axis_kw].get_choices(
-            self.key_for_axis_choices(axis_kw)
-            )
+        scripts.KICK(keys=[kick['prefix']], args=[json.dumps(kick)])
+
+    def choices(self, axis_kw, parent=None):
+        """Choices of an axis. For a hierarchical one, top level values, or children of a parent value"""
+        axis = dict(self.axes)[axis_kw]
+        key = self.key_for_axis_choices(axis_kw)
+
+        if parent is not None:
+            return axis.get_children(key, parent)
+        
+        return axis.get_choices(key)
 
     # STATISTICS
 
@@ -110,14 +354,87 @@ class Metrica(object):
         """Total count of events"""
         return self.values().total()
 
+    def rates(self, filters, windows, method='rate'):
+        """Rates for many filters and windows at once, like for an alert sweep. All of them are fetched in one pipeline
+
+        filters - a list of filter dicts, like [{}, {'gender': 'girl'}]
+        windows - a list of windows in seconds, like [60, 300, 900]
+        method - a MetricaValues rate method, like 'count_rate' of an averaged metrica
+
+        Returns a list of lists: rates for every window, for every filter"""
+        now = datetime.datetime.now()
+
+        queries = [self.filter(**fl).query(method, window, _now=now)
+                   for fl in filters
+                   for window in windows]
+        results = execute_queries(queries)
+
+        return [results[i:i + len(windows)]
+                for i in xrange(0, len(results), len(windows))]
+
+    # (MetricaValues object, method name, arguments...) tuples => list of results, fetched at once
+    fetch_many = staticmethod(fetch_many)
+
+    def traffic(self):
+        """Stats of Redis commands sent for the metrica, when staste.instrumentation is on"""
+        return instrumentation.get_stats(self.name)
+
+    def memory_report(self, count=1000, kicks_per_second=None):
+        """Key counts, fields, encodings and memory of the metrica, by date scale and axis, and their projected growth.
+        Walks the keyspace with SCAN, see staste.memory"""
+        return memory.memory_report(self, count=count, kicks_per_second=kicks_per_second)
+
+    def purge(self, batch_size=500, pause=0):
+        """Deletes all data of the metrica with SCAN and UNLINK, `batch_size` keys at a time, sleeping `pause` seconds in between.
+        Returns how many keys were deleted. See staste.retention"""
+        return retention.purge(self, batch_size=batch_size, pause=pause)
+
+    def prune(self, since, axes=None, batch_size=500, pause=0):
+        """Forgets choices of stored choice axes which have no events since a datetime, in choices sets and hashes which never expire.
+        See staste.retention"""
+        return retention.prune(self, since, axes=axes, batch_size=batch_size, pause=pause)
+
     # UTILS
 
     def key_prefix(self):
         metrics_prefix = settings.STASTE_METRICS_PREFIX
+
+        if getattr(settings, 'STASTE_HASH_TAGS', False):
+            # all keys of the metrica go to the same Redis node (or cluster slot)
+            return '%s:{%s}' % (metrics_prefix, self.name)
         
         return '%s:%s' % (metrics_prefix, self.name)
 
     def hash_field_id(self, **kwargs):
+        return ':'.join(self._hash_field_id_parts(kwargs))
+
+    def hash_field_ids(self, _choices=None, **kwargs):
+        """Returns a list of hash field ids. Values of these fields sum up to the value for the filter
+
+        It's just one field, unless the filtered combination of axes is not stored (see `cuboids`).
+        _choices is a dict to cache axes choices in, if you call it many times"""
+        hash_field_id_parts = self._hash_field_id_parts(kwargs)
+        summed_axes = self._summed_axes(hash_field_id_parts)
+
+        if not summed_axes:
+            return [':'.join(hash_field_id_parts)]
+
+        if _choices is None:
+            _choices = {}
+        
+        parts_lists = []
+        for (axis_kw, axis), part in zip(self.axes, hash_field_id_parts):
+            if axis_kw not in summed_axes:
+                parts_lists.append([part])
+                continue
+
+            if axis_kw not in _choices:
+                _choices[axis_kw] = [str(c) for c in self.choices(axis_kw)]
+            parts_lists.append(_choices[axis_kw])
+
+        return [':'.join(parts) for parts in itertools.product(*parts_lists)]
+
+    def _hash_field_id_parts(self, kwargs):
         hash_field_id_parts = []
         
         for axis_kw, axis in self.axes:
@@ -128,7 +445,37 @@ class Metrica(object):
         if kwargs:
             raise TypeError("Invalid kwargs left: %s" % kwargs)
 
-        return ':'.join(hash_field_id_parts)
+        return hash_field_id_parts
+
+    def _filtered_axes(self, parts):
+        return frozenset(axis_kw for (axis_kw, axis), part in zip(self.axes, parts)
+                         if part != '__all__')
+
+    def _is_stored(self, parts):
+        """Whether a combination of hash field id parts is stored"""
+        return self.cuboids is None or self._filtered_axes(parts) in self.cuboids
+
+    def _summed_axes(self, parts):
+        """Returns a set of axes we have to sum up on to get a value for hash field id parts"""
+        if self._is_stored(parts):
+            return frozenset()
+
+        filtered = self._filtered_axes(parts)
+        candidates = [cuboid for cuboid in self.cuboids if filtered <= cuboid]
+        
+        if not candidates:
+            raise ValueError('No stored cuboid contains axes: %s'
+                             % ', '.join(sorted(filtered)))
+
+        nearest = min(candidates, key=lambda cuboid: (len(cuboid), sorted(cuboid)))
+        return nearest - filtered
+
+    def pipeline(self):
+        """Returns a pipeline for kicks: a Redis one, or a buffered one if the metrica is buffered"""
+        if self.buffer:
+            return self.buffer.pipeline()
+
+        return backend.pipeline(transaction=False)
 
     def get_axis(self, axis_kw):
         return dict(self.axes)[axis_kw]
@@ -136,6 +483,10 @@ class Metrica(object):
     def key_for_axis_choices(self, axis_kw):
         return '%s:__choices__:%s' % (self.key_prefix(), axis_kw)
 
+    def key_for_top(self, hash_key, axis_kw, hash_field_id):
+        """A sorted set of top values of an axis, for a hash field of a time bucket (see staste.axis.TopKAxis)"""
+        return '%s:__top__:%s:%s' % (hash_key, axis_kw, hash_field_id)
+
     def _increment(self, pipe, hash_key, hash_field_id, value):
         pipe.hincrby(hash_key, hash_field_id, value)
 
@@ -144,10 +495,25 @@ class Metrica(object):
 
 
 
+def _sum(values):
+    """Sums up raw values of hash fields. Missing fields are zeros"""
+    return sum(int(v or 0) for v in values)
+
+
+def _with_postfix(hash_field_ids, postfix):
+    if not postfix:
+        return hash_field_ids
+
+    return [hash_field_id + postfix for hash_field_id in hash_field_ids]
+
+
 class MetricaValues(object):
     """A representation of a subset of Metrica statistical values
 
     Used for filtering"""
+
+    # whether its methods have queries, so they can be fetched in a batch (see staste.query)
+    batchable = True
     
     def __init__(self, metrica, timespan=None, filter=None):
         """Constructor. You probably don't want to call it directly"""
@@ -156,10 +522,14 @@ class MetricaValues(object):
         self._filter = filter or {}
 
         # we should do it now to raise an error eagerly
-        tp_id = self.metrica.date_axis.timespan_to_id(**self._timespan)
+        self._tp_id = self.metrica.date_axis.timespan_to_id(**self._timespan)
         self._hash_key = '%s:%s' % (self.metrica.key_prefix(),
-                                    tp_id)
-        self._hash_field_id = self.metrica.hash_field_id(**self._filter)
+                                    self._tp_id)
+        # we check if the filter can be answered eagerly too,
+        # but summed up fields are fetched lazily
+        self.metrica._summed_axes(
+            self.metrica._hash_field_id_parts(dict(self._filter)))
+        self._hash_field_ids_cache = None
 
 
     # FILTERING
@@ -174,84 +544,296 @@ class MetricaValues(object):
         fl = dict(self._filter, **kwargs)
         return self.__class__(self.metrica, timespan=self._timespan, filter=fl)
 
+    def _iterated_choices(self, axis):
+        """Choices of an axis to iterate on. A filtered hierarchical axis is drilled down: children of the filtered value"""
+        parent = self._filter.get(axis)
+
+        if parent is not None and getattr(self.metrica.get_axis(axis), 'hierarchical', False):
+            return self.metrica.choices(axis, parent)
+
+        return self.metrica.choices(axis)
+
+    @property
+    def _hash_field_ids(self):
+        if self._hash_field_ids_cache is None:
+            self._hash_field_ids_cache = self.metrica.hash_field_ids(**self._filter)
+        return self._hash_field_ids_cache
+
     # GETTING VALUES
 
+    def query(self, method, *args, **kwargs):
+        """Returns a staste.query.Query of a method, like .query('iterate', 'gender')"""
+        try:
+            build_query = getattr(self, '_%s_query' % method)
+        except AttributeError:
+            raise ValueError("Can't query %s" % method)
+
+        return build_query(*args, **kwargs)
+
+    def explain(self, method, *args, **kwargs):
+        """Calls a method, like .explain('iterate', 'gender'), and reports what it costs:
+        commands, keys and hash fields read, round trips, sizes of choice sets, Redis and Python time.
+        The result is under 'result'. See staste.explain"""
+        return explain(getattr(self, method), *args, **kwargs)
+
+    def _is_closed(self, tp_id):
+        """Whether a time bucket is over, and its values can be cached"""
+        return self.metrica.date_axis.is_closed(tp_id, BUCKET_CACHE.grace)
+
     def total(self):
         """Total events count in the subset"""
-        return int(redis.hget(self._hash_key, self._hash_field_id) or 0) / self.metrica.multiplier
+        return self._total_query().execute()
+
+    def _total_query(self, _hash_key_postfix='', _mult=None):
+        mult = _mult or self.metrica.multiplier
+        hash_key = self._hash_key + _hash_key_postfix
+        closed = [hash_key] if self._is_closed(self._tp_id) else []
+        
+        return Query([(hash_key, self._hash_field_ids)],
+                     lambda values: _sum(values[0]) / mult,
+                     closed)
+
+    def total_between(self, since, until):
+        """Total events count for an arbitrary time range, like the last 36 hours
+
+        The range is covered with the fewest stored buckets (months in the middle, minutes at the edges),
+        so it's rounded to the finest scale. See DateAxis.decompose()"""
+        return self._total_between_query(since, until).execute()
+
+    def _total_between_query(self, since, until, _hash_key_postfix='', _mult=None):
+        mult = _mult or self.metrica.multiplier
+        prefix = self.metrica.key_prefix()
+        date_axis = self.metrica.date_axis
+
+        reads = []
+        closed = []
+        for tp_id in date_axis.decompose(since, until):
+            key_id, field_postfix = date_axis.split_tp_id(tp_id)
+            hash_key = '%s:%s%s' % (prefix, key_id, _hash_key_postfix)
+
+            reads.append((hash_key, _with_postfix(self._hash_field_ids, field_postfix)))
+            if self._is_closed(key_id):
+                closed.append(hash_key)
 
-    def timeserie(self, since, until, scale=None,
-                  _hash_key_postfix='', _mult=None):
+        return Query(reads,
+                     lambda values: sum(_sum(v) for v in values) / mult,
+                     closed)
+
+    def rate(self, window=60):
+        """Events (values) per second for the last `window` seconds, read from the finest buckets there are
+
+        Buckets partly outside the window are weighted, see DateAxis.window()"""
+        return self._rate_query(window).execute()
+
+    def _rate_query(self, window=60, _now=None, _hash_key_postfix='', _mult=None):
         mult = _mult or self.metrica.multiplier
         prefix = self.metrica.key_prefix()
+        date_axis = self.metrica.date_axis
+
+        now = _now or datetime.datetime.now()
+        since = now - datetime.timedelta(seconds=window)
+
+        reads = []
+        weights = []
+        closed = []
+        for tp_id, weight in date_axis.window(since, now, now):
+            key_id, field_postfix = date_axis.split_tp_id(tp_id)
+            hash_key = '%s:%s%s' % (prefix, key_id, _hash_key_postfix)
+
+            reads.append((hash_key, _with_postfix(self._hash_field_ids, field_postfix)))
+            weights.append(weight)
+            if self._is_closed(key_id):
+                closed.append(hash_key)
+
+        def build(values):
+            return sum(_sum(v) * weight for v, weight in zip(values, weights)) / mult / float(window)
+
+        return Query(reads, build, closed)
+
+    def timeserie(self, since, until, scale=None):
+        return self._timeserie_query(since, until, scale).execute()
+
+    def _timeserie_query(self, since, until, scale=None,
+                         _hash_key_postfix='', _mult=None):
+        mult = _mult or self.metrica.multiplier
 
-        ts_points = self.metrica.date_axis.timeserie(since, until, scale)
+        points, buckets, closed = self._timeserie_points(since, until, scale,
+                                                         _hash_key_postfix)
+
+        reads = [(hash_key, _with_postfix(self._hash_field_ids, field_postfix))
+                 for hash_key, field_postfix in buckets]
+
+        return Query(reads,
+                     lambda values: zip(points, [_sum(v) / mult for v in values]),
+                     closed)
+
+    def _timeserie_points(self, since, until, scale, _hash_key_postfix=''):
+        """Returns a list of time points, a list of their (hash key, hash field ids postfix) pairs, and a list of closed hash keys
+
+        Postfixes are not empty only for seconds, see staste.dateaxis"""
+        prefix = self.metrica.key_prefix()
+        date_axis = self.metrica.date_axis
 
         points = []
-        pipe = redis.pipeline(transaction=False)
+        buckets = []
+        closed = []
 
-        for point, tp_id in ts_points:
-            points.append(point)
+        for point, tp_id in date_axis.timeserie(since, until, scale):
+            key_id, field_postfix = date_axis.split_tp_id(tp_id)
+            hash_key = '%s:%s%s' % (prefix, key_id, _hash_key_postfix)
             
-            hash_key = '%s:%s%s' % (prefix, tp_id, _hash_key_postfix)
-            pipe.hget(hash_key, self._hash_field_id)            
+            points.append(point)
+            buckets.append((hash_key, field_postfix))
+            if self._is_closed(key_id):
+                closed.append(hash_key)
+
+        return points, buckets, closed
+
+    def timeserie_by(self, axis, since, until, scale=None):
+        """Timeseries for every choice of an axis. Returns a dict: {choice: [(point, value), ...]}
 
-        values = pipe.execute()
+        Much cheaper than calling .filter(axis=choice).timeserie() for every choice:
+        time points are computed once, and all choices are fetched with one HMGET per point"""
+        return self._timeserie_by_query(axis, since, until, scale).execute()
+
+    def _timeserie_by_query(self, axis, since, until, scale=None,
+                            _hash_key_postfix='', _mult=None):
+        mult = _mult or self.metrica.multiplier
 
-        return zip(points, [int(v or 0) / mult for v in values])
+        points, buckets, closed = self._timeserie_points(since, until, scale,
+                                                         _hash_key_postfix)
+
+        keys = list(self._iterated_choices(axis))
+        choices = {}
+
+        # every choice gets a slice of fields
+        hash_field_ids = []
+        slices = []
+        for key in keys:
+            fl = dict(self._filter, **{axis: key})
+            choice_field_ids = self.metrica.hash_field_ids(_choices=choices, **fl)
+
+            slices.append((len(hash_field_ids),
+                           len(hash_field_ids) + len(choice_field_ids)))
+            hash_field_ids.extend(choice_field_ids)
+
+        reads = [(hash_key, _with_postfix(hash_field_ids, field_postfix))
+                 for hash_key, field_postfix in buckets]
+
+        def build(values):
+            return dict((key, zip(points, [_sum(v[start:end]) / mult for v in values]))
+                        for key, (start, end) in zip(keys, slices))
+
+        return Query(reads, build, closed)
 
     def iterate(self, axis=None):
         """Iterates on a MetricaValues set. Returns a list of (key, value) tuples.
 
         If axis is not specified, iterates on the next scale of a date axis. I.e. mymetric.timespan(year=2011).iterate() will iterate months."""
+        if axis and self._is_top_axis(axis):
+            return self._iterate_top(axis)
+
+        return self._iterate_query(axis).execute()
+
+    def _is_top_axis(self, axis):
+        return getattr(self.metrica.get_axis(axis), 'track_top', False)
+
+    def _iterate_top(self, axis):
+        """Top values of a top-k axis, and the rest of the total as '__other__'"""
+        top_axis = self.metrica.get_axis(axis)
+        mult = self.metrica.multiplier
+
+        pipe = backend.pipeline(transaction=False)
+        pipe.hmget(self._hash_key, self._hash_field_ids)
+        for hash_field_id in self._hash_field_ids:
+            zset_key = self.metrica.key_for_top(self._hash_key, axis, hash_field_id)
+            
+            pipe.zrevrange(zset_key, 0, top_axis.k - 1, withscores=True)
+            pipe.zrange(zset_key, 0, 0, withscores=True)
+            pipe.zcard(zset_key)
+        results = pipe.execute()
+
+        total = _sum(results[0])
+        counts = {}
+        
+        for i in xrange(1, len(results), 3):
+            top, lowest, size = results[i:i + 3]
+
+            # if the set is full, any value could have inherited the lowest count
+            error = int(lowest[0][1]) if size >= top_axis.capacity else 0
+
+            for member, score in top:
+                counts[member] = counts.get(member, 0) + int(score) - error
+
+        top = sorted([(member, count) for member, count in counts.iteritems() if count > 0],
+                     key=lambda item: (-item[1], item[0]))[:top_axis.k]
+        other = max(total - sum(count for member, count in top), 0)
+
+        return ([(member, count / mult) for member, count in top] +
+                [('__other__', other / mult)])
+
+    def _iterate_query(self, axis=None):
         if not axis:
-            return self.iterate_on_dateaxis()
+            return self._iterate_on_dateaxis_query()
 
-        return self._iterate(axis, self._hash_key, self.metrica.multiplier)
+        if self._is_top_axis(axis):
+            raise ValueError("Top-k axes are stored in sorted sets, they can't be queried in a batch")
 
-    def _iterate(self, axis, _hash_key, mult):
-        keys = self.metrica.choices(axis)
+        return self._iterate_on_axis_query(axis, self._hash_key, self.metrica.multiplier)
 
-        pipe = redis.pipeline(transaction=False)
+    def _iterate_on_axis_query(self, axis, _hash_key, mult):
+        keys = list(self._iterated_choices(axis))
+        choices = {}
+
+        reads = []
         
         for key in keys:
             fl = dict(self._filter, **{axis: key})
-            hash_field_id = self.metrica.hash_field_id(**fl)
+            hash_field_ids = self.metrica.hash_field_ids(_choices=choices, **fl)
             
-            pipe.hget(_hash_key, hash_field_id)
+            reads.append((_hash_key, hash_field_ids))
 
-        values = pipe.execute()
+        closed = [_hash_key] if self._is_closed(self._tp_id) else []
 
-        return zip(keys, [int(v or 0) / mult for v in values])
+        return Query(reads,
+                     lambda values: zip(keys, [_sum(v) / mult for v in values]),
+                     closed)
 
 
     def iterate_on_dateaxis(self):
         """Iterates on the next scale of a date axis.
 
         I.e. mymetric.timespan(year=2011).iterate() will iterate months"""
-        return self._iterate_on_dateaxis('', self.metrica.multiplier)
+        return self._iterate_on_dateaxis_query().execute()
 
-    def _iterate_on_dateaxis(self, _hash_key_postfix, mult):
+    def _iterate_on_dateaxis_query(self, _hash_key_postfix='', _mult=None):
+        mult = _mult or self.metrica.multiplier
         prefix = self.metrica.key_prefix()
         keys = []
 
-        pipe = redis.pipeline(transaction=False)
+        reads = []
+        closed = []
         
         for key, tp_id in self.metrica.date_axis.iterate(self):
             keys.append(key)
             
             hash_key = '%s:%s' % (prefix, tp_id) + _hash_key_postfix
             
-            pipe.hget(hash_key, self._hash_field_id)
-
-        values = pipe.execute()
+            reads.append((hash_key, self._hash_field_ids))
+            if self._is_closed(tp_id):
+                closed.append(hash_key)
 
-        return zip(keys, [int(v or 0) / mult for v in values])
+        return Query(reads,
+                     lambda values: zip(keys, [_sum(v) / mult for v in values]),
+                     closed)
             
 
     
 class AveragedMetrica(Metrica):
     """AveragedMetrica works like a normal metrica, but also stores counts of the events. So you can ask for .average or .count"""
+
+    _script_count_postfix = ':__len__'
+    _companion_postfixes = (':__len__',)
     
     def values(self):
         """Returns a MetricaValues object for all the data out there"""
@@ -271,54 +853,512 @@ class AveragedMetrica(Metrica):
         
 class AveragedMetricaValues(MetricaValues):
     def average(self):
-        return self.total() / self.count()
+        return self._average_query().execute()
+
+    def _average_query(self):
+        return Query.combine([self._total_query(), self._count_query()],
+                             lambda total, count: total / count)
 
     def count(self):
-        return int(redis.hget('%s:__len__' % self._hash_key,
-                              self._hash_field_id) or 0)
+        return self._count_query().execute()
+
+    def _count_query(self):
+        return self._total_query(':__len__', 1)
 
     def iterate_counts(self, axis=None):
+        return self._iterate_counts_query(axis).execute()
+
+    def _iterate_counts_query(self, axis=None):
         if not axis:
-            return self._iterate_on_dateaxis(':__len__', 1)
+            return self._iterate_on_dateaxis_query(':__len__', 1)
 
         hash_key = '%s:__len__' % self._hash_key
         
-        return self._iterate(axis, hash_key, 1)
+        return self._iterate_on_axis_query(axis, hash_key, 1)
 
     def iterate_averages(self, axis=None):
-        vals = self.iterate(axis)
-        counts = self.iterate_counts(axis)
+        return self._iterate_averages_query(axis).execute()
 
-        for (k1, v1), (k2, v2) in zip(vals, counts):
-            assert k1 == k2
+    def _iterate_averages_query(self, axis=None):
+        return Query.combine([self._iterate_query(axis),
+                              self._iterate_counts_query(axis)],
+                             _averages)
 
-            if not v2:
-                yield k1, None
-            else:
-                yield k1, v1 / v2
+    def count_rate(self, window=60):
+        """Events per second for the last `window` seconds"""
+        return self._count_rate_query(window).execute()
 
-    def timeserie_counts(self, since, until, scale=None):
-        return self.timeserie(since, until, scale,
-                              _hash_key_postfix=':__len__',
-                              _mult=1)
+    def _count_rate_query(self, window=60, _now=None):
+        return self._rate_query(window, _now, ':__len__', 1)
 
-    def timeserie_counts_and_averages(self, since, until, scale=None):
+    def count_between(self, since, until):
+        return self._count_between_query(since, until).execute()
 
-        vals = self.timeserie(since, until, scale)
-        counts = self.timeserie_counts(since, until, scale)
-        
-        for (k1, total), (k2, count) in zip(vals, counts):
-            assert k1 == k2
+    def _count_between_query(self, since, until):
+        return self._total_between_query(since, until, ':__len__', 1)
 
-            try:
-                avg = total / count
-            except ZeroDivisionError:
-                avg = 0
+    def timeserie_counts(self, since, until, scale=None):
+        return self._timeserie_counts_query(since, until, scale).execute()
+
+    def _timeserie_counts_query(self, since, until, scale=None):
+        return self._timeserie_query(since, until, scale,
+                                     _hash_key_postfix=':__len__',
+                                     _mult=1)
+
+    def timeserie_counts_and_averages(self, since, until, scale=None):
+        return self._timeserie_counts_and_averages_query(since, until, scale).execute()
 
-            yield k1, count, avg
+    def _timeserie_counts_and_averages_query(self, since, until, scale=None):
+        return Query.combine([self._timeserie_query(since, until, scale),
+                              self._timeserie_counts_query(since, until, scale)],
+                             _counts_and_averages)
         
     def timeserie_averages(self, since, until, scale=None):
-        count_avgs = self.timeserie_counts_and_averages(self, since, until, scale)
+        count_avgs = self.timeserie_counts_and_averages(since, until, scale)
         for k, count, avg in count_avgs:
             yield k, avg
-            
+
+
+def log_boundaries(start, end, factor=2):
+    """Returns log-spaced histogram bucket boundaries: start, start*factor, start*factor^2... up to end"""
+    boundaries = []
+
+    boundary = start
+    while boundary <= end * (1 + 1e-9):
+        boundaries.append(boundary)
+        boundary *= factor
+
+    return boundaries
+
+# from a millisecond to a minute, for response times in seconds
+DEFAULT_BOUNDARIES = log_boundaries(0.001, 60, 2 ** 0.5)
+
+
+class HistogramMetrica(AveragedMetrica):
+    """HistogramMetrica works like an averaged metrica, but also counts events in buckets by their values. So you can ask for percentiles
+
+    Buckets are fixed, and every event goes to the first bucket which boundary is greater than the value
+    (or to the last one, after all boundaries). Only buckets with events are stored, as fields of a '<hash key>:__hist__' hash"""
+
+    _companion_postfixes = AveragedMetrica._companion_postfixes + (':__hist__',)
+
+    def __init__(self, name, axes, boundaries=None, **kwargs):
+        """boundaries - a sorted list of bucket boundaries. log_boundaries() are nice. DEFAULT_BOUNDARIES by default (for seconds)"""
+        super(HistogramMetrica, self).__init__(name, axes, **kwargs)
+
+        if self.use_script:
+            raise ValueError("A histogram metrica can't be kicked with a script")
+
+        self.boundaries = sorted(boundaries or DEFAULT_BOUNDARIES)
+
+    def values(self):
+        """Returns a MetricaValues object for all the data out there"""
+        return HistogramMetricaValues(self)
+
+    def percentile(self, q):
+        return self.values().percentile(q)
+
+    def bucket(self, value):
+        """Returns a number of the bucket for a value"""
+        return bisect.bisect_right(self.boundaries, value)
+
+    def _increment(self, pipe, hash_key, hash_field_id, value):
+        super(HistogramMetrica, self)._increment(pipe, hash_key, hash_field_id, value)
+
+        bucket = self.bucket(value / self.multiplier)
+        pipe.hincrby('%s:__hist__' % hash_key, '%s#%s' % (hash_field_id, bucket), 1)
+
+
+class HistogramMetricaValues(AveragedMetricaValues):
+    def _histogram_fields(self, field_postfix=''):
+        buckets = xrange(len(self.metrica.boundaries) + 1)
+        
+        return ['%s#%s' % (hash_field_id, bucket)
+                for hash_field_id in _with_postfix(self._hash_field_ids, field_postfix)
+                for bucket in buckets]
+
+    def _bucket_counts(self, values):
+        """Sums values of histogram fields up by bucket"""
+        counts = [0] * (len(self.metrica.boundaries) + 1)
+
+        for i, v in enumerate(values):
+            counts[i % len(counts)] += int(v or 0)
+
+        return counts
+
+    def histogram(self):
+        """Returns a list of (bucket upper boundary, count) tuples. The last boundary is None"""
+        return self._histogram_query().execute()
+
+    def _histogram_query(self):
+        hash_key = '%s:__hist__' % self._hash_key
+        closed = [hash_key] if self._is_closed(self._tp_id) else []
+
+        return Query([(hash_key, self._histogram_fields())],
+                     lambda values: self._histogram(self._bucket_counts(values[0])),
+                     closed)
+
+    def _histogram(self, counts):
+        return zip(self.metrica.boundaries + [None], counts)
+
+    def percentile(self, q):
+        """Returns an estimate of a percentile: .percentile(0.99). None if there are no events"""
+        return self._percentile_query(q).execute()
+
+    def _percentile_query(self, q):
+        return self._percentiles_query([q], _single=True)
+
+    def percentiles(self, qs):
+        """Returns a list of percentiles estimates: .percentiles([0.5, 0.9, 0.99])"""
+        return self._percentiles_query(qs).execute()
+
+    def _percentiles_query(self, qs, _single=False):
+        def build(histogram):
+            percentiles = _percentiles(self.metrica.boundaries,
+                                       [count for boundary, count in histogram],
+                                       qs)
+            return percentiles[0] if _single else percentiles
+
+        return Query.combine([self._histogram_query()], build)
+
+    def timeserie_percentiles(self, since, until, scale=None, qs=(0.5, 0.9, 0.99)):
+        """Returns a list of (point, [percentiles]) tuples"""
+        return self._timeserie_percentiles_query(since, until, scale, qs).execute()
+
+    def _timeserie_percentiles_query(self, since, until, scale=None, qs=(0.5, 0.9, 0.99)):
+        points, buckets, closed = self._timeserie_points(since, until, scale, ':__hist__')
+
+        reads = [(hash_key, self._histogram_fields(field_postfix))
+                 for hash_key, field_postfix in buckets]
+
+        def build(values):
+            return zip(points, [_percentiles(self.metrica.boundaries, self._bucket_counts(v), qs)
+                                for v in values])
+
+        return Query(reads, build, closed)
+
+    def histogram_between(self, since, until, scale=None):
+        """A histogram of all buckets of a timeserie merged together"""
+        return self._histogram_between_query(since, until, scale).execute()
+
+    def _histogram_between_query(self, since, until, scale=None):
+        points, buckets, closed = self._timeserie_points(since, until, scale, ':__hist__')
+
+        reads = [(hash_key, self._histogram_fields(field_postfix))
+                 for hash_key, field_postfix in buckets]
+
+        def build(values):
+            merged = []
+            for v in values:
+                merged.extend(v)
+            return self._histogram(self._bucket_counts(merged))
+
+        return Query(reads, build, closed)
+
+    def percentiles_between(self, since, until, scale=None, qs=(0.5, 0.9, 0.99)):
+        """Percentiles for a time range"""
+        return self._percentiles_between_query(since, until, scale, qs).execute()
+
+    def _percentiles_between_query(self, since, until, scale=None, qs=(0.5, 0.9, 0.99)):
+        def build(histogram):
+            return _percentiles(self.metrica.boundaries,
+                                [count for boundary, count in histogram],
+                                qs)
+
+        return Query.combine([self._histogram_between_query(since, until, scale)], build)
+
+
+def _percentiles(boundaries, counts, qs):
+    """Estimates percentiles from bucket counts, interpolating linearly inside buckets"""
+    total = sum(counts)
+    if not total:
+        return [None for q in qs]
+
+    result = []
+    for q in qs:
+        rank = q * total
+        seen = 0
+
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = boundaries[i - 1] if i else 0
+
+                if i == len(boundaries):
+                    # there's no upper boundary to interpolate with
+                    result.append(lower)
+                else:
+                    upper = boundaries[i]
+                    result.append(lower + (upper - lower) * float(rank - seen) / count)
+                break
+
+            seen += count
+
+    return result
+
+
+def _averages(vals, counts):
+    result = []
+    
+    for (k1, v1), (k2, v2) in zip(vals, counts):
+        assert k1 == k2
+
+        if not v2:
+            result.append((k1, None))
+        else:
+            result.append((k1, v1 / v2))
+
+    return result
+
+
+def _counts_and_averages(vals, counts):
+    result = []
+    
+    for (k1, total), (k2, count) in zip(vals, counts):
+        assert k1 == k2
+
+        try:
+            avg = total / count
+        except ZeroDivisionError:
+            avg = 0
+
+        result.append((k1, count, avg))
+
+    return result
+
+
+class UniqueMetrica(Metrica):
+    """UniqueMetrica counts distinct items (like visitors), not events. So you kick it with an item: .kick(user.id, ...)
+
+    Every combination of axes values and every time bucket gets its own HyperLogLog in Redis (2.8.9+ is needed).
+    It uses about 12 KB at most, no matter how many items there are, and counts them with a standard error of 0.81%.
+    Distinct counts can't be summed up, so they are not fetched in batches"""
+
+    def __init__(self, name, axes, **kwargs):
+        super(UniqueMetrica, self).__init__(name, axes, **kwargs)
+
+        if self.buffer or self.use_script:
+            raise ValueError("A unique metrica can't be buffered or kicked with a script")
+
+        if any(getattr(axis, 'track_top', False) for axis_kw, axis in self.axes):
+            raise ValueError("A unique metrica can't have top-k axes")
+
+        if self.date_axis.is_stored('second'):
+            raise ValueError("A unique metrica can't store seconds")
+
+        if _sharded_without_hash_tags():
+            # HyperLogLogs are united with PFCOUNT and PFMERGE, which need all their keys on one node
+            raise ValueError("A unique metrica can be sharded only with settings.STASTE_HASH_TAGS")
+
+    def values(self):
+        """Returns a MetricaValues object for all the data out there"""
+        return UniqueMetricaValues(self)
+
+    def kick_many(self, events, chunk_size=10000):
+        """Registers lots of items, like in a backfill. events - an iterable of kick() kwargs dicts, like {'item': user.id, 'date': dt, 'gender': 'boy'}
+
+        Items are grouped by HyperLogLog, `chunk_size` events at a time, and every chunk is sent as one pipeline
+        with a single PFADD for every HyperLogLog. Returns how many events were kicked"""
+        kicked = 0
+
+        for chunk in batches(events, chunk_size):
+            items = []
+            for event in chunk:
+                event = dict(event)
+                items.append((event.pop('item'), event.pop('date', None), event))
+
+            self._kick_items(items)
+            kicked += len(items)
+
+        return kicked
+
+    def kick(self, item, date=None, **kwargs):
+        """Registers an item with parameters (for each of axis)"""
+        self._kick_items([(item, date, kwargs)])
+
+    def _kick_items(self, items):
+        """Registers (item, date, kwargs) tuples in one pipeline, with one PFADD for every HyperLogLog"""
+        hash_key_prefix = self.key_prefix()
+
+        hlls = OrderedDict() # HyperLogLog key => items
+        expirations = {}
+        choices_sets_to_append = []
+
+        for item, date, kwargs in items:
+            date = date or datetime.datetime.now()
+
+            plan = self._kick_plan(self._kick_params(kwargs))
+            choices_sets_to_append.extend(plan.choices_sets)
+
+            for date_scale in self.date_axis.scales(date):
+                hash_key = '%s:%s' % (hash_key_prefix, date_scale.id)
+
+                for hash_field_id in plan.hash_field_ids:
+                    hll_key = self.hll_key(hash_key, hash_field_id)
+
+                    hlls.setdefault(hll_key, []).append(item)
+                    if date_scale.expiration:
+                        expirations[hll_key] = date_scale.expiration
+
+                if date_scale.store:
+                    choices_sets_to_append.append((date_scale.store, date_scale.value))
+
+        pipe = self.pipeline()
+        memos = []
+
+        for hll_key, hll_items in hlls.iteritems():
+            pipe.pfadd(hll_key, *hll_items)
+
+            expiration = expirations.get(hll_key)
+            if expiration:
+                if self._should_expire(hll_key, expiration, memos):
+                    pipe.expire(hll_key, expiration)
+
+        for key, s_value in choices_sets_to_append:
+            set_key = '%s:%s' % (hash_key_prefix, key)
+
+            if self._should_store_member(set_key, s_value, memos):
+                pipe.sadd(set_key, s_value)
+
+        pipe.execute()
+        self._remember(memos)
+
+    def hll_key(self, hash_key, hash_field_id):
+        """A key of the HyperLogLog for a hash field"""
+        return '%s:__unique__:%s' % (hash_key, hash_field_id)
+
+
+class UniqueMetricaValues(MetricaValues):
+    """Distinct counts. Fields of combinations which are not stored (see `cuboids`) are united, not summed up"""
+
+    batchable = False
+
+    def query(self, method, *args, **kwargs):
+        raise ValueError("Distinct counts can't be fetched in a batch")
+
+    def _hll_keys(self, hash_key):
+        return [self.metrica.hll_key(hash_key, hash_field_id)
+                for hash_field_id in self._hash_field_ids]
+
+    def _count(self, hll_keys_lists):
+        """PFCOUNTs every list of HyperLogLog keys in one pipeline"""
+        pipe = backend.pipeline(transaction=False)
+
+        for hll_keys in hll_keys_lists:
+            pipe.pfcount(*hll_keys)
+
+        return pipe.execute()
+
+    def total(self):
+        """Distinct items count in the subset"""
+        return self._count([self._hll_keys(self._hash_key)])[0]
+
+    def timeserie(self, since, until, scale=None):
+        points, buckets, closed = self._timeserie_points(since, until, scale)
+
+        return zip(points, self._count([self._hll_keys(hash_key)
+                                        for hash_key, field_postfix in buckets]))
+
+    def timeserie_by(self, axis, since, until, scale=None):
+        """Timeseries of distinct counts for every choice of an axis. Returns a dict: {choice: [(point, value), ...]}"""
+        points, buckets, closed = self._timeserie_points(since, until, scale)
+
+        keys = list(self._iterated_choices(axis))
+        choices = {}
+
+        hll_keys_lists = []
+        for key in keys:
+            fl = dict(self._filter, **{axis: key})
+            hash_field_ids = self.metrica.hash_field_ids(_choices=choices, **fl)
+
+            hll_keys_lists.extend([self.metrica.hll_key(hash_key, hash_field_id)
+                                   for hash_field_id in hash_field_ids]
+                                  for hash_key, field_postfix in buckets)
+
+        counts = self._count(hll_keys_lists)
+
+        return dict((key, zip(points, counts[i * len(points):(i + 1) * len(points)]))
+                    for i, key in enumerate(keys))
+
+    def total_between(self, since, until):
+        """Distinct items count for an arbitrary time range: a union of the fewest buckets covering it"""
+        prefix = self.metrica.key_prefix()
+
+        hll_keys = []
+        for tp_id in self.metrica.date_axis.decompose(since, until):
+            hll_keys.extend(self._hll_keys('%s:%s' % (prefix, tp_id)))
+
+        if not hll_keys:
+            return 0
+        return backend.pfcount(*hll_keys)
+
+    def rate(self, window=60):
+        """Distinct items per second for the last `window` seconds
+
+        Distinct counts can't be weighted, so buckets partly outside the window are counted whole"""
+        prefix = self.metrica.key_prefix()
+        now = datetime.datetime.now()
+        since = now - datetime.timedelta(seconds=window)
+
+        hll_keys = []
+        for tp_id, weight in self.metrica.date_axis.window(since, now, now):
+            hll_keys.extend(self._hll_keys('%s:%s' % (prefix, tp_id)))
+
+        if not hll_keys:
+            return 0.0
+        return backend.pfcount(*hll_keys) / float(window)
+
+    def iterate(self, axis=None):
+        if not axis:
+            return self.iterate_on_dateaxis()
+
+        keys = list(self._iterated_choices(axis))
+        choices = {}
+
+        hll_keys_lists = []
+        for key in keys:
+            fl = dict(self._filter, **{axis: key})
+            hll_keys_lists.append([self.metrica.hll_key(self._hash_key, hash_field_id)
+                                   for hash_field_id in self.metrica.hash_field_ids(_choices=choices, **fl)])
+
+        return zip(keys, self._count(hll_keys_lists))
+
+    def iterate_on_dateaxis(self):
+        prefix = self.metrica.key_prefix()
+
+        keys = []
+        hll_keys_lists = []
+        for key, tp_id in self.metrica.date_axis.iterate(self):
+            keys.append(key)
+            hll_keys_lists.append(self._hll_keys('%s:%s' % (prefix, tp_id)))
+
+        return zip(keys, self._count(hll_keys_lists))
+
+    def _hll_keys_between(self, since, until, scale):
+        points, buckets, closed = self._timeserie_points(since, until, scale)
+
+        hll_keys = []
+        for hash_key, field_postfix in buckets:
+            hll_keys.extend(self._hll_keys(hash_key))
+        return hll_keys
+
+    def unique_between(self, since, until, scale=None):
+        """Distinct items count for a time range, like "unique visitors for the last 10 days"
+
+        Buckets of the timeserie are united. Use a coarse scale for long ranges: there are less of them"""
+        hll_keys = self._hll_keys_between(since, until, scale)
+        if not hll_keys:
+            return 0
+
+        return backend.pfcount(*hll_keys)
+
+    def merge_between(self, destkey, since, until, scale=None, expire=None):
+        """Stores a union of the time range buckets in a HyperLogLog at destkey. Returns its distinct count"""
+        hll_keys = self._hll_keys_between(since, until, scale)
+
+        pipe = backend.pipeline(transaction=False)
+        pipe.pfmerge(destkey, *hll_keys)
+        if expire:
+            pipe.expire(destkey, expire)
+        pipe.pfcount(destkey)
+
+        return pipe.execute()[-1]
@@ -1,12 +1,30 @@
 import time
 
-from staste.metrica import AveragedMetrica
-from staste.axis import StoredChoiceAxis
+from django.conf import settings
 
-response_time_metrica = AveragedMetrica('response_time_metrica',
-                                        [('view', StoredChoiceAxis()),
-                                         ('exception', StoredChoiceAxis())],
-                                        multiplier=10000)
+from staste.metrica import AveragedMetrica, HistogramMetrica
+from staste.axis import StoredChoiceAxis, HierarchicalAxis
+
+# with a histogram, you can ask for percentiles of response times too
+if getattr(settings, 'STASTE_RESPONSE_TIME_HISTOGRAM', False):
+    metrica_class = HistogramMetrica
+else:
+    metrica_class = AveragedMetrica
+
+# with a view tree, views are counted by their packages and modules too: 'app', 'app.views', 'app.views.index'.
+# fields and choice sets are different, so it's a metrica of its own
+if getattr(settings, 'STASTE_RESPONSE_TIME_VIEW_TREE', False):
+    metrica_name = 'response_time_metrica_tree'
+    view_axis = HierarchicalAxis()
+else:
+    metrica_name = 'response_time_metrica'
+    view_axis = StoredChoiceAxis()
+
+response_time_metrica = metrica_class(metrica_name,
+                                      [('view', view_axis),
+                                       ('exception', StoredChoiceAxis())],
+                                      multiplier=10000,
+                                      buffer=getattr(settings, 'STASTE_BUFFER_RESPONSE_TIME', False))
 
 class ResponseTimeMiddleware(object):
     def process_request(self, request):
@@ -0,0 +1,194 @@
+"""Queries: what hash fields to read, and how to make a result out of them
+
+Every MetricaValues method which reads something builds a Query first. A Query alone is
+executed in one pipeline, but many of them can be collected in a batch_query(),
+and then all of them are fetched together, with one HMGET for every hash key:
+
+    with batch_query() as batch:
+        girls = batch.total(metrica.filter(gender='girl'))
+        ages = batch.iterate(metrica.timespan(year=2011), 'age')
+
+    print girls.value, ages.value
+"""
+from collections import OrderedDict
+
+from staste import backend
+from staste.bucket_cache import BUCKET_CACHE
+
+
+class Query(object):
+    """A list of reads, (hash key, [hash field ids]), and a function building a result out of their values"""
+
+    def __init__(self, reads, build, closed=()):
+        """build - a function of a list of values lists, one for each read
+        closed - hash keys of time buckets which are over. their values can be cached (see staste.bucket_cache)"""
+        self.reads = reads
+        self.build = build
+        self.closed = frozenset(closed)
+
+    def execute(self):
+        return execute_queries([self])[0]
+
+    @classmethod
+    def combine(cls, queries, build):
+        """Returns a Query reading everything for all the queries at once
+
+        build - a function of their results"""
+        reads = []
+        closed = set()
+        for query in queries:
+            reads.extend(query.reads)
+            closed.update(query.closed)
+
+        def build_all(values):
+            results = []
+
+            start = 0
+            for query in queries:
+                end = start + len(query.reads)
+                results.append(query.build(values[start:end]))
+                start = end
+
+            return build(*results)
+
+        return cls(reads, build_all, closed)
+
+
+def execute_queries(queries):
+    """Fetches everything for a list of queries in one pipeline, and returns a list of their results"""
+    fields_by_key = OrderedDict()
+    for query in queries:
+        for hash_key, hash_field_ids in query.reads:
+            fields = fields_by_key.setdefault(hash_key, OrderedDict())
+            for hash_field_id in hash_field_ids:
+                fields[hash_field_id] = None
+
+    closed = set()
+    for query in queries:
+        closed.update(query.closed)
+
+    cache = BUCKET_CACHE if BUCKET_CACHE.enabled else None
+    
+    fetched = [] # (hash key, [hash field ids])
+    for hash_key, fields in fields_by_key.iteritems():
+        if cache and hash_key in closed:
+            cached = cache.get_many(hash_key, list(fields))
+            fields.update(cached)
+            missing = [hash_field_id for hash_field_id in fields
+                       if hash_field_id not in cached]
+        else:
+            missing = list(fields)
+
+        if missing:
+            fetched.append((hash_key, missing))
+
+    if fetched:
+        pipe = backend.pipeline(transaction=False)
+        for hash_key, hash_field_ids in fetched:
+            pipe.hmget(hash_key, hash_field_ids)
+
+        for (hash_key, hash_field_ids), values in zip(fetched, pipe.execute()):
+            values = dict(zip(hash_field_ids, values))
+            fields_by_key[hash_key].update(values)
+
+            if cache and hash_key in closed:
+                cache.set_many(hash_key, values)
+
+    results = []
+    for query in queries:
+        values = [[fields_by_key[hash_key][hash_field_id]
+                   for hash_field_id in hash_field_ids]
+                  for hash_key, hash_field_ids in query.reads]
+        results.append(query.build(values))
+
+    return results
+
+
+class LazyResult(object):
+    """A result of a query in a batch. It's available as .value after the batch is executed"""
+
+    def __init__(self):
+        self.ready = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self.ready:
+            raise ValueError('The batch has not been executed yet')
+        return self._value
+
+    def set(self, value):
+        self._value = value
+        self.ready = True
+
+    def __repr__(self):
+        if not self.ready:
+            return '<LazyResult: pending>'
+        return '<LazyResult: %r>' % (self._value,)
+
+
+class BatchQuery(object):
+    """Collects queries of many MetricaValues and executes them together
+
+    Every MetricaValues method which has a query can be called on a batch,
+    with the MetricaValues as the first argument: batch.iterate(values, 'gender').
+    It returns a LazyResult"""
+
+    def __init__(self):
+        self.pending = []
+
+    def add(self, query):
+        result = LazyResult()
+        self.pending.append((query, result))
+        return result
+
+    def fetch(self, values, method, *args, **kwargs):
+        """Adds a query of values.method(*args, **kwargs). Returns a LazyResult
+
+        Values which can't be fetched in a batch (distinct counts) are fetched right away"""
+        if not values.batchable:
+            result = LazyResult()
+            result.set(getattr(values, method)(*args, **kwargs))
+            return result
+
+        return self.add(values.query(method, *args, **kwargs))
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def fetch(values, *args, **kwargs):
+            return self.fetch(values, method, *args, **kwargs)
+        return fetch
+
+    def execute(self):
+        pending, self.pending = self.pending, []
+
+        results = execute_queries([query for query, result in pending])
+
+        for (query, result), value in zip(pending, results):
+            result.set(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+def batch_query():
+    """Returns a BatchQuery, to be used in a with statement"""
+    return BatchQuery()
+
+
+def fetch_many(requests):
+    """Executes many queries at once. Returns a list of results
+
+    requests - a list of tuples: (MetricaValues object, method name, arguments...)"""
+    batch = BatchQuery()
+    results = [batch.fetch(request[0], request[1], *request[2:])
+               for request in requests]
+    batch.execute()
+
+    return [result.value for result in results]
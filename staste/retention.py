@@ -0,0 +1,136 @@
+"""Deleting data without blocking Redis
+
+purge() deletes all keys of a metrica. prune() forgets values of stored choice axes which weren't
+kicked for a while: buckets of expiring scales go away on their own, but a value stays in its
+choices set, and in '__all__' and year hashes (and other scales which never expire), forever.
+
+Keys are found with SCAN and fields with HSCAN. They are deleted with UNLINK (Redis 4.0+, memory
+is freed in background, it's DEL on older ones) and HDEL, `batch_size` at a time, sleeping `pause` seconds between
+batches, so other clients are served in between.
+
+Kicks of a pruned value made while pruning could be lost in long-lived hashes. Other processes
+remember which choices they've stored for Metrica.stored_members_ttl, so a value kicked there again
+is stored again only after that. Prune less often."""
+import time
+import datetime
+
+from staste import backend
+from staste.query import fetch_many
+from staste.bucket_cache import BUCKET_CACHE
+from staste.memory import parse_key
+from staste.utils import batches
+
+
+def _forget(metrica):
+    """Memos of the metrica and cached buckets are about keys which are not there anymore"""
+    metrica.forget_kicks()
+    BUCKET_CACHE.forget(metrica.key_prefix())
+
+
+def _scan(metrica, batch_size):
+    return backend.scan_iter(match='%s:*' % metrica.key_prefix(), count=batch_size)
+
+
+def purge(metrica, batch_size=500, pause=0):
+    """Deletes all keys of a metrica. Returns how many were deleted"""
+    deleted = 0
+
+    for keys in batches(_scan(metrica, batch_size), batch_size):
+        deleted += backend.unlink(*keys)
+        time.sleep(pause)
+
+    _forget(metrica)
+    return deleted
+
+
+def stale_choices(metrica, axis_kw, since, until=None, batch_size=500):
+    """Returns a list of stored choices of an axis which have no events since a datetime"""
+    until = until or datetime.datetime.now()
+
+    values = metrica.values()
+    method = 'count_between' if hasattr(values, 'count_between') else 'total_between'
+
+    stale = []
+    for choices in batches(backend.smembers(metrica.key_for_axis_choices(axis_kw)), batch_size):
+        requests = [(metrica.filter(**{axis_kw: choice}), method, since, until)
+                    for choice in choices]
+
+        stale.extend(choice for choice, value in zip(choices, fetch_many(requests))
+                     if not value)
+    return stale
+
+
+def _is_stale_field(field, stale_parts):
+    """Whether a hash field id has a stale choice. stale_parts - a list of (axis position, set of stale choices)"""
+    # fields of histograms and seconds have postfixes
+    parts = field.split('#', 1)[0].split(':')
+
+    return any(i < len(parts) and parts[i] in choices for i, choices in stale_parts)
+
+
+def prune(metrica, since, axes=None, batch_size=500, pause=0):
+    """Forgets choices of stored choice axes (all of them by default) which have no events since a datetime.
+    They are removed from choices sets, and their fields from hashes (and top sets, and HyperLogLogs) of scales which never expire
+
+    Returns a dict: 'choices' - a dict of removed choices by axis, 'fields' and 'keys' - how many were deleted"""
+    if axes is None:
+        axes = [axis_kw for axis_kw, axis in metrica.axes if getattr(axis, 'store_choice', False)]
+
+    positions = dict((axis_kw, i) for i, (axis_kw, axis) in enumerate(metrica.axes))
+
+    result = {'choices': {}, 'fields': 0, 'keys': 0}
+    stale_parts = []
+
+    for axis_kw in axes:
+        if not getattr(metrica.get_axis(axis_kw), 'store_choice', False):
+            raise ValueError('Only stored choice axes can be pruned, %s is not one' % axis_kw)
+
+        stale = stale_choices(metrica, axis_kw, since, batch_size=batch_size)
+        result['choices'][axis_kw] = stale
+
+        if stale:
+            stale_parts.append((positions[axis_kw], set(stale)))
+
+        for members in batches(stale, batch_size):
+            backend.srem(metrica.key_for_axis_choices(axis_kw), *members)
+            time.sleep(pause)
+
+    if not stale_parts:
+        return result
+
+    never_expiring = set(['__all__'] + [scale for scale, expiration
+                                        in metrica.date_axis.scales_and_expirations
+                                        if not expiration])
+
+    stale_keys = []
+    for key in _scan(metrica, batch_size):
+        kind, scale, axis = parse_key(metrica, key)
+        if scale not in never_expiring:
+            continue
+
+        if kind in ('values', 'counts', 'histograms'):
+            stale_fields = (field for field, value in backend.hscan_iter(key, count=batch_size)
+                            if _is_stale_field(field, stale_parts))
+
+            for fields in batches(stale_fields, batch_size):
+                result['fields'] += backend.hdel(key, *fields)
+                time.sleep(pause)
+
+        elif kind == 'top':
+            # '<hash key>:__top__:<axis>:<field>'
+            field = key.split(':__top__:', 1)[1].split(':', 1)[1]
+            if _is_stale_field(field, stale_parts):
+                stale_keys.append(key)
+
+        elif kind == 'unique':
+            # '<hash key>:__unique__:<field>'
+            field = key.split(':__unique__:', 1)[1]
+            if _is_stale_field(field, stale_parts):
+                stale_keys.append(key)
+
+    for keys in batches(stale_keys, batch_size):
+        result['keys'] += backend.unlink(*keys)
+        time.sleep(pause)
+
+    _forget(metrica)
+    return result
@@ -0,0 +1,231 @@
+"""Lua scripts executed inside Redis (needs Redis 2.6+)
+
+Every script has a Python implementation too, for backends which can't run Lua"""
+import json
+import weakref
+import hashlib
+import threading
+import itertools
+
+from redis.exceptions import NoScriptError
+
+from staste import backend
+
+
+_scripts = {} # sha => Script
+
+def get_script(sha):
+    return _scripts[sha]
+
+
+class Script(object):
+    """A Lua script, called by its SHA1 digest. Loaded into Redis on demand
+
+    python - a function(backend, keys, args) doing the same thing"""
+
+    def __init__(self, lua, python=None):
+        self.lua = lua
+        self.python = python
+        self.sha = hashlib.sha1(lua).hexdigest()
+        self.loaded = False
+
+        _scripts.setdefault(self.sha, self)
+
+    def run_in_python(self, backend, keys, args):
+        if not self.python:
+            raise NotImplementedError('Script %s has no Python implementation' % self.sha)
+
+        return self.python(backend, keys, args)
+
+    def __call__(self, keys=(), args=(), client=None):
+        client = client or backend
+        params = list(keys) + list(args)
+
+        try:
+            return client.evalsha(self.sha, len(keys), *params)
+        except NoScriptError:
+            pass
+
+        # Redis was restarted or flushed its script cache
+        client.script_load(self.lua)
+        self.loaded = True
+        return client.evalsha(self.sha, len(keys), *params)
+
+    def queue(self, pipe, keys=(), args=()):
+        """Adds a call of the script to a pipeline. The script is loaded beforehand, once.
+        Execute the pipeline with staste.scripts.execute(), it calls the script again if Redis has lost it"""
+        if not self.loaded:
+            backend.script_load(self.lua)
+            self.loaded = True
+
+        queue_evalsha(pipe, self.sha, len(keys), *(list(keys) + list(args)))
+
+
+# pipeline => a list of (position in the pipeline, sha, number of keys, args) of scripts queued there
+_queued = weakref.WeakKeyDictionary()
+_queued_lock = threading.Lock()
+
+def queue_evalsha(pipe, sha, numkeys, *args):
+    """Adds an EVALSHA to a pipeline, and remembers where it is. See execute()"""
+    with _queued_lock:
+        _queued.setdefault(pipe, []).append((len(pipe), sha, numkeys, args))
+
+    pipe.evalsha(sha, numkeys, *args)
+
+
+def execute(pipe):
+    """Executes a pipeline with queued scripts. Returns a list of results, like pipe.execute()
+
+    If Redis has lost its scripts (it was restarted or SCRIPT FLUSHed), the other commands are executed anyway.
+    So the scripts are loaded again, and only their failed calls are made once more"""
+    with _queued_lock:
+        calls = _queued.pop(pipe, None)
+
+    if not calls:
+        return pipe.execute()
+
+    results = pipe.execute(raise_on_error=False)
+    if results is None:
+        # a buffered pipeline, scripts are called when it's flushed
+        return results
+
+    for position, sha, numkeys, args in calls:
+        if isinstance(results[position], NoScriptError):
+            script = get_script(sha)
+            results[position] = script(keys=args[:numkeys], args=args[numkeys:])
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    return results
+
+
+# Does everything Metrica.kick() does with a pipeline, but inside Redis.
+#
+# KEYS[1] is a key prefix of the metrica, ARGV[1] is a JSON object:
+#   axes - a list of lists of field id parts, one for each axis
+#   fields - optional, a list of hash field ids to bump. every combination of axes parts is bumped by default
+#   scales - a list of [date scale id, expiration, field postfix] lists. a postfix is appended to fields, it's for seconds
+#   value - a multiplier-adjusted value, as a string
+#   count_postfix - if not empty, events are counted in a '<hash key><count_postfix>' hash too. it expires with the hash
+#   sets - a list of [set key, member] pairs
+#
+# Keep in mind that the keys are built inside the script, so all keys of a metrica
+# must be on the same Redis node (see settings.STASTE_HASH_TAGS).
+def _kick(backend, keys, args):
+    prefix = keys[0]
+    kick = json.loads(args[0])
+
+    fields = kick.get('fields')
+    if fields is None:
+        fields = [':'.join(parts) for parts in itertools.product(*kick['axes'])]
+
+    for scale in kick['scales']:
+        scale_id, expiration = scale[:2]
+        field_postfix = scale[2] if len(scale) > 2 else ''
+        hash_key = '%s:%s' % (prefix, scale_id)
+
+        for field in fields:
+            backend.hincrby(hash_key, field + field_postfix, kick['value'])
+
+            if kick['count_postfix']:
+                backend.hincrby(hash_key + kick['count_postfix'], field + field_postfix, 1)
+
+        if expiration > 0:
+            backend.expire(hash_key, expiration)
+
+            if kick['count_postfix']:
+                backend.expire(hash_key + kick['count_postfix'], expiration)
+
+    for set_key, member in kick['sets']:
+        backend.sadd('%s:%s' % (prefix, set_key), member)
+
+    return len(fields)
+
+KICK = Script("""
+local prefix = KEYS[1]
+local kick = cjson.decode(ARGV[1])
+
+local fields = kick.fields
+if not fields then
+    fields = {''}
+    for i, parts in ipairs(kick.axes) do
+        local expanded = {}
+        for _, field in ipairs(fields) do
+            for _, part in ipairs(parts) do
+                if i == 1 then
+                    table.insert(expanded, part)
+                else
+                    table.insert(expanded, field .. ':' .. part)
+                end
+            end
+        end
+        fields = expanded
+    end
+end
+
+for _, scale in ipairs(kick.scales) do
+    local hash_key = prefix .. ':' .. scale[1]
+    local field_postfix = scale[3] or ''
+
+    for _, field in ipairs(fields) do
+        redis.call('HINCRBY', hash_key, field .. field_postfix, kick.value)
+
+        if kick.count_postfix ~= '' then
+            redis.call('HINCRBY', hash_key .. kick.count_postfix, field .. field_postfix, 1)
+        end
+    end
+
+    if scale[2] > 0 then
+        redis.call('EXPIRE', hash_key, scale[2])
+
+        if kick.count_postfix ~= '' then
+            redis.call('EXPIRE', hash_key .. kick.count_postfix, scale[2])
+        end
+    end
+end
+
+for _, set in ipairs(kick.sets) do
+    redis.call('SADD', prefix .. ':' .. set[1], set[2])
+end
+
+return #fields
+""", _kick)
+
+
+# Space-saving top-k: counts a member in a sorted set of at most k members.
+# If the set is full, the member with the lowest score is replaced, and the newcomer
+# inherits its score (so scores are overestimated by at most that much).
+#
+# KEYS[1] is a sorted set key, ARGV is member, increment, k, expiration
+def _space_saving(backend, keys, args):
+    key = keys[0]
+    member, increment, k, expiration = args[0], float(args[1]), int(args[2]), int(args[3])
+
+    if backend.zscore(key, member) is not None or backend.zcard(key) < k:
+        backend.zincrby(key, member, increment)
+    else:
+        (min_member, min_score), = backend.zrange(key, 0, 0, withscores=True)
+        backend.zrem(key, min_member)
+        backend.zincrby(key, member, float(min_score) + increment)
+
+    if expiration > 0:
+        backend.expire(key, expiration)
+
+SPACE_SAVING = Script("""
+local key, member = KEYS[1], ARGV[1]
+local increment, k, expiration = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+
+if redis.call('ZSCORE', key, member) or redis.call('ZCARD', key) < k then
+    redis.call('ZINCRBY', key, increment, member)
+else
+    local min = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    redis.call('ZREM', key, min[1])
+    redis.call('ZINCRBY', key, tonumber(min[2]) + increment, member)
+end
+
+if expiration > 0 then
+    redis.call('EXPIRE', key, expiration)
+end
+""", _space_saving)
@@ -0,0 +1,220 @@
+"""Spreading metricas over several Redis nodes
+
+Keys are grouped into 16384 slots the same way Redis Cluster does it: CRC16 of the key,
+or of its {hash tag} if there is one. Slots are assigned to nodes with consistent hashing,
+so adding a node moves only about 1/N of the slots.
+
+With settings.STASTE_HASH_TAGS all keys of a metrica share a hash tag, so the whole
+metrica lives on a single node. Otherwise every hash key is routed on its own,
+and a kick is sent as one pipeline per node."""
+import bisect
+import hashlib
+
+
+CLUSTER_SLOTS = 16384
+
+
+def _crc16_table():
+    table = []
+    for i in xrange(256):
+        crc = i << 8
+        for j in xrange(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """CRC16-CCITT (XModem), the one Redis Cluster uses"""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffff) ^ CRC16_TABLE[((crc >> 8) ^ ord(byte)) & 0xff]
+    return crc
+
+
+def key_slot(key):
+    """Returns a Redis Cluster slot of a key. Only a {hash tag} is hashed, if the key has one"""
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+
+    return crc16(key) % CLUSTER_SLOTS
+
+
+class SlotRouter(object):
+    """Assigns cluster slots to nodes with a consistent hash ring"""
+
+    replicas = 160
+
+    def __init__(self, node_names):
+        ring = []
+        for node_index, name in enumerate(node_names):
+            for i in xrange(self.replicas):
+                ring.append((self._hash('%s:%s' % (name, i)), node_index))
+        ring.sort()
+
+        points = [point for point, node_index in ring]
+
+        self.slots = []
+        for slot in xrange(CLUSTER_SLOTS):
+            i = bisect.bisect(points, self._hash('slot:%s' % slot)) % len(ring)
+            self.slots.append(ring[i][1])
+
+    def _hash(self, s):
+        return int(hashlib.md5(s).hexdigest()[:8], 16)
+
+    def get_node_index(self, key):
+        return self.slots[key_slot(key)]
+
+
+class ShardedRedis(object):
+    """Looks like a Redis client, but sends every command to the node its key belongs to
+
+    Supports only commands staste uses"""
+
+    def __init__(self, nodes, router_class=SlotRouter):
+        """nodes - a list of Redis clients"""
+        self.nodes = list(nodes)
+        self.router = router_class([self._node_name(node) for node in self.nodes])
+
+    def _node_name(self, node):
+        kwargs = node.connection_pool.connection_kwargs
+        return '%s:%s:%s' % (kwargs.get('host'), kwargs.get('port'), kwargs.get('db'))
+
+    def get_node(self, key):
+        return self.nodes[self.router.get_node_index(key)]
+
+    def pipeline(self, transaction=False):
+        return ShardedPipeline(self)
+
+    def keys(self, pattern='*'):
+        keys = []
+        for node in self.nodes:
+            keys.extend(node.keys(pattern))
+        return keys
+
+    def scan_iter(self, match=None, count=None):
+        for node in self.nodes:
+            for key in node.scan_iter(match=match, count=count):
+                yield key
+
+    def object(self, infotype, key):
+        return self.get_node(key).object(infotype, key)
+
+    def delete(self, *keys):
+        deleted = 0
+        for node_index, node_keys in self._group_by_node(keys).iteritems():
+            deleted += self.nodes[node_index].delete(*node_keys)
+        return deleted
+
+    def unlink(self, *keys):
+        unlinked = 0
+        for node_index, node_keys in self._group_by_node(keys).iteritems():
+            unlinked += self.nodes[node_index].unlink(*node_keys)
+        return unlinked
+
+    def _group_by_node(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.router.get_node_index(key), []).append(key)
+        return groups
+
+    def evalsha(self, sha, numkeys, *args):
+        # we route scripts by their first key
+        return self.get_node(args[0]).evalsha(sha, numkeys, *args)
+
+    def script_load(self, script):
+        for node in self.nodes:
+            sha = node.script_load(script)
+        return sha
+
+    def info(self):
+        """Returns INFO of all nodes. Memory usage is summed up"""
+        infos = [node.info() for node in self.nodes]
+
+        used_memory = sum(info['used_memory'] for info in infos)
+        return {'used_memory': used_memory,
+                'used_memory_human': '%.2fM' % (used_memory / 1024.0 / 1024),
+                'nodes': infos}
+
+
+class ShardedPipeline(object):
+    """Collects commands into per-node pipelines. Results are returned in the original order"""
+
+    def __init__(self, sharded):
+        self.sharded = sharded
+        self.pipes = {} # node index => pipeline
+        self.order = [] # node index of every command
+
+    def _pipe_for(self, key):
+        node_index = self.sharded.router.get_node_index(key)
+
+        if node_index not in self.pipes:
+            node = self.sharded.nodes[node_index]
+            self.pipes[node_index] = node.pipeline(transaction=False)
+
+        self.order.append(node_index)
+        return self.pipes[node_index]
+
+    def evalsha(self, sha, numkeys, *args):
+        self._pipe_for(args[0]).evalsha(sha, numkeys, *args)
+        return self
+
+    def object(self, infotype, key):
+        self._pipe_for(key).object(infotype, key)
+        return self
+
+    def __len__(self):
+        return len(self.order)
+
+    def execute(self, raise_on_error=True):
+        results = dict((node_index, iter(pipe.execute(raise_on_error=raise_on_error)))
+                       for node_index, pipe in self.pipes.iteritems())
+
+        values = [results[node_index].next() for node_index in self.order]
+
+        self.pipes = {}
+        self.order = []
+        return values
+
+
+# commands which have a single key as the first argument
+KEY_COMMANDS = ['hget', 'hmget', 'hgetall', 'hkeys', 'hlen', 'hincrby', 'hdel',
+                'smembers', 'sadd', 'srem', 'scard',
+                # multi-key HyperLogLog commands need all keys on one node, see STASTE_HASH_TAGS
+                'pfadd', 'pfcount', 'pfmerge',
+                'zincrby', 'zscore', 'zcard', 'zrange', 'zrevrange', 'zrem',
+                'expire', 'ttl', 'exists', 'type', 'memory_usage']
+
+# commands which are not pipelined
+ROUTED_ONLY_COMMANDS = ['hscan_iter']
+
+
+def _routed(command):
+    def method(self, key, *args, **kwargs):
+        return getattr(self.get_node(key), command)(key, *args, **kwargs)
+    method.__name__ = command
+    return method
+
+
+def _pipelined(command):
+    def method(self, key, *args, **kwargs):
+        getattr(self._pipe_for(key), command)(key, *args, **kwargs)
+        return self
+    method.__name__ = command
+    return method
+
+
+for command in KEY_COMMANDS:
+    setattr(ShardedRedis, command, _routed(command))
+    setattr(ShardedPipeline, command, _pipelined(command))
+
+for command in ROUTED_ONLY_COMMANDS:
+    setattr(ShardedRedis, command, _routed(command))
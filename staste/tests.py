@@ -1,11 +1,28 @@
 import datetime
+import threading
+import time
 
 from django.test import TestCase
 from django.conf import settings
 
-from staste import redis
-from staste.metrica import Metrica, AveragedMetrica
-from staste.axis import Axis, StoredChoiceAxis
+from redis import Redis
+
+from staste import backend
+from staste.backends import MemoryBackend
+from staste import scripts
+from staste import batch_query
+from staste.bucket_cache import BucketCache, BUCKET_CACHE
+from staste.sharding import ShardedRedis, key_slot
+from staste.client import StasteRedis
+from staste.metrica import Metrica, AveragedMetrica, UniqueMetrica, HistogramMetrica
+from staste.axis import Axis, StoredChoiceAxis, TopKAxis, RangeAxis, LogRangeAxis, HierarchicalAxis
+from staste.buffer import KickBuffer
+from staste import benchmark
+from staste import instrumentation
+from staste import memory
+from staste import export
+from staste.explain import explain
+from staste.dateaxis import DateAxis, DATE_SCALES_AND_EXPIRATIONS, days_to_seconds
 
 def dtt(*args, **kwargs):
     return datetime.datetime(*args, **kwargs)
@@ -23,19 +40,22 @@ class TestStatsApi(TestCase):
 
         assert settings.STASTE_METRICS_PREFIX.endswith('_test')
         
-        for k in redis.keys(settings.STASTE_METRICS_PREFIX + '*'):
-            redis.delete(k)
+        for k in backend.keys(settings.STASTE_METRICS_PREFIX + '*'):
+            backend.delete(k)
 
     def setUp(self):
         self.old_prefix = getattr(settings, 'STASTE_METRICS_PREFIX', 'metrica')
         settings.STASTE_METRICS_PREFIX = self.old_prefix + '_test'
         
         self.removeAllKeys()
+        BUCKET_CACHE.clear()
+        self.old_cache_size = BUCKET_CACHE.size
 
     def tearDown(self):
         self.removeAllKeys()
         
         settings.STASTE_METRICS_PREFIX = self.old_prefix
+        BUCKET_CACHE.resize(self.old_cache_size)
             
     def testTheSimplestCase(self):
         # so we want to count my guests
@@ -261,6 +281,825 @@ class TestStatsApi(TestCase):
         chars = list(metrica.filter().iterate_averages('c'))
         self.assertEquals(chars, [('a', (12+7.5+0.16)/3), ('b', 1.5)])
         
+    def testBufferedMetrica(self):
+        buffer = KickBuffer(flush_interval=3600, max_events=10)
+        
+        axis = Axis(choices=['a', 'b'])
+        metrica = AveragedMetrica(name='some_buffered_metrica', axes=[('c', axis)],
+                                  multiplier=100, buffer=buffer)
+
+        d1 = datetime.datetime(2010, 2, 7)
+
+        for i in xrange(5):
+            metrica.kick(date=d1, value=2, c='a')
+        metrica.kick(date=d1, value=0.5, c='b')
+
+        # nothing is sent yet
+        self.assertEquals(metrica.total(), 0)
+
+        buffer.flush()
+        
+        self.assertEquals(metrica.total(), 10.5)
+        self.assertEquals(metrica.count(), 6)
+        self.assertEquals(metrica.filter(c='b').timespan(year=2010, month=2, day=7).total(), 0.5)
+
+        # too many kicks pending: flushed right away
+        for i in xrange(10):
+            metrica.kick(date=d1, c='b')
+
+        self.assertEquals(metrica.filter(c='b').count(), 11)
+
+        buffer.stop()
+        
+    def testScriptedKick(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        age_axis = StoredChoiceAxis()
+        metrica = AveragedMetrica(name='some_scripted_metrica',
+                                  axes=[('gender', gender_axis),
+                                        ('age', age_axis)],
+                                  multiplier=100, use_script=True)
+
+        d1 = datetime.datetime(2010, 2, 7)
+        d2 = datetime.datetime(2010, 2, 8)
+
+        metrica.kick(date=d1, value=12, gender='boy', age=17)
+        metrica.kick(date=d1, value=2, gender='girl', age=18)
+        metrica.kick(date=d2, value=7.5, gender='boy', age=18)
+
+        self.assertEquals(metrica.total(), 21.5)
+        self.assertEquals(metrica.count(), 3)
+        self.assertEquals(metrica.filter(gender='boy').total(), 19.5)
+        self.assertEquals(metrica.filter(gender='boy', age=18).timespan(year=2010, month=2, day=8).count(), 1)
+        self.assertEquals(set(metrica.filter().iterate_counts('age')), set([('17', 1), ('18', 2)]))
+        self.assertEquals(list(metrica.timespan().iterate()), [(2010, 21.5)])
+
+    def testScriptsAfterFlush(self):
+        client = Redis(**getattr(settings, 'STASTE_REDIS_CONNECTION', {}))
+
+        scripted = Metrica(name='some_flushed_scripted_metrica', use_script=True,
+                           axes=[('gender', Axis(choices=['boy', 'girl']))])
+        top = Metrica(name='some_flushed_top_metrica', axes=[('url', TopKAxis(k=2, capacity=3))])
+        seconds = Metrica(name='some_flushed_seconds_metrica', axes=[], use_script=True,
+                          date_axis=DateAxis(scales=DATE_SCALES_AND_EXPIRATIONS + [('second', 600)]))
+
+        scripted.kick(gender='boy')
+        top.kick(url='/a')
+
+        # Redis was restarted: scripts are loaded again
+        client.script_flush()
+        scripted.kick(gender='boy')
+        top.kick(url='/a')
+        top.kick(url='/b')
+
+        client.script_flush()
+        seconds.kick(value=3)
+        seconds.kick(value=4)
+
+        self.assertEquals(scripted.filter(gender='boy').total(), 2)
+        self.assertEquals(top.values().iterate('url'), [('/a', 2), ('/b', 1), ('__other__', 0)])
+        self.assertEquals(seconds.total(), 7)
+
+    def testKickPlans(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        age_axis = StoredChoiceAxis()
+        metrica = Metrica(name='some_planned_metrica',
+                          axes=[('gender', gender_axis),
+                                ('age', age_axis)])
+
+        d1 = datetime.datetime(2010, 2, 7, 12, 30)
+
+        metrica.kick(date=d1, gender='boy', age=17)
+        metrica.kick(date=d1, gender='boy', age=17)
+        metrica.kick(date=d1, gender='girl', age=17)
+
+        self.assertEquals(metrica.kick_stats['plan_misses'], 2)
+        self.assertEquals(metrica.kick_stats['plan_hits'], 1)
+        # month, day, hour and minute keys already have their TTLs
+        self.assertEquals(metrica.kick_stats['expires_saved'], 8)
+        # the age and the year are stored
+        self.assertEquals(metrica.kick_stats['sadds_saved'], 4)
+
+        self.assertEquals(metrica.filter(age=17).total(), 3)
+        self.assertEquals(metrica.filter(gender='boy').timespan(year=2010, month=2, day=7, hour=12, minute=30).total(), 2)
+        self.assertTrue(backend.ttl('%s:year:2010:month:2:day:7:hour:12:minute:30' % metrica.key_prefix()) > 0)
+        self.assertRaises(ValueError, metrica.kick, gender='dog')
+
+        # a TTL of a day is remembered for an hour at most
+        minute_key = '%s:year:2010:month:2:day:7:hour:12:minute:30' % metrica.key_prefix()
+        self.assertTrue(metrica._expiring_keys.get(minute_key) <= time.time() + metrica.expiring_keys_ttl)
+
+        # and only once it's sent
+        metrica.forget_kicks()
+        failing = metrica.pipeline()
+        def fail(*args, **kwargs):
+            raise IOError('Redis is down')
+        failing.execute = fail
+        metrica.pipeline = lambda: failing
+
+        self.assertRaises(IOError, metrica.kick, date=d1, gender='boy', age=17)
+        del metrica.pipeline
+        metrica.kick(date=d1, gender='boy', age=17)
+        self.assertEquals(metrica.kick_stats['expires_saved'], 8)
+        self.assertEquals(metrica.kick_stats['sadds_saved'], 4)
+        
+    def testCuboids(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        age_axis = StoredChoiceAxis()
+        drink_axis = Axis(choices=['tea', 'beer'])
+        metrica = Metrica(name='some_partial_metrica',
+                          axes=[('gender', gender_axis),
+                                ('age', age_axis),
+                                ('drink', drink_axis)],
+                          cuboids=[(), ('gender', 'age'), ('drink',)])
+
+        d1 = datetime.datetime(2010, 2, 7)
+
+        metrica.kick(date=d1, gender='boy', age=17, drink='tea')
+        metrica.kick(date=d1, gender='boy', age=18, drink='beer')
+        metrica.kick(date=d1, gender='girl', age=18, drink='beer')
+
+        # 3 stored combinations per kick instead of 8
+        self.assertEquals(len(backend.hkeys('%s:__all__' % metrica.key_prefix())), 6)
+
+        self.assertEquals(metrica.total(), 3)
+        self.assertEquals(metrica.filter(drink='beer').total(), 2)
+        self.assertEquals(metrica.filter(gender='boy', age=18).total(), 1)
+        
+        # summed up from the (gender, age) cuboid
+        self.assertEquals(metrica.filter(gender='boy').total(), 2)
+        self.assertEquals(metrica.filter(age=18).timespan(year=2010, month=2).total(), 2)
+        self.assertEquals(set(metrica.filter().iterate('gender')), set([('boy', 2), ('girl', 1)]))
+        self.assertEquals(list(metrica.filter(gender='girl').timespan(year=2010, month=2).iterate())[6], (7, 1))
+
+        self.assertRaises(ValueError, metrica.filter, gender='boy', drink='tea')
+        self.assertRaises(ValueError, Metrica, name='some_invalid_metrica',
+                          axes=[('gender', gender_axis)], cuboids=[('age',)])
+        
+    def testSharding(self):
+        self.assertEquals(key_slot('123456789'), 12739)
+        self.assertEquals(key_slot('staste:{visits}:__all__'), key_slot('visits'))
+
+        # scripts and unions of HyperLogLogs need all keys of a metrica on one node
+        settings.STASTE_REDIS_SHARDS = [{'db': 14}, {'db': 15}]
+        try:
+            self.assertRaises(ValueError, Metrica, name='some_sharded_metrica', axes=[], use_script=True)
+            self.assertRaises(ValueError, UniqueMetrica, name='some_sharded_metrica', axes=[])
+
+            settings.STASTE_HASH_TAGS = True
+            UniqueMetrica(name='some_sharded_metrica', axes=[])
+        finally:
+            settings.STASTE_REDIS_SHARDS = None
+            settings.STASTE_HASH_TAGS = False
+
+        connection = getattr(settings, 'STASTE_REDIS_CONNECTION', {})
+        nodes = [StasteRedis(**dict(connection, db=14)), StasteRedis(**dict(connection, db=15))]
+        sharded = ShardedRedis(nodes)
+
+        # slots are spread over both nodes
+        self.assertEquals(set(sharded.router.slots), set([0, 1]))
+
+        keys = ['%s:sharded:%s' % (settings.STASTE_METRICS_PREFIX, i) for i in xrange(20)]
+
+        pipe = sharded.pipeline()
+        for i, key in enumerate(keys):
+            pipe.hincrby(key, 'field', i)
+        for key in keys:
+            pipe.hget(key, 'field')
+        values = pipe.execute()
+
+        self.assertEquals(values, range(20) + [str(i) for i in xrange(20)])
+        self.assertEquals(sharded.hget(keys[7], 'field'), '7')
+        self.assertTrue(all(len(node.keys(settings.STASTE_METRICS_PREFIX + ':sharded:*'))
+                            for node in nodes))
+
+        self.assertEquals(sharded.delete(*keys), 20)
+        
+    def testMemoryBackend(self):
+        memory = MemoryBackend()
+
+        pipe = memory.pipeline()
+        pipe.hincrby('h', 'a', 2)
+        pipe.hincrby('h', 'a', 3)
+        pipe.sadd('s', 17)
+        pipe.expire('h', 60)
+        pipe.expire('nothing', 60)
+        self.assertEquals(pipe.execute(), [2, 5, 1, True, False])
+
+        self.assertEquals(memory.hget('h', 'a'), '5')
+        self.assertEquals(memory.hmget('h', ['a', 'b']), ['5', None])
+        self.assertEquals(memory.smembers('s'), set(['17']))
+        self.assertTrue(0 < memory.ttl('h') <= 60)
+        self.assertEquals(sorted(memory.keys('*')), ['h', 's'])
+
+        memory.expire('s', -1)
+        self.assertEquals(memory.keys('*'), ['h'])
+        self.assertEquals(memory.delete('h', 's'), 1)
+
+        # scripts run in Python
+        scripts.KICK(keys=['m'],
+                     args=['{"axes": [["__all__", "a"]], "scales": [["__all__", 0], ["year:2010", 60]], '
+                           '"value": "3", "count_postfix": ":__len__", "sets": [["years", 2010]]}'],
+                     client=memory)
+        self.assertEquals(memory.hgetall('m:year:2010'), {'__all__': '3', 'a': '3'})
+        self.assertEquals(memory.hget('m:__all__:__len__', 'a'), '1')
+        self.assertEquals(memory.smembers('m:years'), set(['2010']))
+        
+    def testBatchQuery(self):
+        axis = Axis(choices=['a', 'b'])
+        metrica = AveragedMetrica(name='some_batched_metrica', axes=[('c', axis)], multiplier=100)
+
+        d1 = datetime.datetime(2010, 2, 7)
+        d2 = datetime.datetime(2010, 2, 8)
+        
+        metrica.kick(date=d1, value=12, c='a')
+        metrica.kick(date=d1, value=2, c='b')
+        metrica.kick(date=d2, value=7.5, c='a')
+
+        with batch_query() as batch:
+            total = batch.total(metrica.values())
+            count = batch.count(metrica.filter(c='a'))
+            average = batch.average(metrica.timespan(year=2010, month=2, day=7))
+            chars = batch.iterate_averages(metrica.filter(), 'c')
+            days = batch.iterate_counts(metrica.timespan(year=2010, month=2))
+
+            self.assertFalse(total.ready)
+
+        self.assertEquals(total.value, 21.5)
+        self.assertEquals(count.value, 2)
+        self.assertEquals(average.value, 7)
+        self.assertEquals(chars.value, [('a', 9.75), ('b', 2)])
+        self.assertEquals(days.value[5:9], [(6, 0), (7, 2), (8, 1), (9, 0)])
+
+        self.assertEquals(Metrica.fetch_many([(metrica.filter(c='b'), 'total'),
+                                              (metrica.values(), 'iterate', 'c')]),
+                          [2, [('a', 19.5), ('b', 2)]])
+        
+    def testTimeserieBy(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        age_axis = StoredChoiceAxis()
+        metrica = Metrica(name='some_timeseried_metrica',
+                          axes=[('gender', gender_axis),
+                                ('age', age_axis)])
+
+        metrica.kick(date=dtm(hours=2), gender='boy', age=17)
+        metrica.kick(date=dtm(hours=2), gender='girl', age=18)
+        metrica.kick(date=dtm(hours=1), gender='boy', age=18)
+        metrica.kick(date=dtm(minutes=1), gender='boy', age=18)
+
+        since, until = dtm(hours=3), dtm()
+        values = metrica.filter(gender='boy')
+        
+        by_age = values.timeserie_by('age', since, until, 'hour')
+
+        self.assertEquals(set(by_age), set(['17', '18']))
+        for age in ['17', '18']:
+            self.assertEquals(by_age[age],
+                              values.filter(age=age).timeserie(since, until, 'hour'))
+        self.assertEquals(sum(v for point, v in by_age['18']), 2)
+        
+    def testClosedBucketCache(self):
+        self.assertFalse(BucketCache().enabled)
+        BUCKET_CACHE.resize(1000)
+
+        metrica = Metrica(name='some_cached_metrica', axes=[])
+
+        metrica.kick(date=dtt(2010, 2, 7))
+        metrica.kick(date=dtt(2010, 2, 8))
+        metrica.kick()
+
+        self.assertEquals(metrica.timespan(year=2010, month=2, day=7).total(), 1)
+        self.assertEquals(list(metrica.timespan(year=2010, month=2).iterate())[6:8], [(7, 1), (8, 1)])
+        self.assertEquals(metrica.total(), 3)
+
+        self.removeAllKeys()
+
+        # closed buckets are not read again
+        self.assertEquals(metrica.timespan(year=2010, month=2, day=7).total(), 1)
+        self.assertEquals(list(metrica.timespan(year=2010, month=2).iterate())[6:8], [(7, 1), (8, 1)])
+        # but the rest is
+        self.assertEquals(metrica.total(), 0)
+        
+    def testUniqueMetrica(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        metrica = UniqueMetrica(name='some_unique_metrica',
+                                axes=[('gender', gender_axis)])
+
+        d1 = dtm(days=2)
+        d2 = dtm(days=1)
+
+        for i in xrange(3):
+            metrica.kick('vasya', date=d1, gender='boy')
+            metrica.kick('petya', date=d1, gender='boy')
+            metrica.kick('masha', date=d1, gender='girl')
+            
+        metrica.kick('vasya', date=d2, gender='boy')
+        metrica.kick('dasha', date=d2, gender='girl')
+
+        self.assertEquals(metrica.total(), 4)
+        self.assertEquals(metrica.timespan(year=d1.year, month=d1.month, day=d1.day).total(), 3)
+        self.assertEquals(metrica.filter(gender='boy').total(), 2)
+        self.assertEquals(set(metrica.timespan(year=d2.year, month=d2.month, day=d2.day).iterate('gender')),
+                          set([('boy', 1), ('girl', 1)]))
+        self.assertEquals(list(metrica.timespan().iterate()), [(d1.year, 4)] if d1.year == d2.year
+                          else [(d1.year, 3), (d2.year, 2)])
+
+        # days are united, not summed up
+        self.assertEquals(metrica.values().unique_between(d1, d2, 'day'), 4)
+        self.assertEquals(metrica.filter(gender='boy').unique_between(d1, d2, 'day'), 2)
+
+        destkey = '%s:boys' % metrica.key_prefix()
+        self.assertEquals(metrica.filter(gender='boy').merge_between(destkey, d1, d2, 'day'), 2)
+        self.assertEquals(backend.pfcount(destkey), 2)
+
+        self.assertRaises(ValueError, metrica.values().query, 'total')
+
+        # buckets are united here too
+        self.assertEquals(metrica.values().total_between(dtm(days=3), dtm()), 4)
+        self.assertEquals(metrica.filter(gender='girl').total_between(dtm(days=3), dtm()), 2)
+
+        by_gender = metrica.values().timeserie_by('gender', d1, d2, 'day')
+        self.assertEquals([v for k, v in by_gender['boy']], [2, 1])
+        self.assertEquals([v for k, v in by_gender['girl']], [1, 1])
+
+        metrica.kick('vasya', gender='boy')
+        metrica.kick('vasya', gender='boy')
+        self.assertEquals(metrica.values().rate(window=60), 1 / 60.0)
+
+        # distinct counts are fetched right away in a batch
+        self.assertEquals(metrica.fetch_many([(metrica.filter(gender='boy'), 'total')]), [2])
+        
+    def testHistogramMetrica(self):
+        axis = Axis(choices=['a', 'b'])
+        metrica = HistogramMetrica(name='some_histogram_metrica', axes=[('c', axis)],
+                                   boundaries=[1, 2, 4, 8], multiplier=100)
+
+        d1 = dtm(hours=2)
+        d2 = dtm(hours=1)
+
+        for i in xrange(8):
+            metrica.kick(date=d1, value=0.5, c='a')
+        metrica.kick(date=d1, value=3, c='a')
+        metrica.kick(date=d2, value=100, c='b')
+
+        self.assertEquals(metrica.count(), 10)
+        self.assertEquals(metrica.filter(c='a').histogram(),
+                          [(1, 8), (2, 0), (4, 1), (8, 0), (None, 0)])
+        self.assertEquals(metrica.percentile(0.5), 0.625)
+        self.assertEquals(metrica.values().percentiles([0.9, 1]), [4, 8])
+        self.assertEquals(metrica.filter(c='b').percentile(0.5), 8)
+        self.assertEquals(metrica.timespan(year=1999).percentile(0.5), None)
+
+        points = metrica.values().timeserie_percentiles(dtm(hours=3), dtm(), 'hour', qs=[0.5])
+        self.assertEquals([ps for point, ps in points if ps != [None]], [[0.5625], [8]])
+
+        self.assertEquals(metrica.values().histogram_between(d1, d2, 'hour'),
+                          [(1, 8), (2, 0), (4, 1), (8, 0), (None, 1)])
+        self.assertEquals(metrica.values().percentiles_between(d1, d2, 'hour', qs=[0.5]), [0.625])
+
+        # histograms expire with their buckets
+        minute_key = '%s:year:%s:month:%s:day:%s:hour:%s:minute:%s' % (metrica.key_prefix(), d2.year, d2.month,
+                                                                     d2.day, d2.hour, d2.minute)
+        self.assertTrue(0 < backend.ttl(minute_key + ':__hist__') <= days_to_seconds(1))
+        
+    def testTopKAxis(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        url_axis = TopKAxis(k=2, capacity=3)
+        metrica = Metrica(name='some_top_metrica', axes=[('gender', gender_axis),
+                                                         ('url', url_axis)])
+
+        for i in xrange(4):
+            metrica.kick(gender='boy', url='/a')
+        metrica.kick(gender='girl', url='/b', value=2)
+        metrica.kick(gender='boy', url='/c')
+
+        # every value fits: counts are exact
+        self.assertEquals(metrica.filter(gender='boy').iterate('url'),
+                          [('/a', 4), ('/c', 1), ('__other__', 0)])
+        # the set is full: counts are lower bounds, the rest is folded
+        self.assertEquals(metrica.values().iterate('url'),
+                          [('/a', 3), ('/b', 1), ('__other__', 3)])
+
+        # '/d' replaces '/c', the rarest one
+        metrica.kick(gender='girl', url='/d')
+        self.assertEquals(metrica.values().iterate('url'),
+                          [('/a', 2), ('__other__', 6)])
+        self.assertEquals(metrica.total(), 8)
+
+        self.assertEquals(metrica.kick_stats['plan_misses'], 4)
+        self.assertRaises(ValueError, metrica.filter, url='/a')
+        self.assertRaises(ValueError, Metrica, name='scripted_top_metrica',
+                          axes=[('url', url_axis)], use_script=True)
+        
+    def testRangeAxis(self):
+        age_axis = RangeAxis(boundaries=[25, 18, 65])
+        self.assertEquals(age_axis.choices, ['<18', '18-25', '25-65', '65+'])
+        self.assertEquals(LogRangeAxis(1, 4).choices, ['<1', '1-2', '2-4', '4+'])
+        # boundaries are not rounded
+        self.assertEquals(RangeAxis(boundaries=[0.1, 1048576.0, 1048577]).choices,
+                          ['<0.1', '0.1-1048576', '1048576-1048577', '1048577+'])
+        
+        metrica = Metrica(name='some_range_metrica', axes=[('age', age_axis)])
+
+        metrica.kick(age=0)
+        metrica.kick(age=18)
+        metrica.kick(age=24.5)
+        metrica.kick(age=80)
+        metrica.kick(age=None)
+
+        self.assertEquals(metrica.total(), 5)
+        self.assertEquals(metrica.filter(age='18-25').total(), 2)
+        self.assertEquals(metrica.filter(age=20).total(), 2)
+        self.assertEquals(metrica.filter(age=0).total(), 1)
+        self.assertEquals(metrica.values().iterate('age'),
+                          [('<18', 1), ('18-25', 2), ('25-65', 0), ('65+', 1)])
+        self.assertEquals(backend.keys(metrica.key_for_axis_choices('age')), [])
+        
+    def testHierarchicalAxis(self):
+        view_axis = HierarchicalAxis()
+        self.assertEquals(HierarchicalAxis(separator='/').get_ancestors('/blog/2011'),
+                          ['/blog', '/blog/2011'])
+        
+        metrica = Metrica(name='some_hierarchical_metrica', axes=[('view', view_axis)])
+
+        metrica.kick(view='app.views.index')
+        metrica.kick(view='app.views.index')
+        metrica.kick(view='app.views.about')
+        metrica.kick(view='app.admin.index')
+        metrica.kick(view='other.views.index')
+
+        self.assertEquals(metrica.total(), 5)
+        self.assertEquals(metrica.filter(view='app').total(), 4)
+        self.assertEquals(metrica.filter(view='app.views.index').total(), 2)
+
+        self.assertEquals(sorted(metrica.values().iterate('view')),
+                          [('app', 4), ('other', 1)])
+        self.assertEquals(sorted(metrica.filter(view='app').iterate('view')),
+                          [('app.admin', 1), ('app.views', 3)])
+        self.assertEquals(sorted(metrica.filter(view='app.views').iterate('view')),
+                          [('app.views.about', 1), ('app.views.index', 2)])
+        self.assertEquals(metrica.filter(view='app.views.about').iterate('view'), [])
+        
+    def testDateScales(self):
+        self.assertRaises(ValueError, DateAxis, scales=[('week', 0)])
+        
+        date_axis = DateAxis(scales=[('hour', days_to_seconds(2)), ('day', 0)])
+        metrica = Metrica(name='some_scaled_metrica', axes=[], date_axis=date_axis)
+
+        d = dtm(hours=1)
+        metrica.kick(date=d)
+
+        day_key = '%s:year:%s:month:%s:day:%s' % (metrica.key_prefix(), d.year, d.month, d.day)
+        hour_key = '%s:hour:%s' % (day_key, d.hour)
+        self.assertEquals(sorted(backend.keys(metrica.key_prefix() + ':*')),
+                          sorted(['%s:__all__' % metrica.key_prefix(), day_key, hour_key]))
+        self.assertEquals(backend.ttl(day_key), None)
+        self.assertTrue(backend.ttl(hour_key) > days_to_seconds(1))
+
+        day = metrica.timespan(year=d.year, month=d.month, day=d.day)
+        self.assertEquals(day.total(), 1)
+        self.assertRaises(ValueError, metrica.timespan, year=d.year)
+        self.assertRaises(ValueError, day.timespan(hour=d.hour).iterate)
+
+        # there are no minutes, so hours are used
+        points = metrica.values().timeserie(dtm(hours=3), dtm(), 'minute')
+        self.assertTrue(len(points) <= 4)
+        self.assertEquals(sum(v for k, v in points), 1)
+        
+    def testSecondScale(self):
+        date_axis = DateAxis(scales=DATE_SCALES_AND_EXPIRATIONS + [('second', 600)])
+        metrica = AveragedMetrica(name='some_second_metrica', axes=[], date_axis=date_axis)
+        scripted_metrica = Metrica(name='some_scripted_second_metrica', axes=[],
+                                   date_axis=date_axis, use_script=True)
+
+        d = dtm(seconds=30)
+        metrica.kick(date=d, value=2)
+        metrica.kick(date=d, value=4)
+        scripted_metrica.kick(date=d)
+
+        # seconds are fields of a hash of their minute, '<field id>#<second>'. No axes - an empty field id
+        minute_id = 'year:%s:month:%s:day:%s:hour:%s:minute:%s' % (d.year, d.month, d.day, d.hour, d.minute)
+        self.assertEquals(backend.hgetall('%s:%s:second' % (metrica.key_prefix(), minute_id)),
+                          {'#%s' % d.second: '6'})
+        self.assertEquals(backend.hgetall('%s:%s:second' % (scripted_metrica.key_prefix(), minute_id)),
+                          {'#%s' % d.second: '1'})
+
+        # counts expire with their hashes of seconds, kicked with a pipeline or with a script
+        scripted_averaged = AveragedMetrica(name='some_scripted_averaged_second_metrica', axes=[],
+                                            date_axis=date_axis, use_script=True)
+        scripted_averaged.kick(date=d, value=3)
+
+        for m in [metrica, scripted_averaged]:
+            self.assertTrue(0 < backend.ttl('%s:%s:second:__len__' % (m.key_prefix(), minute_id)) <= 600)
+            self.assertTrue(0 < backend.ttl('%s:%s:__len__' % (m.key_prefix(), minute_id)) <= days_to_seconds(1))
+
+        points = metrica.values().timeserie(dtm(minutes=1), dtm(), 'second')
+        self.assertTrue(59 <= len(points) <= 61)
+        self.assertEquals(sum(v for k, v in points), 6)
+        self.assertEquals(sum(v for k, v in metrica.values().timeserie_counts(dtm(minutes=1), dtm(), 'second')), 2)
+
+        # there are no seconds, so minutes are used
+        points = Metrica(name='some_second_metrica', axes=[]).values().timeserie(dtm(minutes=1), dtm(), 'second')
+        self.assertTrue(len(points) <= 2)
+
+        self.assertRaises(ValueError, UniqueMetrica, name='some_unique_second_metrica', axes=[],
+                          date_axis=date_axis)
+        
+    def testTotalBetween(self):
+        date_axis = DateAxis(scales=[(scale, 0) for scale, expiration in DATE_SCALES_AND_EXPIRATIONS])
+        tp_ids = date_axis.decompose(dtt(2011, 1, 30, 22, 30), dtt(2011, 3, 2, 1, 15))
+        self.assertEquals(len(tp_ids), 50)
+        self.assertEquals(tp_ids[30:35], ['year:2011:month:1:day:30:hour:23',
+                                          'year:2011:month:1:day:31',
+                                          'year:2011:month:2',
+                                          'year:2011:month:3:day:1',
+                                          'year:2011:month:3:day:2:hour:0'])
+
+        metrica = AveragedMetrica(name='some_between_metrica', axes=[])
+        metrica.kick(date=dtm(hours=40), value=1)
+        metrica.kick(date=dtm(hours=30), value=2)
+        metrica.kick(date=dtm(hours=2), value=3)
+        metrica.kick(date=dtm(minutes=5), value=4)
+
+        self.assertEquals(metrica.values().total_between(dtm(hours=36), dtm()), 9)
+        self.assertEquals(metrica.values().count_between(dtm(hours=36), dtm()), 3)
+        self.assertEquals(metrica.values().total_between(dtm(hours=1), dtm()), 4)
+        self.assertTrue(len(metrica.date_axis.decompose(dtm(hours=36), dtm())) < 150)
+        
+    def testRates(self):
+        gender_axis = Axis(choices=['boy', 'girl'])
+        metrica = Metrica(name='some_rate_metrica', axes=[('gender', gender_axis)])
+
+        metrica.kick(date=dtm(seconds=30), value=6, gender='girl')
+        metrica.kick(date=dtm(seconds=40), value=3, gender='boy')
+        metrica.kick(date=dtm(minutes=30), value=100, gender='boy')
+
+        self.assertAlmostEqual(metrica.filter(gender='girl').rate(120), 0.05)
+        self.assertAlmostEqual(metrica.values().rate(600), 0.015)
+
+        rates = metrica.rates([{}, {'gender': 'girl'}], [120, 600])
+        self.assertEquals([[round(rate, 6) for rate in window_rates] for window_rates in rates],
+                          [[0.075, 0.015], [0.05, 0.01]])
+        
+    def testBenchmark(self):
+        results = benchmark.run_benchmarks(names=['kick', 'iterate'], ops=3)
+
+        kicks = [r for r in results['results'] if r['benchmark'] == 'kick']
+        self.assertEquals([r['params']['axes'] for r in kicks], [0, 1, 2, 3, 4])
+        # a pipeline of increments, expires and the years set member, then just increments
+        self.assertTrue(kicks[0]['commands_per_op'] >= 6)
+        self.assertTrue(kicks[4]['commands_per_op'] > kicks[0]['commands_per_op'])
+        self.assertTrue(all(r['p50_ms'] <= r['p99_ms'] for r in results['results']))
+        
+        self.assertEquals(backend.keys(settings.STASTE_METRICS_PREFIX + ':*staste_benchmark_*'), [])
+        self.assertFalse('hincrby' in backend.__dict__)
+
+        comparison = benchmark.compare_results(results, results)
+        self.assertEquals(set(ratio for name, params, old, new, ratio in comparison), set([1.0]))
+        
+    def testInstrumentation(self):
+        metrica = Metrica(name='some_instrumented_metrica', axes=[])
+        other_metrica = Metrica(name='some_other_instrumented_metrica', axes=[])
+
+        instrumentation.enable()
+        instrumentation.reset()
+        try:
+            metrica.kick()
+            metrica.kick()
+            metrica.total()
+            other_metrica.kick()
+        finally:
+            instrumentation.disable()
+
+        stats = metrica.traffic()
+        # two kicks of 6 increments (with 4 expires and a years set member the first time), and a total
+        self.assertEquals(stats['commands'], 6 + 4 + 1 + 6 + 1)
+        self.assertEquals(stats['pipelines'], 3)
+        self.assertEquals(sum(stats['latency_ms']['counts']), 3)
+        self.assertTrue(stats['bytes'] > 0)
+        self.assertEquals(other_metrica.traffic()['pipelines'], 1)
+
+        metrica.kick()
+        self.assertEquals(metrica.traffic()['pipelines'], 3)
+        self.assertFalse('pipeline' in backend.__dict__)
+
+        # hooks are uninstalled in any order
+        counter = benchmark.CommandCounter()
+        instrumentation.enable()
+        counter.install(backend)
+        instrumentation.disable()
+        try:
+            metrica.kick()
+        finally:
+            counter.uninstall()
+
+        self.assertEquals(metrica.traffic()['pipelines'], 3)
+        self.assertEquals(counter.commands, 6)
+        self.assertFalse('pipeline' in backend.__dict__)
+        
+    def testExplain(self):
+        metrica = Metrica(name='some_explained_metrica', axes=[('browser', StoredChoiceAxis())])
+        for browser in ['firefox', 'opera', 'safari', 'firefox']:
+            metrica.kick(browser=browser)
+
+        values = metrica.values()
+        report = values.explain('iterate', 'browser')
+
+        self.assertEquals(report['result'], values.iterate('browser'))
+        self.assertEquals(report['choice_sets'], {metrica.key_for_axis_choices('browser'): 3})
+        self.assertEquals(report['commands'].get('smembers'), 1)
+        self.assertTrue(report['round_trips'] >= 2)
+        self.assertTrue(report['hash_fields'] >= 3)
+        self.assertTrue(report['total_ms'] >= report['redis_ms'] >= 0)
+
+        report = values.filter(browser='opera').explain('total')
+        self.assertEquals(report['result'], 1)
+        self.assertEquals(report['choice_sets'], {})
+        self.assertEquals(report['keys'], 1)
+        self.assertFalse('hmget' in backend.__dict__)
+
+        # concurrent calls record their own commands only
+        started = threading.Event()
+        resumed = threading.Event()
+        reports = {}
+
+        def slow_total():
+            started.set()
+            resumed.wait(5)
+            return metrica.total()
+
+        def explain_slow_total():
+            reports['slow'] = explain(slow_total)
+
+        def finish_and_iterate():
+            # the other call is over while this one is being explained
+            resumed.set()
+            thread.join(5)
+            return values.iterate('browser')
+
+        thread = threading.Thread(target=explain_slow_total)
+        thread.start()
+        started.wait(5)
+
+        report = explain(finish_and_iterate)
+
+        self.assertEquals(report['commands'].get('smembers'), 1)
+        self.assertEquals(reports['slow']['result'], 4)
+        self.assertEquals(reports['slow']['commands'], {'hmget': 1})
+        self.assertFalse('hmget' in backend.__dict__)
+
+    def testMemoryReport(self):
+        metrica = Metrica(name='some_measured_metrica', axes=[('browser', StoredChoiceAxis())])
+        metrica.kick(browser='firefox', date=dtt(2011, 3, 2, 10, 5))
+        metrica.kick(browser='opera', date=dtt(2011, 3, 2, 10, 5))
+
+        self.assertEquals(memory.parse_key(metrica, metrica.key_prefix() + ':year:2011:month:3'),
+                          ('values', 'month', None))
+        self.assertEquals(memory.parse_key(metrica, metrica.key_prefix() + ':__all__:__len__'),
+                          ('counts', '__all__', None))
+        self.assertEquals(memory.parse_key(metrica, metrica.key_prefix() + ':__choices__:browser'),
+                          ('choices', None, 'browser'))
+
+        report = metrica.memory_report(count=3, kicks_per_second=1)
+
+        # 6 hashes of '__all__', 'firefox' and 'opera', the years set and the browsers set
+        self.assertEquals(report['keys'], 8)
+        self.assertEquals(report['fields'], 6 * 3 + 1 + 2)
+        self.assertTrue(report['memory'] > 0)
+        self.assertEquals(report['other']['keys'], 0)
+        self.assertEquals(report['axes']['browser']['choices'], 2)
+        self.assertEquals(report['max_fields_per_bucket'], 3)
+
+        minutes = report['scales']['minute']
+        self.assertEquals((minutes['keys'], minutes['fields']), (1, 3))
+        self.assertEquals(minutes['projection']['buckets'], 24 * 60 + 1)
+        self.assertEquals(minutes['projection']['fields_per_bucket'], 3)
+        self.assertTrue('memory_per_year' in report['scales']['year']['projection'])
+        self.assertEquals(report['persistent']['keys'], 0)
+
+        # a count of a minute left without a TTL by an older version
+        backend.hincrby(metrica.key_prefix() + ':year:2011:month:3:day:2:hour:10:minute:5:__len__', 'total')
+        report = metrica.memory_report(count=3, kicks_per_second=1)
+        self.assertEquals(report['persistent']['keys'], 1)
+
+        # no stored scale keeps the last hour to measure the rate with
+        metrica = Metrica(name='some_briefly_measured_metrica', axes=[],
+                          date_axis=DateAxis(scales=[('minute', 1800)]))
+        metrica.kick()
+        report = metrica.memory_report()
+        self.assertEquals(report['kicks_per_second'], None)
+        self.assertEquals(report['persistent']['keys'], 0)
+
+    def testPruneAndPurge(self):
+        metrica = Metrica(name='some_pruned_metrica', axes=[('browser', StoredChoiceAxis())])
+        metrica.kick(browser='firefox', date=dtt(2011, 3, 2, 10, 5))
+        metrica.kick(browser='opera')
+
+        # the same metrica in another process, which remembers stored choices for no time
+        other = Metrica(name='some_pruned_metrica', axes=[('browser', StoredChoiceAxis())])
+        other.stored_members_ttl = 0
+        other.kick(browser='firefox', date=dtt(2011, 3, 2, 10, 5))
+
+        result = metrica.prune(since=dtm(days=30), batch_size=1)
+        
+        self.assertEquals(result['choices'], {'browser': ['firefox']})
+        # from the '__all__' hash and the 2011 one
+        self.assertEquals(result['fields'], 2)
+        self.assertEquals(list(metrica.choices('browser')), ['opera'])
+        self.assertEquals(metrica.filter(browser='firefox').total(), 0)
+        self.assertEquals(metrica.timespan(year=2011).total(), 2)
+        self.assertEquals(metrica.filter(browser='opera').total(), 1)
+
+        # stored again once it's kicked again, in other processes too
+        other.kick(browser='firefox')
+        self.assertEquals(sorted(metrica.choices('browser')), ['firefox', 'opera'])
+        self.assertEquals(other.kick_stats['sadds_saved'], 0)
+
+        self.assertRaises(ValueError, Metrica(name='some_pruned_metrica', axes=[('gender', Axis(choices=['boy']))]).prune,
+                          dtm(days=30), axes=['gender'])
+
+        # 2 * 5 time buckets, the '__all__' one, years and browsers
+        self.assertEquals(metrica.purge(batch_size=2), 13)
+        self.assertEquals(backend.keys(metrica.key_prefix() + ':*'), [])
+        self.assertEquals(metrica.total(), 0)
+
+        # HyperLogLogs of a stale choice are deleted
+        unique = UniqueMetrica(name='some_pruned_unique_metrica', axes=[('browser', StoredChoiceAxis())])
+        unique.kick('user1', browser='firefox', date=dtt(2011, 3, 2, 10, 5))
+        unique.kick('user2', browser='opera')
+
+        result = unique.prune(since=dtm(days=30), batch_size=1)
+        self.assertEquals(result['choices'], {'browser': ['firefox']})
+        # of the '__all__' bucket and the 2011 one
+        self.assertEquals(result['keys'], 2)
+        self.assertEquals(backend.keys(unique.key_prefix() + ':__all__:*firefox'), [])
+        self.assertEquals(backend.keys(unique.key_prefix() + ':year:2011:__unique__:firefox'), [])
+        self.assertEquals(unique.filter(browser='firefox').total(), 0)
+        self.assertEquals(unique.filter(browser='opera').total(), 1)
+        self.assertEquals(unique.timespan(year=2011).total(), 1)
+        unique.purge()
+
+    def testExport(self):
+        metrica = Metrica(name='some_exported_metrica', axes=[('gender', Axis(choices=['boy', 'girl']))])
+        metrica.kick(gender='boy', date=dtt(2011, 3, 2, 10, 5))
+
+        rows = list(export.rows(metrica, count=1))
+        # '__all__' and 'boy' fields of 6 time buckets
+        self.assertEquals(len(rows), 12)
+        self.assertTrue({'timespan': 'year:2011:month:3', 'scale': 'month', 'gender': 'boy', 'value': 1} in rows)
+        self.assertTrue({'timespan': '__all__', 'scale': '__all__', 'gender': '__all__', 'value': 1} in rows)
+
+        lines = list(export.export_lines(metrica, 'csv'))
+        self.assertEquals(len(lines), 13)
+        self.assertEquals(lines[0], 'timespan,scale,gender,value\r\n')
+        self.assertEquals(len(list(export.export_lines(metrica, 'jsonl'))), 12)
+        self.assertRaises(ValueError, export.export_lines, metrica, 'xml')
+
+        averaged = AveragedMetrica(name='some_exported_averaged_metrica', axes=[])
+        averaged.kick(value=5, date=dtt(2011, 3, 2, 10, 5))
+        averaged.kick(value=7, date=dtt(2011, 3, 2, 10, 5))
+
+        self.assertEquals(export.columns(averaged), ['timespan', 'scale', 'value', 'count'])
+        self.assertTrue({'timespan': '__all__', 'scale': '__all__', 'value': 12, 'count': 2}
+                        in list(export.rows(averaged)))
+
+    def testKickMany(self):
+        metrica = Metrica(name='some_bulk_metrica', axes=[('browser', StoredChoiceAxis())])
+        kicked = Metrica(name='some_kicked_metrica', axes=[('browser', StoredChoiceAxis())])
+
+        events = [{'browser': browser, 'date': dtt(2011, 3, 2, 10, minute), 'value': minute}
+                  for minute in xrange(5)
+                  for browser in ['firefox', 'opera', 'firefox']]
+
+        for event in events:
+            kicked.kick(**dict(event))
+
+        self.assertEquals(metrica.kick_many(iter(events), chunk_size=4), 15)
+
+        self.assertEquals(metrica.total(), kicked.total())
+        self.assertEquals(metrica.filter(browser='firefox').total(), 2 * (0 + 1 + 2 + 3 + 4))
+        self.assertEquals(metrica.timespan(year=2011, month=3, day=2, hour=10).iterate(),
+                          kicked.timespan(year=2011, month=3, day=2, hour=10).iterate())
+        self.assertEquals(sorted(metrica.choices('browser')), ['firefox', 'opera'])
+
+        # the hour is over and cached, but it's kicked again
+        BUCKET_CACHE.resize(1000)
+        hour = metrica.timespan(year=2011, month=3, day=2, hour=10)
+        self.assertEquals(hour.total(), 30)
+        metrica.kick_many([{'browser': 'opera', 'date': dtt(2011, 3, 2, 10, 59)}])
+        self.assertEquals(hour.total(), 31)
+
+        averaged = AveragedMetrica(name='some_bulk_averaged_metrica', axes=[])
+        averaged.kick_many([{'value': 1}, {'value': 3}])
+        self.assertEquals(averaged.average(), 2)
+        
+        unique = UniqueMetrica(name='some_bulk_unique_metrica', axes=[('gender', Axis(choices=['boy', 'girl']))])
+        items = [{'item': name, 'gender': gender, 'date': dtt(2011, 3, 2, 10, 5)}
+                 for name, gender in [('vasya', 'boy'), ('petya', 'boy'), ('masha', 'girl'), ('vasya', 'boy')]]
+        self.assertEquals(unique.kick_many(items, chunk_size=3), 4)
+        self.assertEquals(unique.total(), 3)
+        self.assertEquals(unique.filter(gender='boy').timespan(year=2011, month=3).total(), 2)
+        self.assertEquals(list(unique.timespan().iterate()), [(2011, 3)])
+
     def testNewTimespans(self):
     
         metrica = Metrica(name='guest_visits', axes=[])
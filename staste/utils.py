@@ -1 +1,12 @@
-    
+def batches(iterable, size):
+    """Yields lists of at most `size` items of an iterable, without reading it all"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -1,5 +1,5 @@
 from staste.metrica import Metrica
-from staste.axis import Axis, StoredChoiceAxis
+from staste.axis import Axis, RangeAxis
 
 from .forms import GENDERS
 
@@ -7,8 +7,9 @@ from .forms import GENDERS
 
 gender_axis = Axis(choices=GENDERS.keys())
 
-age_axis = StoredChoiceAxis()
+age_axis = RangeAxis(boundaries=[18, 25, 35, 50, 65])
 
-gender_age_metrica = Metrica(name='visitors_gender_and_age',
+# ages used to be a StoredChoiceAxis, so it's a new metrica
+gender_age_metrica = Metrica(name='visitors_gender_and_age_ranges',
                              axes=[('gender', gender_axis),
                                    ('age', age_axis),])
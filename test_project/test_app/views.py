@@ -1,7 +1,7 @@
 from django.http import HttpResponseRedirect
 from django.views.generic import FormView
 
-from staste import redis
+from staste import backend
 
 from .forms import ParticipantForm, GENDERS
 from .metrics import gender_age_metrica
@@ -13,7 +13,7 @@ class IndexView(FormView):
 
     def get_context_data(self, *args, **kwargs):
         data = super(IndexView, self).get_context_data(*args, **kwargs)
-        data['redis_memory'] = redis.info()['used_memory_human']
+        data['redis_memory'] = backend.info()['used_memory_human']
         return data
       
     def form_valid(self, form):